@@ -0,0 +1,416 @@
+import asyncio
+import json
+import os
+import re
+import shutil
+import time
+from aiohttp import web
+from compressor import compressor, QUALITY_PRESETS
+from queue_manager import queue_manager, Job
+from cost_model import cost_model
+from media_probe import media_probe
+from spool import spool, estimate_job_space, SpoolFullError
+from metrics import metrics
+from broker import broker
+from job_store import FINAL_STATES
+from cancellation import JobCancelled
+from url_source import UrlSource
+from config import (
+    API_TOKEN, API_PATHS, API_OUTPUT_DIR, API_JOBS_PER_CLIENT, API_RESULT_TTL,
+    ENCODE_BACKEND, MAX_FILE_SIZE, MAX_TARGET_SIZE_MB
+)
+
+# Cada cuánto se reenvía el estado por SSE aunque no cambie (posición y ETA en cola)
+SSE_REFRESH = 5
+
+def allowed_path(path):
+    real = os.path.realpath(path)
+    return any(real == root or real.startswith(root + os.sep) for root in API_PATHS)
+
+class LocalSource:
+    """Archivo de esta máquina enviado por ruta: se comprime en su lugar, sin copiarlo."""
+    def __init__(self, path, info=None):
+        self.path = path
+        self.file_name = os.path.basename(path)
+        self.file_size = os.path.getsize(path)
+        self.duration = info.duration if info else 0
+        self.height = info.height if info else 0
+        self.info = info
+
+class JobApi:
+    """
+    Trabajos enviados por HTTP (/api/jobs) en lugar de Telegram, para herramientas
+    internas. Pasan por la misma cola, el mismo scheduler y el mismo VideoCompressor
+    que los del bot, pero el resultado queda en disco (API_OUTPUT_DIR o la ruta
+    pedida) en vez de subirse. El estado vive en memoria: un reinicio los pierde.
+    """
+    def __init__(self):
+        self.jobs = {}
+        self.status = {}
+        self.listeners = {}
+
+    async def submit(self, data):
+        """Valida el pedido y encola el trabajo. ValueError/PermissionError si no es válido."""
+        url = data.get('url')
+        path = data.get('path')
+        if bool(url) == bool(path):
+            raise ValueError("Indica 'url' o 'path' (sólo uno)")
+        quality = data.get('quality') or '360p'
+        if quality not in QUALITY_PRESETS:
+            raise ValueError(f"Calidad desconocida: {quality}")
+        target_size = data.get('target_size')
+        if target_size is not None:
+            try:
+                target_size = int(target_size)
+            except (TypeError, ValueError):
+                raise ValueError("'target_size' debe ser un número de MB")
+            if not 1 <= target_size <= MAX_TARGET_SIZE_MB:
+                raise ValueError(f"'target_size' debe estar entre 1 y {MAX_TARGET_SIZE_MB} MB")
+        output_path = data.get('output_path')
+        if output_path:
+            # Se resuelve entera antes de validar: un enlace simbólico dentro de API_PATHS no debe escapar
+            output_path = os.path.realpath(output_path)
+            if not allowed_path(output_path):
+                raise PermissionError("'output_path' fuera de API_PATHS")
+
+        if url:
+            if not re.match(r'^https?://', url):
+                raise ValueError("'url' debe empezar con http:// o https://")
+            source = await UrlSource.probe(url)
+            if source.file_size > MAX_FILE_SIZE:
+                raise ValueError(f"El archivo supera el máximo de {MAX_FILE_SIZE // (1024 * 1024)} MB")
+        else:
+            if not allowed_path(path):
+                raise PermissionError("'path' fuera de API_PATHS")
+            if not os.path.isfile(path):
+                raise ValueError(f"No existe el archivo {path}")
+            source = LocalSource(os.path.realpath(path), await media_probe.probe(path))
+
+        client = str(data.get('client') or 'default')[:64]
+        # Cada cliente es un "usuario" más del scheduler, con su propio reparto justo
+        user_id = f"api:{client}"
+        queue_manager.user_limits[user_id] = API_JOBS_PER_CLIENT
+        job = Job(user_id, None, quality, target_size, source=source)
+        job.output_path = output_path
+        self.jobs[job.id] = job
+        self.status[job.id] = {
+            'id': job.id,
+            'client': client,
+            'source': job.url or source.path,
+            'quality': quality,
+            'target_size': target_size,
+            'progress': 0,
+            'created_at': job.created_at,
+            'started_at': None,
+            'finished_at': None,
+            'result': None,
+            'error': None,
+            'output': None
+        }
+        self.prune()
+        await queue_manager.add_to_queue(user_id, job)
+        print(f"🛰️ Trabajo de la API {job.id} ({client}, {quality}): {self.status[job.id]['source']}")
+        return self.describe(job)
+
+    def describe(self, job):
+        status = dict(self.status[job.id], state=job.state, updated_at=time.time())
+        if job.state == 'queued':
+            eta = cost_model.eta(job)
+            status['position'] = eta['position']
+            status['eta'] = round(eta['wait'] + eta['duration'])
+        elif job.state not in FINAL_STATES:
+            started = job.started_at or time.time()
+            status['eta'] = round(max(cost_model.predict(job)['total'] - (time.time() - started), 0))
+        return status
+
+    def update(self, job, state=None, **changes):
+        if state:
+            job.state = state
+        self.status[job.id].update(changes)
+        listeners = self.listeners.get(job.id)
+        if not listeners:
+            return
+        status = self.describe(job)
+        for queue in listeners:
+            # Un cliente lento sólo recibe el último estado
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(status)
+
+    def finish(self, job, state, **changes):
+        self.update(job, state, finished_at=time.time(), **changes)
+
+    def subscribe(self, job):
+        queue = asyncio.Queue(maxsize=1)
+        self.listeners.setdefault(job.id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, job, queue):
+        listeners = self.listeners.get(job.id, set())
+        listeners.discard(queue)
+        if not listeners:
+            self.listeners.pop(job.id, None)
+
+    async def cancel(self, job):
+        """Cancela un trabajo en cola o en curso. False si ya había terminado."""
+        if job.state in FINAL_STATES:
+            return False
+        if queue_manager.remove(job):
+            self.finish(job, 'cancelled')
+            return True
+        # Cada etapa lo revisa: la descarga en su próximo bloque, FFmpeg muere en el acto
+        job.cancel_token.cancel()
+        return True
+
+    async def forget(self, job):
+        """Borra un trabajo terminado y la salida que guardó la API."""
+        self.jobs.pop(job.id, None)
+        status = self.status.pop(job.id, {})
+        output = status.get('output')
+        if output and self._owned(output):
+            await asyncio.to_thread(self._remove, output)
+
+    def _owned(self, path):
+        return os.path.dirname(path) == os.path.realpath(API_OUTPUT_DIR)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def prune(self):
+        """Olvida los trabajos terminados hace más de API_RESULT_TTL y borra sus salidas."""
+        limit = time.time() - API_RESULT_TTL
+        for job_id, status in list(self.status.items()):
+            if status['finished_at'] and status['finished_at'] < limit:
+                self.jobs.pop(job_id, None)
+                del self.status[job_id]
+        # También los restos de ejecuciones anteriores (el registro no sobrevive a un reinicio)
+        if os.path.isdir(API_OUTPUT_DIR):
+            for name in os.listdir(API_OUTPUT_DIR):
+                path = os.path.join(API_OUTPUT_DIR, name)
+                try:
+                    if os.path.getmtime(path) < limit:
+                        os.remove(path)
+                except OSError:
+                    pass
+
+    async def run(self, job):
+        """Pipeline de un trabajo de la API: descarga (si es un enlace), encode y entrega."""
+        source = job.source
+        quality = job.quality
+        target_size = job.target_size * 1024 * 1024 if job.target_size else None
+        local = isinstance(source, LocalSource)
+        metrics.phase_duration.observe(time.time() - job.created_at, phase='queue')
+        token = compressor.cancel_token(job.id, job.cancel_token)
+        self.update(job, started_at=time.time())
+        workspace = None
+        phase = 'download'
+        try:
+            input_size = source.file_size or 0
+            segmented = compressor.segment_count(source.duration) > 1
+            estimate = estimate_job_space(input_size, quality, target_size, segmented)
+            if local:
+                # La entrada ya está en disco: sólo se reserva la salida
+                estimate -= input_size
+            workspace = await spool.acquire(job.id, estimate, cancelled=lambda: token.cancelled)
+
+            if local:
+                input_path = source.path
+            else:
+                # Siempre a disco: la descarga por rangos se retoma si falla
+                extension = os.path.splitext(source.file_name)[1].lower() or ".mp4"
+                input_path = workspace.path(f"input{extension}")
+                self.update(job, 'downloading')
+
+                async def download_progress(current, total):
+                    token.check()
+                    self.update(job, progress=current / total if total else 0, downloaded=current)
+
+                async with queue_manager.stage('download', token):
+                    started = time.monotonic()
+                    await source.download(input_path, download_progress)
+                    elapsed = time.monotonic() - started
+                metrics.phase_duration.observe(elapsed, phase='download')
+                cost_model.observe_transfer('download', os.path.getsize(input_path), elapsed)
+
+            phase = 'encode'
+            self.update(job, 'encoding', progress=0)
+            output_path = workspace.path("output.mp4")
+
+            async def compression_progress(progress, elapsed=0, current_size=0):
+                self.update(job, progress=progress, elapsed=elapsed, current_size=current_size)
+
+            async with queue_manager.encode_stage(token):
+                started = time.monotonic()
+                if ENCODE_BACKEND == 'broker':
+                    result = await broker.run(
+                        job.id, input_path, output_path, quality, job.target_size, compression_progress,
+                        cancelled=lambda: token.cancelled,
+                        backlog=queue_manager.pending_count()
+                    )
+                else:
+                    result = await compressor.compress_video(
+                        input_path,
+                        output_path,
+                        job.id,
+                        quality,
+                        compression_progress,
+                        borrow_slots=lambda count: queue_manager.borrow('encode', count),
+                        target_size=target_size
+                    )
+                elapsed = time.monotonic() - started
+            metrics.phase_duration.observe(elapsed, phase='encode')
+
+            if result is None:
+                if token.cancelled:
+                    metrics.errors.inc(cause='cancelled')
+                    self.finish(job, 'cancelled')
+                else:
+                    metrics.errors.inc(cause='encode')
+                    metrics.jobs.inc(outcome='failed')
+                    self.finish(job, 'failed', error="Falló la compresión")
+                return
+            if result.get('action') == 'encode':
+                cost_model.observe_encode(quality, await media_probe.probe(input_path), elapsed, result)
+            cost_model.observe_result(quality, result)
+
+            phase = 'deliver'
+            use_original = result.get('use_original')
+            output = await asyncio.to_thread(
+                self._deliver, job, input_path if use_original else output_path, local and use_original
+            )
+            metrics.jobs.inc(outcome='original' if use_original else 'compressed')
+            self.finish(job, 'done', progress=1, result=result, output=output)
+            print(f"✅ Trabajo de la API {job.id} listo: {output}")
+        except JobCancelled:
+            # Cancelado por DELETE
+            metrics.errors.inc(cause='cancelled')
+            self.finish(job, 'cancelled')
+        except Exception as e:
+            print(f"Error en trabajo de la API {job.id}: {e}")
+            metrics.errors.inc(cause='disk_full' if isinstance(e, SpoolFullError) else phase)
+            metrics.jobs.inc(outcome='failed')
+            self.finish(job, 'failed', error=str(e))
+        finally:
+            compressor.clear_cancel_flag(job.id)
+            if workspace:
+                await spool.release(workspace)
+
+    def _deliver(self, job, path, shared):
+        """
+        Deja el resultado en `output_path` o en API_OUTPUT_DIR y devuelve su ruta.
+        `shared`: es el archivo del propio cliente (entrada local que ya cumplía el
+        preset), que se copia o se informa tal cual, nunca se mueve.
+        """
+        destination = job.output_path
+        if destination is None:
+            if shared:
+                return path
+            os.makedirs(API_OUTPUT_DIR, exist_ok=True)
+            destination = os.path.join(os.path.realpath(API_OUTPUT_DIR), job.id + os.path.splitext(path)[1])
+        else:
+            # La ruta pudo convertirse en enlace mientras el trabajo esperaba en cola
+            destination = os.path.realpath(destination)
+            if not allowed_path(destination):
+                raise PermissionError("'output_path' fuera de API_PATHS")
+        if shared:
+            shutil.copyfile(path, destination)
+        else:
+            shutil.move(path, destination)
+        return destination
+
+job_api = JobApi()
+
+def add_api_routes(web_app, job_api):
+    """Endpoints /api/jobs. Sólo se publican si hay API_TOKEN."""
+    if not API_TOKEN:
+        return
+
+    @web.middleware
+    async def auth(request, handler):
+        if request.path.startswith('/api/'):
+            if request.headers.get('Authorization') != f'Bearer {API_TOKEN}':
+                return web.json_response({'error': 'no autorizado'}, status=401)
+        return await handler(request)
+
+    web_app.middlewares.append(auth)
+
+    def find(request):
+        job = job_api.jobs.get(request.match_info['job_id'])
+        if job is None:
+            raise web.HTTPNotFound(text=json.dumps({'error': 'trabajo desconocido'}), content_type='application/json')
+        return job
+
+    async def submit(request):
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.json_response({'error': 'se esperaba un cuerpo JSON'}, status=400)
+        try:
+            status = await job_api.submit(data)
+        except PermissionError as e:
+            return web.json_response({'error': str(e)}, status=403)
+        except ValueError as e:
+            return web.json_response({'error': str(e)}, status=400)
+        except Exception as e:
+            # El enlace no respondió o no se pudo leer
+            return web.json_response({'error': f"No se pudo acceder a la entrada: {e}"}, status=502)
+        return web.json_response(status, status=201, headers={'Location': f"/api/jobs/{status['id']}"})
+
+    async def list_jobs(request):
+        client = request.query.get('client')
+        jobs = sorted(job_api.jobs.values(), key=lambda job: job.created_at)
+        return web.json_response({'jobs': [
+            job_api.describe(job) for job in jobs
+            if client is None or job_api.status[job.id]['client'] == client
+        ]})
+
+    async def get_job(request):
+        return web.json_response(job_api.describe(find(request)))
+
+    async def delete_job(request):
+        job = find(request)
+        if await job_api.cancel(job):
+            return web.json_response(job_api.describe(job), status=202)
+        await job_api.forget(job)
+        return web.Response(status=204)
+
+    async def events(request):
+        """Estado del trabajo por Server-Sent Events hasta que termina."""
+        job = find(request)
+        response = web.StreamResponse(headers={
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        })
+        await response.prepare(request)
+        queue = job_api.subscribe(job)
+        try:
+            status = job_api.describe(job)
+            while True:
+                await response.write(f"event: status\ndata: {json.dumps(status)}\n\n".encode())
+                if status['state'] in FINAL_STATES:
+                    break
+                try:
+                    status = await asyncio.wait_for(queue.get(), timeout=SSE_REFRESH)
+                except asyncio.TimeoutError:
+                    status = job_api.describe(job)
+        finally:
+            job_api.unsubscribe(job, queue)
+        return response
+
+    async def output(request):
+        job = find(request)
+        path = job_api.status[job.id].get('output')
+        if job.state != 'done' or not path or not os.path.exists(path):
+            return web.json_response({'error': 'el resultado no está disponible'}, status=409)
+        return web.FileResponse(path)
+
+    web_app.router.add_post('/api/jobs', submit)
+    web_app.router.add_get('/api/jobs', list_jobs)
+    web_app.router.add_get('/api/jobs/{job_id}', get_job)
+    web_app.router.add_delete('/api/jobs/{job_id}', delete_job)
+    web_app.router.add_get('/api/jobs/{job_id}/events', events)
+    web_app.router.add_get('/api/jobs/{job_id}/output', output)
@@ -0,0 +1,304 @@
+"""
+Benchmark reproducible de QUALITY_PRESETS.
+
+Genera entradas sintéticas deterministas con fuentes lavfi de FFmpeg, pasa cada
+preset por VideoCompressor.compress_video (el mismo camino que usa el bot) y
+registra tiempo real, tiempo de CPU, RSS pico, tamaño de salida y SSIM/PSNR.
+El escalón de encoder_policy se fija con --rung (si no, dependería de la carga)
+y queda en los resultados junto con el CRF usado.
+
+    python benchmark.py run -o base.json
+    python benchmark.py run -o nuevo.json --cases 360p-medium --presets 240p,360p
+    python benchmark.py run -o lento.json --rung hevc-medium
+    python benchmark.py compare base.json nuevo.json
+
+`compare` termina con código 1 si encuentra regresiones, para usarlo en CI.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import re
+import resource
+import subprocess
+import sys
+import time
+
+BENCH_DIR = os.path.join("downloads", "benchmark")
+
+# Niveles de movimiento: barras fijas, patrón animado y patrón animado con ruido
+# temporal (el filtro noise usa una semilla fija, así que sigue siendo determinista)
+MOTION_SOURCES = {
+    'static': 'smptebars=size={size}:rate=30',
+    'medium': 'testsrc2=size={size}:rate=30',
+    'high': 'testsrc2=size={size}:rate=30,noise=alls=30:allf=t+u'
+}
+
+# (nombre, resolución, duración en segundos, movimiento)
+CASES = [
+    ('360p-static', '640x360', 10, 'static'),
+    ('360p-medium', '640x360', 10, 'medium'),
+    ('720p-medium', '1280x720', 10, 'medium'),
+    ('720p-high', '1280x720', 10, 'high'),
+    ('1080p-high', '1920x1080', 20, 'high')
+]
+
+# Umbrales de regresión para `compare`: relativos para costes, absolutos para calidad
+THRESHOLDS = {
+    'wall_time': 0.10,
+    'cpu_time': 0.10,
+    'peak_rss_kb': 0.15,
+    'output_size': 0.03
+}
+SSIM_DROP = 0.005
+PSNR_DROP = 0.5
+
+def ffmpeg_version():
+    try:
+        out = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True).stdout
+        return out.splitlines()[0] if out else 'desconocida'
+    except OSError:
+        return 'no instalado'
+
+def make_input(name, size, duration, motion):
+    """Genera (una sola vez) la entrada sintética del caso. Bit-exacta entre ejecuciones."""
+    os.makedirs(BENCH_DIR, exist_ok=True)
+    path = os.path.join(BENCH_DIR, f"input-{name}.mp4")
+    if os.path.exists(path):
+        return path
+    source = MOTION_SOURCES[motion].format(size=size)
+    cmd = [
+        'ffmpeg', '-y', '-loglevel', 'error',
+        '-f', 'lavfi', '-i', f"{source},format=yuv420p",
+        '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=48000',
+        '-t', str(duration),
+        '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '16', '-threads', '1',
+        '-c:a', 'aac', '-b:a', '128k',
+        '-fflags', '+bitexact', '-flags:v', '+bitexact', '-flags:a', '+bitexact',
+        '-map_metadata', '-1',
+        path
+    ]
+    print(f"🧪 Generando entrada {name} ({size}, {duration}s, movimiento {motion})")
+    subprocess.run(cmd, check=True)
+    return path
+
+def quality_score(reference, distorted):
+    """SSIM y PSNR de la salida escalada a la resolución de la referencia."""
+    probe = subprocess.run(
+        ['ffmpeg', '-i', reference, '-hide_banner'], capture_output=True, text=True
+    ).stderr
+    match = re.search(r'Video:.*?(\d{2,5})x(\d{2,5})', probe)
+    width, height = (match.group(1), match.group(2)) if match else ('640', '360')
+    graph = (
+        f"[0:v]scale={width}:{height}:flags=bicubic,split[d1][d2];"
+        f"[1:v]split[r1][r2];[d1][r1]ssim;[d2][r2]psnr"
+    )
+    result = subprocess.run(
+        ['ffmpeg', '-hide_banner', '-i', distorted, '-i', reference,
+         '-lavfi', graph, '-f', 'null', '-'],
+        capture_output=True, text=True
+    )
+    ssim = re.search(r'SSIM .*All:([\d.]+)', result.stderr)
+    psnr = re.search(r'PSNR .*average:([\d.]+|inf)', result.stderr)
+    return (
+        float(ssim.group(1)) if ssim else None,
+        float(psnr.group(1)) if psnr else None
+    )
+
+def run_worker(input_path, output_path, quality, rung):
+    """
+    Corre en un proceso aparte por caso, así getrusage mide sólo este encode:
+    CPU propia + la de los FFmpeg hijos, y el RSS pico del mayor de ellos.
+    """
+    from compressor import compressor
+    from encoder_policy import encoder_policy
+
+    encoder_policy.pinned = rung
+    started = time.monotonic()
+    result = asyncio.run(compressor.compress_video(input_path, output_path, 0, quality))
+    wall_time = time.monotonic() - started
+
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    encoder = (result or {}).get('encoder') or {}
+    print(json.dumps({
+        'ok': bool(result),
+        'action': (result or {}).get('action'),
+        'use_original': bool((result or {}).get('use_original')),
+        'rung': encoder.get('rung'),
+        'crf': encoder.get('crf'),
+        'wall_time': wall_time,
+        'cpu_time': own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime,
+        'peak_rss_kb': max(own.ru_maxrss, children.ru_maxrss)
+    }))
+
+def run_case(case, quality, rung):
+    name, size, duration, motion = case
+    input_path = make_input(name, size, duration, motion)
+    output_path = os.path.join(BENCH_DIR, f"output-{name}-{quality}.mp4")
+    if os.path.exists(output_path):
+        os.remove(output_path)
+
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '_worker', input_path, output_path, quality, rung],
+        capture_output=True, text=True
+    )
+    lines = proc.stdout.strip().splitlines()
+    try:
+        measured = json.loads(lines[-1])
+    except (IndexError, ValueError):
+        print(f"❌ {name} / {quality}: el worker falló\n{proc.stderr.strip()[-500:]}")
+        return None
+    if not measured['ok']:
+        print(f"❌ {name} / {quality}: compress_video devolvió None")
+        return None
+
+    # Passthrough o salida no menor que la entrada: se "entrega" la propia entrada y
+    # compararla consigo misma daría SSIM 1 / PSNR inf, que no mide ningún encode
+    result_path = output_path if os.path.exists(output_path) and not measured['use_original'] else input_path
+    ssim, psnr = (None, None) if result_path == input_path else quality_score(input_path, result_path)
+    measured.update({
+        'case': name,
+        'preset': quality,
+        'input_size': os.path.getsize(input_path),
+        'output_size': os.path.getsize(result_path),
+        'ssim': ssim,
+        'psnr': psnr
+    })
+    measured.pop('ok')
+    score = "original reenviado, sin SSIM/PSNR" if ssim is None and psnr is None else f"SSIM {ssim}, PSNR {psnr}"
+    print(
+        f"✅ {name} / {quality} ({measured['rung']}, CRF {measured['crf']}): {measured['wall_time']:.2f}s real, "
+        f"{measured['cpu_time']:.2f}s CPU, {measured['peak_rss_kb'] // 1024} MB RSS, "
+        f"{measured['output_size'] // 1024} KB, {score}"
+    )
+    return measured
+
+def run(args):
+    from compressor import QUALITY_PRESETS
+    from encoder_policy import ENCODER_LADDER, DEFAULT_RUNG
+    from config import FFMPEG_THREADS, CPU_COUNT
+
+    rungs = [rung['name'] for rung in ENCODER_LADDER]
+    args.rung = args.rung or DEFAULT_RUNG
+    if args.rung not in rungs:
+        sys.exit(f"--rung debe ser uno de: {', '.join(rungs)}")
+
+    presets = args.presets.split(',') if args.presets else list(QUALITY_PRESETS)
+    cases = [c for c in CASES if not args.cases or c[0] in args.cases.split(',')]
+    results = []
+    for case in cases:
+        for quality in presets:
+            for _ in range(args.repeat):
+                measured = run_case(case, quality, args.rung)
+                if measured:
+                    results.append(measured)
+
+    report = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': {
+            'ffmpeg': ffmpeg_version(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpu_count': CPU_COUNT,
+            'ffmpeg_threads': FFMPEG_THREADS,
+            'rung': args.rung
+        },
+        'results': results
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"📄 Resultados guardados en {args.output}")
+
+def _by_key(report):
+    """Agrupa por (caso, preset); con --repeat se queda con la mediana de cada métrica."""
+    grouped = {}
+    for entry in report['results']:
+        grouped.setdefault((entry['case'], entry['preset']), []).append(entry)
+    merged = {}
+    for key, entries in grouped.items():
+        row = dict(entries[0])
+        for field in ('wall_time', 'cpu_time', 'peak_rss_kb'):
+            values = sorted(e[field] for e in entries)
+            row[field] = values[len(values) // 2]
+        merged[key] = row
+    return merged
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = _by_key(json.load(f))
+    with open(args.candidate) as f:
+        candidate = _by_key(json.load(f))
+
+    regressions = []
+    mismatched = []
+    for key in sorted(baseline.keys() & candidate.keys()):
+        old, new = baseline[key], candidate[key]
+        label = f"{key[0]} / {key[1]}"
+        if old.get('rung') != new.get('rung'):
+            # Otro encoder: tiempos y tamaños no son comparables
+            print(f"⚠️ {label:<22} escalón distinto: {old.get('rung')} -> {new.get('rung')}")
+            mismatched.append(label)
+            continue
+        for field, threshold in THRESHOLDS.items():
+            if not old[field]:
+                continue
+            change = (new[field] - old[field]) / old[field]
+            marker = '⚠️' if change > threshold else '  '
+            print(f"{marker} {label:<22} {field:<12} {old[field]:>12.2f} -> {new[field]:>12.2f} ({change:+.1%})")
+            if change > threshold:
+                regressions.append((label, field, change))
+        for field, max_drop in (('ssim', SSIM_DROP), ('psnr', PSNR_DROP)):
+            if old.get(field) is None or new.get(field) is None:
+                continue
+            drop = old[field] - new[field]
+            marker = '⚠️' if drop > max_drop else '  '
+            print(f"{marker} {label:<22} {field:<12} {old[field]:>12.4f} -> {new[field]:>12.4f} ({-drop:+.4f})")
+            if drop > max_drop:
+                regressions.append((label, field, -drop))
+
+    missing = baseline.keys() - candidate.keys()
+    for key in sorted(missing):
+        print(f"⚠️ {key[0]} / {key[1]}: falta en {args.candidate}")
+
+    if regressions or missing or mismatched:
+        print(
+            f"\n❌ {len(regressions)} regresiones, {len(missing)} casos faltantes, "
+            f"{len(mismatched)} con otro escalón"
+        )
+        return 1
+    print("\n✅ Sin regresiones")
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de los presets de compresión")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = sub.add_parser('run', help="Ejecuta el benchmark y guarda los resultados en JSON")
+    run_parser.add_argument('-o', '--output', default='benchmark.json')
+    run_parser.add_argument('--presets', help="Lista separada por comas (por defecto todos)")
+    run_parser.add_argument('--cases', help="Lista de casos separada por comas (por defecto todos)")
+    run_parser.add_argument('--repeat', type=int, default=1, help="Repeticiones por caso (se usa la mediana)")
+    run_parser.add_argument('--rung', help="Escalón de encoder_policy fijo (por defecto DEFAULT_RUNG)")
+
+    compare_parser = sub.add_parser('compare', help="Compara dos ejecuciones y marca regresiones")
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+
+    worker_parser = sub.add_parser('_worker')
+    worker_parser.add_argument('input_path')
+    worker_parser.add_argument('output_path')
+    worker_parser.add_argument('quality')
+    worker_parser.add_argument('rung')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    elif args.command == 'compare':
+        sys.exit(compare(args))
+    else:
+        run_worker(args.input_path, args.output_path, args.quality, args.rung)
+
+if __name__ == "__main__":
+    main()
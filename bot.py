@@ -1,17 +1,38 @@
 import os
 import asyncio
+import time
 import re
 import urllib.request
 import urllib.error
 from pyrogram.client import Client
-from pyrogram import filters
-from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+from pyrogram import filters, StopTransmission
+from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, InputMediaVideo
 from aiohttp import web
-from config import BOT_TOKEN, API_ID, API_HASH, DOWNLOAD_DIR
-from compressor import compressor, QUALITY_PRESETS
-from queue_manager import queue_manager
-from utils import format_bytes, cleanup_file, generate_filename, create_progress_bar, sanitize_filename, wait_for_file
-import glob
+from config import (
+    BOT_TOKEN, API_ID, API_HASH, DOWNLOAD_DIR, STREAMING_DOWNLOAD, TARGET_SIZE_OPTIONS, MAX_TARGET_SIZE_MB,
+    MAX_FILE_SIZE, ENCODE_BACKEND, STREAMING_UPLOAD, PARALLEL_DOWNLOAD, PARALLEL_DOWNLOAD_MIN, PARALLEL_UPLOAD,
+    PREVIEW_LENGTH, PREVIEW_TIMEOUT, ADMIN_IDS, STATS_WINDOW
+)
+from compressor import compressor, QUALITY_PRESETS, PREVIEW_QUALITIES
+from queue_manager import queue_manager, Job
+from result_cache import result_cache
+from streaming import open_media_stream
+from media_probe import media_probe
+from spool import spool, estimate_job_space, SpoolFullError
+from status_updater import status_updater
+from metrics import metrics
+from tracing import tracer
+from cancellation import JobCancelled
+from job_store import job_store, FINAL_STATES
+from broker import broker, add_worker_routes
+from stream_upload import GrowingFileUpload, ParallelUpload, send_uploaded_video, BIG_FILE_MIN
+from parallel_download import ParallelDownloader, TelegramFetcher
+from cost_model import cost_model
+from encoder_policy import encoder_policy
+from url_source import UrlSource
+from api import job_api, add_api_routes
+from utils import format_bytes, format_duration, cleanup_file, generate_filename, create_progress_bar, sanitize_filename
+from file_watch import file_watcher
 import subprocess
 
 app = Client(
@@ -24,6 +45,13 @@ app = Client(
     workdir=DOWNLOAD_DIR
 )
 
+# Trabajos fuera de la cola mientras se genera su vista previa: (user_id, message_id) -> (job, elección, tarea)
+preview_jobs = {}
+
+async def save_user_settings(user_id):
+    await job_store.save_settings(
+        user_id, compressor.get_user_quality(user_id), compressor.get_user_target_size(user_id)
+    )
 
 @app.on_message(filters.command("on"))
 async def start_command(client, message: Message):
@@ -67,7 +95,17 @@ async def help_command(client, message: Message):
         "• 360p - Alta compresión (~60-80% reducción) ⭐\n"
         "• 480p - Compresión media (~40-60% reducción)\n"
         "• 720p - Buena calidad (~20-40% reducción)\n"
-        "• Original - Solo cambia codec"
+        "• Original - Solo cambia codec\n\n"
+        "👀 **Vista previa:** el botón bajo cada video envía unos segundos en cada calidad "
+        "con el tamaño estimado, para elegir antes de comprimirlo entero\n\n"
+        "**Tamaño objetivo:**\n"
+        "/size 50 - Ajusta el video para que pese ~50 MB\n"
+        "/size off - Vuelve a usar la calidad\n\n"
+        "**Desde un enlace:**\n"
+        "/url https://... - Comprime un video de un enlace directo\n\n"
+        "**Cancelar:**\n"
+        "/cancel - Detiene todo lo tuyo (en curso y en cola)\n"
+        "/cancel respondiendo a un video - Sólo ese video"
     )
     keyboard = InlineKeyboardMarkup([
         [InlineKeyboardButton("⚙️ Cambiar Calidad", callback_data="show_quality")]
@@ -105,41 +143,104 @@ async def quality_command(client, message: Message):
         reply_markup=keyboard
     )
 
+@app.on_message(filters.command("size"))
+async def size_command(client, message: Message):
+    user_id = message.from_user.id
+    args = message.command[1:]
+    
+    if not args:
+        current = compressor.get_user_target_size(user_id)
+        current_str = f"{current} MB" if current else "desactivado"
+        await message.reply_text(
+            f"🎯 **Tamaño objetivo**\n\n"
+            f"Actual: **{current_str}**\n\n"
+            f"Uso: `/size <MB>` (ej. `/size 50`)\n"
+            f"`/size off` para volver a comprimir por calidad."
+        )
+        return
+    
+    if args[0].lower() in ('off', '0', 'no'):
+        compressor.set_user_target_size(user_id, None)
+        await save_user_settings(user_id)
+        await message.reply_text("✅ Tamaño objetivo desactivado. Se usará la calidad elegida.")
+        return
+    
+    try:
+        size_mb = int(float(args[0].lower().replace('mb', '').replace(',', '.')))
+    except ValueError:
+        size_mb = 0
+    
+    if not 1 <= size_mb <= MAX_TARGET_SIZE_MB:
+        await message.reply_text(f"⚠️ Indica un tamaño entre 1 y {MAX_TARGET_SIZE_MB} MB. Ej: `/size 50`")
+        return
+    
+    compressor.set_user_target_size(user_id, size_mb)
+    await save_user_settings(user_id)
+    await message.reply_text(
+        f"✅ **Tamaño objetivo: {size_mb} MB**\n\n"
+        f"Tus próximos videos se ajustarán para pesar como máximo ~{size_mb} MB."
+    )
+
+async def drop_queued(jobs):
+    """
+    Marca como cancelados trabajos ya sacados de la cola y libera su workspace
+    (vista previa o retenido de un trabajo recuperado tras un reinicio).
+    """
+    await job_store.cancel_queued(jobs)
+    for job in jobs:
+        await spool.forget(job.id)
+
+async def cancel_job(user_id, message_id):
+    """Cancela sólo el trabajo del mensaje `message_id`: en vista previa, en cola o en curso."""
+    held = preview_jobs.get((user_id, message_id))
+    if held:
+        held[2].cancel()
+        return True
+    job = queue_manager.find_job(user_id, message_id)
+    if job and queue_manager.remove(job):
+        await drop_queued([job])
+        return True
+    job = queue_manager.find_active(user_id, message_id)
+    if job:
+        job.cancel_token.cancel()
+        return True
+    return False
+
 @app.on_message(filters.command("cancel"))
 async def cancel_command(client, message: Message):
     user_id = message.from_user.id
     
-    if queue_manager.is_processing(user_id):
-        compressor.set_cancel_flag(user_id, True)
-        queue_manager.clear_queue(user_id)
+    if message.reply_to_message:
+        # /cancel respondiendo a un video: sólo ese trabajo
+        if await cancel_job(user_id, message.reply_to_message.id):
+            await message.reply_text("❌ **Video cancelado**\n\nEl resto de tu cola sigue igual.")
+        else:
+            await message.reply_text("ℹ️ Ese video no está en cola ni en proceso.")
+        return
+    
+    previews = [held for key, held in list(preview_jobs.items()) if key[0] == user_id]
+    for _, _, task in previews:
+        task.cancel()
+    
+    active = [job for job in queue_manager.active_jobs.values() if job.user_id == user_id]
+    for job in active:
+        # Descargas y subidas se cortan en su próximo bloque, FFmpeg muere en el acto
+        job.cancel_token.cancel()
+    queued = queue_manager.clear_queue(user_id)
+    await drop_queued(queued)
+    
+    if active:
         await message.reply_text("❌ **Operación cancelada**\n\nSe ha detenido la compresión actual.")
+    elif queued or previews:
+        await message.reply_text("❌ **Cola limpiada**\n\nSe han eliminado todos los videos pendientes.")
     else:
-        queue_position = queue_manager.get_queue_position(user_id)
-        if queue_position > 0:
-            queue_manager.clear_queue(user_id)
-            await message.reply_text("❌ **Cola limpiada**\n\nSe han eliminado todos los videos pendientes.")
-        else:
-            await message.reply_text("ℹ️ No hay ninguna operación en curso para cancelar.")
+        await message.reply_text("ℹ️ No hay ninguna operación en curso para cancelar.")
 
 @app.on_message(filters.command("cache"))
 async def cache_command(client, message: Message):
     try:
-        import glob
-        import os
-        
-        # Limpiar descargas
-        download_files = glob.glob(os.path.join(DOWNLOAD_DIR, "*"))
-        deleted_count = 0
-        total_size = 0
-        
-        for file in download_files:
-            try:
-                size = os.path.getsize(file)
-                total_size += size
-                os.remove(file)
-                deleted_count += 1
-            except Exception as e:
-                print(f"Error deleting {file}: {e}")
+        # Sólo restos huérfanos: los trabajos en curso y la sesión se conservan
+        deleted_count, total_size = await asyncio.to_thread(spool.purge)
         
         size_str = format_bytes(total_size)
         await message.reply_text(
@@ -153,31 +254,121 @@ async def cache_command(client, message: Message):
         await message.reply_text(f"❌ Error al limpiar caché: {str(e)}")
         print(f"Error en comando cache: {e}")
 
+# Fases de las trazas en el orden en que ocurren
+PHASE_NAMES = {
+    'queue': "Cola",
+    'disk_wait': "Espera de disco",
+    'download': "Descarga",
+    'file_wait': "Espera del archivo",
+    'probe': "Análisis",
+    'stream': "Descarga + compresión",
+    'crf_analysis': "Análisis CRF",
+    'encode': "Compresión",
+    'probe_output': "Análisis de la salida",
+    'upload': "Subida",
+    'upload_tail': "Fin de la subida",
+    'status_edit': "Ediciones de estado"
+}
+
+def format_seconds(seconds):
+    return f"{seconds:.1f} s" if seconds < 60 else format_duration(seconds)
+
+def build_stats_text():
+    """Tiempos por fase, throughput y reducción reales de los últimos STATS_WINDOW trabajos."""
+    summary = tracer.summary(last=STATS_WINDOW)
+    if not summary['jobs']:
+        return (
+            "📊 **Estadísticas del Bot**\n\n"
+            "Todavía no hay trabajos terminados desde el último arranque.\n"
+            "Envía un video para comenzar."
+        )
+    
+    lines = [f"📊 **Estadísticas de los últimos {summary['jobs']} trabajos**\n", "⏱️ **Tiempo por fase (p50 / p95):**"]
+    for name, label in PHASE_NAMES.items():
+        phase = summary['phases'].get(name)
+        if phase:
+            lines.append(f"• {label}: {format_seconds(phase['p50'])} / {format_seconds(phase['p95'])}")
+    
+    rates = [
+        ("Descarga", summary['download_mbps'], "MB/s"),
+        ("Subida", summary['upload_mbps'], "MB/s"),
+        ("Compresión", summary['encode_speed'], "x tiempo real")
+    ]
+    rates = [(label, rate, unit) for label, rate, unit in rates if rate]
+    if rates:
+        lines.append("\n🚀 **Velocidad (p50 / p95):**")
+        for label, rate, unit in rates:
+            lines.append(f"• {label}: {rate['p50']:.1f} / {rate['p95']:.1f} {unit}")
+    
+    if summary['reduction']:
+        lines.append("\n📉 **Reducción lograda (mediana):**")
+        for quality in QUALITY_PRESETS:
+            reduction = summary['reduction'].get(quality)
+            if reduction:
+                lines.append(f"• {QUALITY_PRESETS[quality]['name']}: {reduction['p50']:.0f}% ({reduction['count']} videos)")
+    
+    lines.append("\n💡 /quality para cambiar la calidad predeterminada")
+    return "\n".join(lines)
+
+def build_trace_text(trace):
+    phases = trace.phases()
+    duration = trace.duration if trace.duration is not None else time.time() - trace.started
+    attrs = trace.attrs
+    lines = [
+        f"🔎 **Traza {trace.job_id}**\n",
+        f"Estado: {trace.outcome or 'en curso'} | Total: {format_seconds(duration)}",
+        f"Calidad: {attrs.get('preset')}" + (f" | 🎯 {attrs['target_size']} MB" if attrs.get('target_size') else ""),
+        f"Entrada: {format_bytes(attrs.get('input_size') or 0)}"
+        + (f" | Salida: {format_bytes(attrs['output_size'])}" if 'output_size' in attrs else "")
+        + (f" | {format_seconds(attrs['media_duration'])} de video" if attrs.get('media_duration') else ""),
+        "\n⏱️ **Por fase (veces, total, máximo):**"
+    ]
+    for name, (count, total, longest) in sorted(phases.items(), key=lambda item: -item[1][1]):
+        lines.append(f"• {PHASE_NAMES.get(name, name)}: {count}x, {format_seconds(total)}, {format_seconds(longest)}")
+    
+    timeline = sorted((span for span in trace.spans if span['name'] != 'status_edit'), key=lambda span: span['start'])
+    if timeline:
+        lines.append("\n🧵 **Línea de tiempo:**")
+        for span in timeline[:30]:
+            extra = " ".join(f"{key}={value}" for key, value in span.items() if key not in ('name', 'start', 'duration'))
+            lines.append(f"`{span['start']:+8.1f}s` {PHASE_NAMES.get(span['name'], span['name'])} {format_seconds(span['duration'])} {extra}".rstrip())
+        if len(timeline) > 30:
+            lines.append(f"... y {len(timeline) - 30} spans más")
+    if trace.dropped:
+        lines.append(f"\n⚠️ {trace.dropped} spans descartados por el límite")
+    return "\n".join(lines)
+
 @app.on_message(filters.command("stats"))
 async def stats_command(client, message: Message):
-    stats_text = (
-        "📊 **Estadísticas del Bot**\n\n"
-        "🚀 **Optimizaciones Activas:**\n"
-        "✅ Codec HEVC (libx265) - Mejor compresión\n"
-        "✅ Preset ultrafast - Máxima velocidad\n"
-        "✅ Copia directa de audio - Sin recodificación\n"
-        "✅ Escalado rápido - Algoritmo optimizado\n"
-        "✅ Barra de progreso en tiempo real\n"
-        "✅ Cola inteligente por usuario\n\n"
-        "⚡ **Rendimiento Esperado:**\n"
-        "• 240p: ~70-90% reducción de tamaño\n"
-        "• 360p: ~60-80% reducción de tamaño ⭐\n"
-        "• 480p: ~50-70% reducción de tamaño\n"
-        "• 720p: ~30-50% reducción de tamaño\n\n"
-        "💡 **Tips:**\n"
-        "• Usa 240p para máxima compresión\n"
-        "• Usa 360p para balance (recomendado)\n"
-        "• /quality para cambiar predeterminado"
-    )
     keyboard = InlineKeyboardMarkup([
         [InlineKeyboardButton("⚙️ Cambiar Calidad", callback_data="show_quality")]
     ])
-    await message.reply_text(stats_text, reply_markup=keyboard)
+    await message.reply_text(build_stats_text(), reply_markup=keyboard)
+
+@app.on_message(filters.command("trace"))
+async def trace_command(client, message: Message):
+    """Sólo ADMIN_IDS: /trace lista los trabajos más lentos, /trace <id> vuelca la traza de uno."""
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    args = message.text.split()
+    if len(args) > 1:
+        trace = tracer.get(args[1])
+        if trace is None:
+            await message.reply_text("⚠️ No hay traza de ese trabajo (sólo se guardan los últimos).")
+            return
+        await message.reply_text(build_trace_text(trace)[:4000])
+        return
+    
+    slowest = tracer.slowest()
+    if not slowest:
+        await message.reply_text("📭 Todavía no hay trazas.")
+        return
+    lines = ["🐢 **Trabajos más lentos recientes:**\n"]
+    for trace in slowest:
+        lines.append(f"• `{trace.job_id}` {format_seconds(trace.duration)} {trace.attrs.get('preset')} ({trace.outcome})")
+    lines.append("\n/trace <id> para ver la traza completa")
+    await message.reply_text("\n".join(lines))
 
 @app.on_callback_query(filters.regex("^show_"))
 async def menu_callback(client, callback_query: CallbackQuery):
@@ -220,23 +411,10 @@ async def menu_callback(client, callback_query: CallbackQuery):
         )
     
     elif action == "stats":
-        stats_text = (
-            "📊 **Estadísticas y Optimizaciones**\n\n"
-            "🚀 **Activas:**\n"
-            "✅ HEVC (libx265)\n"
-            "✅ Ultrafast preset\n"
-            "✅ 10 descargas paralelas\n"
-            "✅ 1MB block size\n\n"
-            "📈 **Rendimiento:**\n"
-            "• 240p: 70-90% reducción\n"
-            "• 360p: 60-80% reducción ⭐\n"
-            "• 480p: 50-70% reducción\n"
-            "• 720p: 30-50% reducción"
-        )
         keyboard = InlineKeyboardMarkup([
             [InlineKeyboardButton("⚙️ Calidad", callback_data="show_quality")]
         ])
-        await callback_query.message.edit_text(stats_text, reply_markup=keyboard)
+        await callback_query.message.edit_text(build_stats_text(), reply_markup=keyboard)
     
     elif action == "cancel":
         await callback_query.answer("Usa /cancel para cancelar operaciones")
@@ -248,6 +426,7 @@ async def quality_callback(client, callback_query: CallbackQuery):
     quality = data_str.split("_")[1]
     
     compressor.set_user_quality(user_id, quality)
+    await save_user_settings(user_id)
     
     await callback_query.answer(f"✅ Calidad cambiada a {QUALITY_PRESETS[quality]['name']}")
     await callback_query.message.edit_text(
@@ -278,51 +457,158 @@ async def handle_video(client, message: Message):
         )
         return
     
-    quality = compressor.get_user_quality(user_id)
-    queue_position = queue_manager.get_queue_position(user_id)
+    await enqueue_video(message)
+
+@app.on_message(filters.command("url"))
+async def url_command(client, message: Message):
+    parts = (message.text or "").split(maxsplit=1)
+    url = parts[1].strip() if len(parts) > 1 else ""
+    if not re.match(r'^https?://', url):
+        await message.reply_text(
+            "🔗 **Comprimir desde un enlace**\n\n"
+            "Uso: `/url https://ejemplo.com/video.mp4`\n"
+            "El enlace debe apuntar directamente al archivo de video."
+        )
+        return
     
-    # Botones para elegir calidad
-    keyboard = InlineKeyboardMarkup([
+    try:
+        source = await UrlSource.probe(url)
+    except Exception as e:
+        await message.reply_text(f"❌ **No se pudo acceder al enlace**\n\n{e}")
+        return
+    
+    if not source.looks_like_video():
+        await message.reply_text(
+            "⚠️ **El enlace no parece ser un video**\n\n"
+            f"Tipo recibido: `{source.content_type or 'desconocido'}`"
+        )
+        return
+    if source.file_size > MAX_FILE_SIZE:
+        await message.reply_text(
+            f"⚠️ **Archivo demasiado grande** ({format_bytes(source.file_size)})\n\n"
+            f"El máximo es {format_bytes(MAX_FILE_SIZE)}."
+        )
+        return
+    
+    await enqueue_video(message, source)
+
+def quality_keyboard(message_id, preview=False):
+    """Botones para elegir calidad o tamaño objetivo del video `message_id`."""
+    rows = [
         [
-            InlineKeyboardButton("240p 🔥", callback_data=f"video_quality_240p_{message.id}"),
-            InlineKeyboardButton("360p ⭐", callback_data=f"video_quality_360p_{message.id}")
+            InlineKeyboardButton("240p 🔥", callback_data=f"video_quality_240p_{message_id}"),
+            InlineKeyboardButton("360p ⭐", callback_data=f"video_quality_360p_{message_id}")
         ],
         [
-            InlineKeyboardButton("480p 📺", callback_data=f"video_quality_480p_{message.id}"),
-            InlineKeyboardButton("720p 🎬", callback_data=f"video_quality_720p_{message.id}")
+            InlineKeyboardButton("480p 📺", callback_data=f"video_quality_480p_{message_id}"),
+            InlineKeyboardButton("720p 🎬", callback_data=f"video_quality_720p_{message_id}")
         ],
-        [InlineKeyboardButton("Original 📹", callback_data=f"video_quality_original_{message.id}")]
-    ])
+        [InlineKeyboardButton("Original 📹", callback_data=f"video_quality_original_{message_id}")],
+        [
+            InlineKeyboardButton(f"🎯 {size_mb} MB", callback_data=f"video_size_{size_mb}_{message_id}")
+            for size_mb in TARGET_SIZE_OPTIONS
+        ]
+    ]
+    if preview:
+        rows.append([
+            InlineKeyboardButton("👀 Vista previa", callback_data=f"video_preview_{message_id}"),
+            InlineKeyboardButton("❌ Quitar de la cola", callback_data=f"video_cancel_{message_id}")
+        ])
+    return InlineKeyboardMarkup(rows)
+
+async def enqueue_video(message: Message, source=None):
+    """Responde con las opciones de calidad y el tiempo estimado, y encola el trabajo."""
+    user_id = message.from_user.id
+    quality = compressor.get_user_quality(user_id)
+    target_size = compressor.get_user_target_size(user_id)
+    # Usar calidad por defecto si no se elige una
+    job = Job(user_id, message, quality, target_size, source=source)
+    video = job.media
+    size_str = format_bytes(video.file_size) if video.file_size else "desconocido"
+    eta = cost_model.eta(job)
+    eta_str = f"⏱️ Listo en ~**{format_duration(eta['wait'] + eta['duration'])}**"
+    if eta['wait'] >= 60:
+        eta_str += f" (~{format_duration(eta['wait'])} de espera)"
     
-    if queue_position > 0:
+    default_str = f"🎯 {target_size} MB" if target_size else QUALITY_PRESETS[quality]['name']
+    keyboard = quality_keyboard(message.id, preview=True)
+    
+    if eta['position'] > 0:
         await message.reply_text(
-            f"📥 **Video recibido (Posición {queue_position + 1} en cola)**\n\n"
-            f"Tamaño: **{format_bytes(video.file_size)}**\n"
-            f"Calidad predeterminada: **{QUALITY_PRESETS[quality]['name']}**\n\n"
-            f"O elige otra calidad:",
+            f"📥 **Video recibido (Posición {eta['position'] + 1} en cola)**\n\n"
+            f"Tamaño: **{size_str}**\n"
+            f"Predeterminado: **{default_str}**\n"
+            f"{eta_str}\n\n"
+            f"O elige otra calidad o un tamaño objetivo (👀 para comparar antes):",
             reply_markup=keyboard
         )
     else:
         await message.reply_text(
             f"🎥 **Video recibido**\n\n"
-            f"Tamaño: **{format_bytes(video.file_size)}**\n"
-            f"Calidad predeterminada: **{QUALITY_PRESETS[quality]['name']}**\n\n"
-            f"O elige otra calidad:",
+            f"Tamaño: **{size_str}**\n"
+            f"Predeterminado: **{default_str}**\n"
+            f"{eta_str}\n\n"
+            f"O elige otra calidad o un tamaño objetivo (👀 para comparar antes):",
             reply_markup=keyboard
         )
     
-    # Usar calidad por defecto si no se elige una
-    await queue_manager.add_to_queue(user_id, (message, quality))
+    await job_store.save(job)
+    await queue_manager.add_to_queue(user_id, job)
+
+def find_pending_job(user_id, message_id):
+    """Trabajo aún sin empezar (en cola o en vista previa) y, si está en vista previa, su evento de elección."""
+    held = preview_jobs.get((user_id, message_id))
+    if held:
+        return held[0], held[1]
+    return queue_manager.find_job(user_id, message_id), None
+
+@app.on_callback_query(filters.regex("^video_preview_"))
+async def video_preview_callback(client, callback_query: CallbackQuery):
+    user_id = callback_query.from_user.id
+    message_id = int(str(callback_query.data).split("_")[2])
     
-    if not queue_manager.is_processing(user_id):
-        queue_manager.mark_processing(user_id, True)
-        asyncio.create_task(process_queue(client, user_id))
+    # Fuera de la cola mientras se genera la vista previa: el scheduler no lo despacha
+    job = queue_manager.find_job(user_id, message_id)
+    if job is None or not queue_manager.remove(job):
+        await callback_query.answer("⚠️ Este video ya se está procesando")
+        return
+    
+    chosen = asyncio.Event()
+    preview_jobs[(user_id, message_id)] = (job, chosen, asyncio.create_task(run_preview(client, job, chosen)))
+    await callback_query.answer("👀 Generando vista previa...")
+    
+    try:
+        await callback_query.message.delete()
+    except:
+        pass
+
+@app.on_callback_query(filters.regex("^video_cancel_"))
+async def video_cancel_callback(client, callback_query: CallbackQuery):
+    message_id = int(str(callback_query.data).split("_")[2])
+    if not await cancel_job(callback_query.from_user.id, message_id):
+        await callback_query.answer("⚠️ Este video ya no está en la cola")
+        return
+    await callback_query.answer("❌ Video quitado de la cola")
+    try:
+        await callback_query.message.edit_text("❌ **Video quitado de la cola.**")
+    except:
+        pass
 
 @app.on_callback_query(filters.regex("^video_quality_"))
 async def video_quality_callback(client, callback_query: CallbackQuery):
     data_parts: list[str] = str(callback_query.data).split("_")
     quality: str = data_parts[2]
     
+    job, chosen = find_pending_job(callback_query.from_user.id, int(data_parts[3]))
+    if job is None:
+        await callback_query.answer("⚠️ Este video ya se está procesando")
+        return
+    
+    job.quality = quality
+    job.target_size = None
+    await job_store.save(job)
+    if chosen:
+        chosen.set()
     await callback_query.answer(f"✅ Procesando con {QUALITY_PRESETS[quality]['name']}")
     
     try:
@@ -330,22 +616,386 @@ async def video_quality_callback(client, callback_query: CallbackQuery):
     except:
         pass
 
-async def process_queue(client, user_id):
+@app.on_callback_query(filters.regex("^video_size_"))
+async def video_size_callback(client, callback_query: CallbackQuery):
+    data_parts: list[str] = str(callback_query.data).split("_")
+    size_mb = int(data_parts[2])
+    
+    job, chosen = find_pending_job(callback_query.from_user.id, int(data_parts[3]))
+    if job is None:
+        await callback_query.answer("⚠️ Este video ya se está procesando")
+        return
+    
+    job.target_size = size_mb
+    await job_store.save(job)
+    if chosen:
+        chosen.set()
+    await callback_query.answer(f"🎯 Se ajustará a ~{size_mb} MB")
+    
     try:
-        while True:
-            task_data = await queue_manager.get_next_task(user_id)
-            
-            if task_data is None:
-                break
-            
-            message, quality = task_data
-            await process_video(client, message, quality)
+        await callback_query.message.delete()
+    except:
+        pass
+
+def preview_caption(quality, preview, original_size):
+    reduction = (1 - preview['projected_size'] / original_size) * 100 if original_size else 0
+    return f"{QUALITY_PRESETS[quality]['name']}: ~{format_bytes(preview['projected_size'])} (-{reduction:.0f}%)"
+
+async def run_preview(client, job: Job, chosen):
+    """
+    Descarga el video, codifica un clip corto en cada calidad y los envía con el tamaño
+    proyectado del video completo. El trabajo vuelve a la cola cuando el usuario elige
+    o, pasado PREVIEW_TIMEOUT, con la calidad que ya tenía. La descarga queda en el
+    workspace y el encode completo la reutiliza.
+    """
+    message = job.message
+    video = job.media
+    status_msg_ref = [await message.reply_text(
+        "👀 **Preparando vista previa...**\n\n"
+        "Se descarga el video y se codifica una muestra corta en cada calidad."
+    )]
+    workspace = None
+    # Los FFmpeg de las muestras vigilan el token del trabajo, no uno propio
+    compressor.cancel_token(job.id, job.cancel_token)
+    try:
+        input_size = video.file_size or 0
+        segmented = compressor.segment_count(getattr(video, 'duration', 0) or 0) > 1
+        workspace = await spool.acquire(job.id, estimate_job_space(input_size, job.quality, None, segmented))
+        extension = os.path.splitext(sanitize_filename(video.file_name))[1].lower() or ".mp4"
+        input_path = await download_input(client, job, workspace.path(f"input{extension}"), status_msg_ref)
+        
+        status_updater.update(
+            status_msg_ref[0],
+            f"👀 **Codificando muestras...**\n\n"
+            f"{PREVIEW_LENGTH} segundos del medio del video en {len(PREVIEW_QUALITIES)} calidades."
+        )
+        async with queue_manager.stage('encode'), queue_manager.borrow('encode', len(PREVIEW_QUALITIES) - 1) as extra:
+            previews = await compressor.preview(input_path, workspace.path("preview"), job.id, workers=1 + extra)
+        if not previews:
+            raise RuntimeError("no se pudo codificar ninguna muestra")
+        
+        original_size = os.path.getsize(input_path)
+        clips = [
+            InputMediaVideo(preview['path'], caption=preview_caption(quality, preview, original_size), supports_streaming=True)
+            for quality, preview in previews.items() if preview['path']
+        ]
+        if len(clips) > 1:
+            await message.reply_media_group(clips)
+        elif clips:
+            await message.reply_video(clips[0].media, caption=clips[0].caption)
+        await status_updater.delete(status_msg_ref[0])
+        
+        lines = []
+        for quality, preview in previews.items():
+            note = " (se envía el original)" if preview['action'] == 'passthrough' else ""
+            lines.append(f"• {preview_caption(quality, preview, original_size)}{note}")
+        default_str = f"🎯 {job.target_size} MB" if job.target_size else QUALITY_PRESETS[job.quality]['name']
+        choice_msg = await message.reply_text(
+            f"👀 **Vista previa lista**\n\n"
+            f"Tamaño estimado del video completo:\n" + "\n".join(lines) + "\n\n"
+            f"⏳ Si no eliges en {format_duration(PREVIEW_TIMEOUT)} se usa **{default_str}**.",
+            reply_markup=quality_keyboard(message.id)
+        )
+        try:
+            await asyncio.wait_for(chosen.wait(), timeout=PREVIEW_TIMEOUT)
+        except asyncio.TimeoutError:
+            try:
+                await choice_msg.edit_text(f"⏳ Sin elección: se comprime con **{default_str}**.")
+            except Exception:
+                pass
+    except asyncio.CancelledError:
+        # /cancel durante la vista previa
+        preview_jobs.pop((job.user_id, message.id), None)
+        compressor.clear_cancel_flag(job.id)
+        status_updater.update(status_msg_ref[0], "❌ **Vista previa cancelada.**")
+        await job_store.set_state(job, 'cancelled')
+        if workspace:
+            await spool.release(workspace)
+        raise
+    except Exception as e:
+        print(f"Error en la vista previa: {e}")
+        status_updater.update(
+            status_msg_ref[0],
+            "⚠️ **No se pudo generar la vista previa**\n\n"
+            "El video se comprimirá con la calidad elegida."
+        )
+    
+    preview_jobs.pop((job.user_id, message.id), None)
+    compressor.clear_cancel_flag(job.id)
+    await job_store.save(job)
+    await queue_manager.add_to_queue(job.user_id, job)
+
+async def run_job(job: Job):
+    if job.message is None:
+        # Trabajo de la API HTTP: no hay chat al que responder
+        await job_api.run(job)
+    else:
+        await process_video(app, job)
+
+def build_caption(result, cached=False):
+    caption = (
+        f"✅ **Video comprimido exitosamente**\n\n"
+        f"📊 **Estadísticas:**\n"
+        f"• Calidad: {result['quality']}\n"
+        f"• Tamaño original: {result['original_size_str']}\n"
+        f"• Tamaño comprimido: {result['compressed_size_str']}\n"
+        f"• Reducción: {result['reduction']:.1f}%\n"
+    )
+    if result.get('target_size'):
+        caption += f"• Objetivo: {result['target_size_str']} ({result['target_deviation']:+.1f}%)\n"
+    caption += "\n"
+    if result.get('use_original'):
+        caption += "ℹ️ El video ya cumplía la calidad elegida: se envía el original\n"
+    if cached:
+        caption += "⚡ Entregado al instante (ya comprimido antes)\n"
+    return caption + "🎥 Comprimido por @Compresor_minimisador_bot"
+
+async def send_cached_result(message: Message, cached):
+    try:
+        await message.reply_video(
+            video=cached['file_id'],
+            caption=build_caption(cached['stats'], cached=True)
+        )
+        return True
+    except Exception as e:
+        print(f"Error enviando resultado cacheado: {e}")
+        return False
+
+async def upload_result(client, message: Message, output_path, result, status_msg_ref, token=None):
+    status_updater.update(
+        status_msg_ref[0],
+        "📤 **Subiendo video comprimido...**\n\n"
+        "Esto puede tomar unos momentos."
+    )
+    
+    async def upload_progress(current, total):
+        if token and token.cancelled:
+            client.stop_transmission()
+        # El dispatcher agrupa: sólo llega a Telegram el último estado
+        bar = await create_progress_bar(current, total, "📤", "")
+        status_updater.update(
+            status_msg_ref[0],
+            f"📤 **Subiendo video comprimido...**\n\n"
+            f"{bar}\n"
+            f"{format_bytes(current)} / {format_bytes(total)}"
+        )
+    
+    video_duration = result.get('duration')
+    video_kwargs = {
+        'video': output_path,
+        'caption': build_caption(result),
+        'progress': upload_progress,
+        'supports_streaming': True,
+        'thumb': None
+    }
+    if video_duration and video_duration > 0:
+        video_kwargs['duration'] = int(video_duration)
+    
+    print(f"Enviando video comprimido: {output_path}")
+    async with queue_manager.stage('upload', token):
+        started = time.monotonic()
+        sent = None
+        if PARALLEL_UPLOAD and os.path.getsize(output_path) > BIG_FILE_MIN:
+            # Partes repartidas entre varias conexiones; ante un fallo, la subida normal
+            try:
+                input_file = await ParallelUpload(client, output_path).run(upload_progress)
+                sent = await send_uploaded_video(
+                    client, message, input_file, video_kwargs['caption'], result, os.path.basename(output_path)
+                )
+            except StopTransmission:
+                pass
+            except Exception as e:
+                print(f"Error en la subida en paralelo, se usa la normal: {e}")
+        if sent is None and not (token and token.cancelled):
+            # Con stop_transmission Pyrogram devuelve None
+            sent = await message.reply_video(**video_kwargs)
+        elapsed = time.monotonic() - started
+    if token:
+        token.check()
+    metrics.phase_duration.observe(elapsed, phase='upload')
+    tracer.record('upload', elapsed)
+    metrics.upload_throughput.observe(os.path.getsize(output_path) / (1024 * 1024) / max(elapsed, 0.001))
+    cost_model.observe_transfer('upload', os.path.getsize(output_path), elapsed)
+    return sent
+
+async def send_streamed_result(message: Message, upload, result, status_msg_ref):
+    """Cierra la subida hecha durante el encode; None si hay que subir el archivo como siempre."""
+    status_updater.update(
+        status_msg_ref[0],
+        "📤 **Terminando la subida...**\n\n"
+        f"{format_bytes(upload.sent_bytes)} ya subidos durante la compresión."
+    )
+    # La subida en curso ya tiene su propio slot: se espera fuera de la etapa para no bloquearla
+    if await upload.result() is None:
+        return None
+    async with queue_manager.stage('upload'):
+        try:
+            sent = await upload.send(message, build_caption(result), result)
+        except Exception as e:
+            print(f"Error enviando la subida en streaming: {e}")
+            return None
+    if sent:
+        # Sólo cuenta lo que quedó por subir después del encode
+        metrics.phase_duration.observe(time.monotonic() - upload.finished_at, phase='upload_tail')
+        tracer.record('upload_tail', time.monotonic() - upload.finished_at)
+    return sent
+
+async def send_original(message: Message, caption):
+    if message.video:
+        return await message.reply_video(video=message.video.file_id, caption=caption)
+    return await message.reply_document(document=message.document.file_id, caption=caption)
+
+async def process_video(client, job: Job):
+    video = job.media
+    with tracer.trace(
+        job.id,
+        preset=job.quality,
+        target_size=job.target_size,
+        input_size=video.file_size or 0,
+        media_duration=getattr(video, 'duration', 0) or 0
+    ) as trace:
+        try:
+            await traced_process_video(client, job)
+        finally:
+            trace.outcome = job.state
+
+async def traced_process_video(client, job: Job):
+    message = job.message
+    quality = job.quality
+    video = job.media
+    target_size = job.target_size * 1024 * 1024 if job.target_size else None
+    metrics.phase_duration.observe(time.time() - job.created_at, phase='queue')
+    tracer.record('queue', time.time() - job.created_at)
+    
+    # Mismo archivo + mismo preset + mismos parámetros = mismo resultado
+    cache_key = result_cache.make_key(
+        video.file_unique_id, quality, compressor.params_hash(quality, target_size)
+    )
+    duration = getattr(video, 'duration', 0) or 0
+    
+    def current_encoder(entry):
+        # Un resultado codificado con un escalón rápido (con cola) no se sirve si ahora se usaría uno mejor
+        return encoder_policy.serves(entry['stats'].get('encoder'), duration, quality, target_size)
+    
+    while True:
+        try:
+            # Un trabajo idéntico en curso puede tardar: /cancel no espera a que termine
+            cached = await job.cancel_token.wait_for(result_cache.acquire(cache_key, accept=current_encoder))
+        except JobCancelled:
+            metrics.errors.inc(cause='cancelled')
+            await job_store.set_state(job, 'cancelled')
+            return
+        if not cached:
+            # acquire() nos dejó a cargo: sólo así se puede llamar a complete() al final
+            break
+        if await send_cached_result(message, cached):
+            print(f"⚡ Resultado servido desde caché: {video.file_unique_id} ({quality})")
+            metrics.jobs.inc(outcome='cached')
+            tracer.annotate(cached=True)
+            await job_store.set_state(job, 'done')
+            return
+        # El file_id ya no sirve: se borra y se vuelve a pedir la clave (u otro trabajo idéntico la produce)
+        await result_cache.invalidate(cache_key)
+    
+    file_id, stats = None, None
+    try:
+        with metrics.phase_duration.time(phase='total'):
+            outcome = await compress_and_send(client, job, target_size)
+        if outcome:
+            file_id, stats = outcome
+            if stats.get('original_size'):
+                metrics.size_ratio.observe(stats['compressed_size'] / stats['original_size'], preset=quality)
+            cost_model.observe_result(quality, stats)
+            tracer.annotate(
+                output_size=stats['compressed_size'],
+                use_original=bool(stats.get('use_original')),
+                media_duration=stats.get('duration') or getattr(video, 'duration', 0) or 0
+            )
+            metrics.jobs.inc(outcome='original' if stats.get('use_original') else 'compressed')
+            await job_store.set_state(job, 'done')
+        else:
+            metrics.jobs.inc(outcome='failed')
+            if job.state not in FINAL_STATES:
+                await job_store.set_state(job, 'failed')
     finally:
-        queue_manager.mark_processing(user_id, False)
+        # Libera a los trabajos idénticos en espera (sin resultado si éste falló)
+        await result_cache.complete(cache_key, file_id, stats)
 
-async def process_video(client, message: Message, quality='360p'):
-    user_id = message.from_user.id
-    video = message.video or message.document
+async def download_input(client, job: Job, input_path, status_msg_ref):
+    """
+    Descarga el video a `input_path` con barra de progreso y devuelve su ruta; lanza
+    FileNotFoundError si falla y JobCancelled si se cancela el trabajo.
+    """
+    token = job.cancel_token
+    
+    async def download_progress(current, total):
+        if token.cancelled:
+            # Corta la descarga en el próximo bloque (Pyrogram borra su .temp)
+            client.stop_transmission()
+        bar = await create_progress_bar(current, total, "📥", "")
+        status_updater.update(
+            status_msg_ref[0],
+            f"📥 **Descargando video...**\n\n"
+            f"{bar}\n"
+            f"{format_bytes(current)} / {format_bytes(total)}"
+        )
+    
+    media = job.media
+    mode = 'disk'
+    async with queue_manager.stage('download', token):
+        token.check()
+        started = time.monotonic()
+        try:
+            if job.source:
+                # Enlace directo (/url): rangos HTTP en paralelo si el servidor los admite
+                await job.source.download(input_path, download_progress)
+                mode = 'http'
+            elif PARALLEL_DOWNLOAD and (media.file_size or 0) >= PARALLEL_DOWNLOAD_MIN:
+                # Archivos grandes: varios rangos a la vez en lugar de una sola conexión
+                try:
+                    await ParallelDownloader(TelegramFetcher(client, media.file_id)).download(
+                        input_path, media.file_size, download_progress
+                    )
+                    mode = 'parallel'
+                except StopTransmission:
+                    raise
+                except Exception as e:
+                    print(f"Error en la descarga en paralelo, se usa la normal: {e}")
+                    # La descarga normal empieza de cero; no debe quedar nada que parezca retomable
+                    await asyncio.to_thread(ParallelDownloader.discard, input_path)
+            if mode == 'disk':
+                # Pyrogram escribe en un .temp y devuelve la ruta final tras renombrarlo (None si falla)
+                input_path = await job.message.download(file_name=input_path, progress=download_progress)
+        except StopTransmission:
+            input_path = None
+        elapsed = time.monotonic() - started
+    
+    token.check()
+    if not input_path:
+        raise FileNotFoundError("Error al descargar el video. Intenta nuevamente.")
+    if not os.path.exists(input_path):
+        # Con DOWNLOAD_DIR en un volumen compartido el rename puede verse con retraso
+        with tracer.span('file_wait'):
+            input_path = await file_watcher.wait(input_path, timeout=10)
+        if not input_path:
+            raise FileNotFoundError("Error al descargar el video. Intenta nuevamente.")
+    
+    # Validar tamaño mínimo
+    file_size = os.path.getsize(input_path)
+    if file_size < 1024:  # Menos de 1KB es sospechoso
+        raise FileNotFoundError(f"Archivo descargado muy pequeño ({file_size} bytes).")
+    metrics.phase_duration.observe(elapsed, phase='download')
+    metrics.download_throughput.observe(file_size / (1024 * 1024) / max(elapsed, 0.001), mode=mode)
+    tracer.record('download', elapsed, mode=mode)
+    cost_model.observe_transfer('download', file_size, elapsed)
+    return input_path
+
+async def compress_and_send(client, job: Job, target_size=None):
+    message = job.message
+    quality = job.quality
+    video = job.media
+    # El compresor vigila el mismo token: /cancel mata a FFmpeg en el acto
+    token = compressor.cancel_token(job.id, job.cancel_token)
     
     status_msg = await message.reply_text(
         f"📥 **Descargando video...**\n\n"
@@ -353,214 +1003,290 @@ async def process_video(client, message: Message, quality='360p'):
         f"Esto puede tomar unos momentos dependiendo del tamaño del archivo."
     )
     
-    input_path = None
-    output_path = None
+    workspace = None
     status_msg_ref = [status_msg]
+    phase = 'disk'
+    # Estado persistido al arrancar: distinto de 'queued' si se retoma tras un reinicio
+    resume = job.state
     
     try:
-        # Nombre simple con timestamp para evitar conflictos
-        import time
-        timestamp = str(int(time.time() * 1000))
-        input_path = os.path.join(DOWNLOAD_DIR, f"download_{timestamp}.mp4")
+        # Admisión: se reserva el disco (entrada + salida proyectada) antes de descargar
+        input_size = video.file_size or 0
+        segmented = compressor.segment_count(getattr(video, 'duration', 0) or 0) > 1
+        estimate = estimate_job_space(input_size, quality, target_size, segmented)
         
-        last_download_update = [0]
-        
-        async def download_progress(current, total):
-            percentage = (current / total)
-            if percentage - last_download_update[0] >= 0.02 or current == total:
-                bar = await create_progress_bar(current, total, "📥", "")
-                try:
-                    await status_msg_ref[0].edit_text(
-                        f"📥 **Descargando video...**\n\n"
-                        f"{bar}\n"
-                        f"{format_bytes(current)} / {format_bytes(total)}"
-                    )
-                    last_download_update[0] = percentage
-                except:
-                    pass
-        
-        # Descarga con nombre simple y directo
-        await message.download(file_name=input_path, progress=download_progress)
+        async def disk_wait():
+            status_updater.update(
+                status_msg_ref[0],
+                "⏳ **En espera de espacio en disco...**\n\n"
+                "El servidor está ocupado. Tu video empezará en cuanto haya espacio."
+            )
         
-        # Verificar que el archivo existe (incluyendo .temp)
-        max_wait = 10
-        wait_count = 0
-        temp_path = input_path + ".temp"
+        with metrics.phase_duration.time(phase='disk_wait'), tracer.span('disk_wait'):
+            workspace = await spool.acquire(job.id, estimate, on_wait=disk_wait, cancelled=lambda: token.cancelled)
+        extension = os.path.splitext(sanitize_filename(video.file_name))[1].lower() or ".mp4"
+        input_path = workspace.path(f"input{extension}")
+        output_path = workspace.path("output.mp4")
+        upload = None
         
-        while wait_count < max_wait:
-            if os.path.exists(input_path):
-                break
-            if os.path.exists(temp_path):
-                # Renombrar .temp a .mp4
-                try:
-                    os.rename(temp_path, input_path)
-                    break
-                except Exception as e:
-                    print(f"Error renombrando .temp: {e}")
-                    await asyncio.sleep(0.5)
-                    wait_count += 1
-                    continue
+        async def compression_progress(progress, elapsed=0, current_size=0):
+            bar = await create_progress_bar(int(progress * 100), 100, "⚙️", "")
             
-            await asyncio.sleep(0.5)
-            wait_count += 1
-        
-        # Validar tamaño mínimo
-        if os.path.exists(input_path):
-            file_size = os.path.getsize(input_path)
-            if file_size < 1024:  # Menos de 1KB es sospechoso
-                raise FileNotFoundError(f"Archivo descargado muy pequeño ({file_size} bytes).")
-        else:
-            raise FileNotFoundError(f"Error al descargar el video. Intenta nuevamente.")
+            time_str = f"{elapsed//60:02d}:{elapsed%60:02d}"
+            size_str = format_bytes(current_size) if current_size > 0 else "0 B"
+            speed_str = format_bytes(current_size // max(elapsed, 1)) if elapsed > 0 else "0 B/s"
+            upload_str = f"\n📤 Subido: {format_bytes(upload.sent_bytes)}" if upload and upload.sent_parts else ""
+            
+            status_updater.update(
+                status_msg_ref[0],
+                f"🎬 **Comprimiendo...**\n\n"
+                f"{bar}\n"
+                f"Progreso: {progress * 100:.1f}%\n\n"
+                f"⏱️ Tiempo: {time_str}\n"
+                f"🎛️ Velocidad: {speed_str}/s\n"
+                f"📦 Tamaño: {size_str}"
+                f"{upload_str}"
+            )
         
-        if compressor.should_cancel(user_id):
-            await status_msg_ref[0].edit_text("❌ **Descarga cancelada por el usuario.**")
-            await cleanup_file(input_path)
-            compressor.clear_cancel_flag(user_id)
-            return
+        result = None
+        if resume == 'uploading' and job.result and (job.result.get('use_original') or os.path.exists(output_path)):
+            # Reinicio tras terminar el encode: sólo falta enviar el resultado
+            print(f"♻️ Retomando {job.id}: se reutiliza el video comprimido")
+            result = job.result
         
-        await status_msg_ref[0].edit_text(
-            f"⚙️ **Comprimiendo video...**\n\n"
-            f"Calidad: **{QUALITY_PRESETS[quality]['name']}**\n"
-            f"Procesando con FFmpeg. Esto puede tomar varios minutos."
+        # Descarga completa ya en el workspace: reinicio durante el encode o vista previa previa
+        input_ready = (
+            (resume == 'encoding' or (input_size > 0 and not os.path.exists(input_path + ".ranges")))
+            and os.path.exists(input_path) and os.path.getsize(input_path) >= input_size
         )
         
-        # Use simple generic name to avoid issues
-        output_path = os.path.join(DOWNLOAD_DIR, "video_compressed.mp4")
+        # Streaming: FFmpeg comprime mientras se descarga (si el contenedor lo permite)
+        media_stream = None
+        # Con workers externos el encode necesita el archivo en disco
+        if STREAMING_DOWNLOAD and ENCODE_BACKEND == 'local' and result is None and not input_ready:
+            if job.source:
+                media_stream = await job.source.open_stream()
+            else:
+                media_stream = await open_media_stream(client, message)
+        stream_duration = 0
+        if media_stream:
+            with tracer.span('probe'):
+                media_stream.info = job.info = await media_probe.probe(data=media_stream.head, size=video.file_size or 0)
+            stream_duration = getattr(video, 'duration', 0) or (media_stream.info.duration if media_stream.info else 0)
+            if compressor.needs_file(media_stream.info, quality, stream_duration, target_size):
+                # Segmentos en paralelo y análisis de CRF necesitan el archivo en disco
+                await media_stream.aclose()
+                media_stream = None
+            else:
+                # La entrada nunca toca el disco: sólo hace falta espacio para la salida
+                spool.adjust(workspace, estimate - input_size)
         
-        last_progress_update = [0.0]
+        if STREAMING_UPLOAD and ENCODE_BACKEND == 'local' and result is None:
+            # La salida se sube mientras FFmpeg la escribe; no puede quedar una de un intento anterior
+            await cleanup_file(output_path)
+            upload = GrowingFileUpload(client, output_path, f"{os.path.splitext(sanitize_filename(video.file_name))[0] or 'video'}.mp4")
         
-        async def compression_progress(progress, elapsed=0, current_size=0):
-            # Solo actualizar si ha cambiado más del 2%
-            if abs(progress - last_progress_update[0]) < 0.02 and progress < 0.99:
-                return
+        if media_stream:
+            await job_store.set_state(job, 'downloading')
+            status_updater.update(
+                status_msg_ref[0],
+                f"⚙️ **Descargando y comprimiendo...**\n\n"
+                f"Calidad: **{QUALITY_PRESETS[quality]['name']}**\n"
+                f"La compresión empieza mientras se descarga el video."
+            )
             
-            try:
-                bar = await create_progress_bar(int(progress * 100), 100, "⚙️", "")
-                
-                # Calcular tiempo estimado
-                if progress > 0.01:
-                    estimated_total = int(elapsed / progress)
-                    remaining = estimated_total - elapsed
-                else:
-                    remaining = 0
-                
-                time_str = f"{elapsed//60:02d}:{elapsed%60:02d}"
-                size_str = format_bytes(current_size) if current_size > 0 else "0 B"
-                speed_str = format_bytes(current_size // max(elapsed, 1)) if elapsed > 0 else "0 B/s"
-                
-                await status_msg_ref[0].edit_text(
-                    f"🎬 **Comprimiendo...**\n\n"
-                    f"{bar}\n"
-                    f"Progreso: {progress * 100:.1f}%\n\n"
-                    f"⏱️ Tiempo: {time_str}\n"
-                    f"🎛️ Velocidad: {speed_str}/s\n"
-                    f"📦 Tamaño: {size_str}"
+            phase = 'stream'
+            async with queue_manager.stage('encode', token), queue_manager.stage('download', token):
+                started = time.monotonic()
+                if upload:
+                    # La subida en streaming ocupa un slot de subida mientras dure, como cualquier otra
+                    upload.start(queue_manager.stage('upload', token))
+                result = await compressor.compress_stream(
+                    media_stream,
+                    output_path,
+                    job.id,
+                    quality,
+                    compression_progress,
+                    duration=stream_duration,
+                    input_size=video.file_size or 0,
+                    target_size=target_size,
+                    fragmented=upload is not None
                 )
-                last_progress_update[0] = progress
-            except:
-                pass
+                elapsed = time.monotonic() - started
+            metrics.phase_duration.observe(elapsed, phase='stream')
+            tracer.record('stream', elapsed)
+            if result:
+                # En streaming la descarga va al ritmo del encoder
+                metrics.download_throughput.observe(input_size / (1024 * 1024) / max(elapsed, 0.001), mode='stream')
+        elif result is None:
+            if input_ready:
+                print(f"♻️ {job.id}: se reutiliza la descarga del workspace")
+            else:
+                await job_store.set_state(job, 'downloading')
+                phase = 'download'
+                input_path = await download_input(client, job, input_path, status_msg_ref)
+            
+            token.check()
+            # El probe queda en caché para el compresor; el modelo de costos ya ve fps y códec reales
+            with tracer.span('probe'):
+                job.info = await media_probe.probe(input_path)
+            
+            await job_store.set_state(job, 'encoding')
+            status_updater.update(
+                status_msg_ref[0],
+                f"⚙️ **Comprimiendo video...**\n\n"
+                f"Calidad: **{QUALITY_PRESETS[quality]['name']}**\n"
+                f"Procesando con FFmpeg. Esto puede tomar varios minutos."
+            )
+            
+            phase = 'encode'
+            async with queue_manager.encode_stage(token):
+                started = time.monotonic()
+                if ENCODE_BACKEND == 'broker':
+                    result = await broker.run(
+                        job.id,
+                        input_path,
+                        output_path,
+                        quality,
+                        job.target_size,
+                        compression_progress,
+                        cancelled=lambda: token.cancelled,
+                        backlog=queue_manager.pending_count()
+                    )
+                else:
+                    if upload:
+                        upload.start(queue_manager.stage('upload', token))
+                    result = await compressor.compress_video(
+                        input_path,
+                        output_path,
+                        job.id,
+                        quality,
+                        compression_progress,
+                        borrow_slots=lambda count: queue_manager.borrow('encode', count),
+                        target_size=target_size,
+                        fragmented=upload is not None
+                    )
+            elapsed = time.monotonic() - started
+            metrics.phase_duration.observe(elapsed, phase='encode')
+            tracer.record('encode', elapsed, backend=ENCODE_BACKEND)
+            if result and result.get('action') == 'encode':
+                cost_model.observe_encode(quality, await media_probe.probe(input_path), elapsed, result)
         
-        result = await compressor.compress_video(
-            input_path,
-            output_path,
-            user_id,
-            quality,
-            compression_progress
-        )
+        if upload:
+            upload.finish(result is not None and not result.get('use_original'))
         
         if result is None:
-            if compressor.should_cancel(user_id):
-                await status_msg_ref[0].edit_text("❌ **Compresión cancelada por el usuario.**")
-                compressor.clear_cancel_flag(user_id)
-            else:
-                await status_msg_ref[0].edit_text(
-                    "❌ **Error en la compresión**\n\n"
-                    "Hubo un problema al comprimir tu video. "
-                    "Por favor, intenta con otro archivo."
-                )
-            await cleanup_file(input_path)
-            if output_path and os.path.exists(output_path):
-                await cleanup_file(output_path)
+            token.check()
+            metrics.errors.inc(cause=phase)
+            status_updater.update(
+                status_msg_ref[0],
+                "❌ **Error en la compresión**\n\n"
+                "Hubo un problema al comprimir tu video. "
+                "Por favor, intenta con otro archivo."
+            )
             return
         
-        await status_msg_ref[0].edit_text(
-            "📤 **Subiendo video comprimido...**\n\n"
-            "Esto puede tomar unos momentos."
-        )
-        
-        last_upload_update = [0]
-        
-        async def upload_progress(current, total):
-            percentage = (current / total) if total > 0 else 0
-            if abs(percentage - last_upload_update[0]) < 0.02 and current != total:
-                return
-                
-            try:
-                bar = await create_progress_bar(current, total, "📤", "")
-                await status_msg_ref[0].edit_text(
-                    f"📤 **Subiendo video comprimido...**\n\n"
-                    f"{bar}\n"
-                    f"{format_bytes(current)} / {format_bytes(total)}"
-                )
-                last_upload_update[0] = percentage
-            except:
-                pass
-        
-        caption = (
-            f"✅ **Video comprimido exitosamente**\n\n"
-            f"📊 **Estadísticas:**\n"
-            f"• Calidad: {result['quality']}\n"
-            f"• Tamaño original: {result['original_size_str']}\n"
-            f"• Tamaño comprimido: {result['compressed_size_str']}\n"
-            f"• Reducción: {result['reduction']:.1f}%\n\n"
-            f"🎥 Comprimido por @Compresor_minimisador_bot"
-        )
-        
-        video_duration = result.get('duration')
-        video_kwargs = {
-            'video': output_path,
-            'caption': caption,
-            'progress': upload_progress,
-            'supports_streaming': True,
-            'thumb': None
-        }
-        if video_duration and video_duration > 0:
-            video_kwargs['duration'] = int(video_duration)
-        
-        print(f"Enviando video comprimido: {output_path}")
-        await message.reply_video(**video_kwargs)
+        phase = 'upload'
+        await job_store.set_state(job, 'uploading', result)
+        if result.get('use_original') and job.source:
+            # Un enlace no tiene file_id que reenviar: se sube el original (en streaming no tocó el disco)
+            if not os.path.exists(input_path):
+                input_path = await download_input(client, job, input_path, status_msg_ref)
+            sent = await upload_result(client, message, input_path, result, status_msg_ref, token)
+        elif result.get('use_original'):
+            # La entrada ya cumple el preset: se reenvía por file_id, sin subir nada
+            sent = await send_original(message, build_caption(result))
+        else:
+            sent = await send_streamed_result(message, upload, result, status_msg_ref) if upload else None
+            if sent is None:
+                sent = await upload_result(client, message, output_path, result, status_msg_ref, token)
         print(f"Video enviado exitosamente")
         
-        try:
-            await status_msg_ref[0].delete()
-        except:
-            pass
+        await status_updater.delete(status_msg_ref[0])
         
-        await cleanup_file(input_path)
-        await cleanup_file(output_path)
         
-        compressor.clear_cancel_flag(user_id)
+        sent_media = (sent.video or sent.document) if sent else None
+        if sent_media:
+            return sent_media.file_id, result
+        return None
         
+    except JobCancelled:
+        status_updater.update(status_msg_ref[0], "❌ **Operación cancelada por el usuario.**")
+        metrics.errors.inc(cause='cancelled')
+        await job_store.set_state(job, 'cancelled')
+    
     except Exception as e:
         print(f"Error processing video: {e}")
+        metrics.errors.inc(cause='disk_full' if isinstance(e, SpoolFullError) else phase)
+        status_updater.update(
+            status_msg_ref[0],
+            "❌ **Error inesperado**\n\n"
+            f"Ocurrió un error: {str(e)}\n"
+            "Por favor, intenta nuevamente."
+        )
+    
+    except asyncio.CancelledError:
+        # Apagado del bot: el workspace se conserva para retomar el trabajo al reiniciar
+        workspace = None
+        raise
+    
+    finally:
+        compressor.clear_cancel_flag(job.id)
+        if upload:
+            await upload.cancel()
+        # El workspace entero (entrada, salida, segmentos) se borra de una vez
+        if workspace:
+            await spool.release(workspace)
+
+async def restore_state():
+    """Recupera preferencias y trabajos sin terminar de la ejecución anterior."""
+    for user_id, (quality, target_size) in (await job_store.load_settings()).items():
+        if quality in QUALITY_PRESETS:
+            compressor.set_user_quality(user_id, quality)
+        compressor.set_user_target_size(user_id, target_size)
+    await job_store.prune()
+    
+    pending = await job_store.unfinished()
+    by_chat = {}
+    for row in pending:
+        by_chat.setdefault(row['chat_id'], []).append(row)
+    
+    restored = 0
+    for chat_id, rows in by_chat.items():
         try:
-            await status_msg_ref[0].edit_text(
-                "❌ **Error inesperado**\n\n"
-                f"Ocurrió un error: {str(e)}\n"
-                "Por favor, intenta nuevamente."
-            )
-        except:
-            pass
-        
-        compressor.clear_cancel_flag(user_id)
+            messages = await app.get_messages(chat_id, [row['message_id'] for row in rows])
+        except Exception as e:
+            print(f"Error recuperando mensajes del chat {chat_id}: {e}")
+            messages = [None] * len(rows)
         
-        try:
-            if input_path:
-                await cleanup_file(input_path)
-            if output_path:
-                await cleanup_file(output_path)
-        except:
-            pass
+        for row, message in zip(rows, messages):
+            source = None
+            if row['url'] and message and not message.empty:
+                try:
+                    source = await UrlSource.probe(row['url'])
+                except Exception as e:
+                    print(f"Error recuperando el enlace {row['url']}: {e}")
+            if not message or message.empty or not (source or message.video or message.document):
+                # El video original ya no existe: no hay nada que retomar
+                await job_store.mark(row['id'], 'failed')
+                continue
+            job = Job(row['user_id'], message, row['quality'], row['target_size'],
+                      job_id=row['id'], created_at=row['created_at'], source=source)
+            job.state = row['state']
+            job.result = row['result']
+            spool.retain(job.id)
+            await queue_manager.add_to_queue(job.user_id, job)
+            restored += 1
+            try:
+                await message.reply_text(
+                    "🔄 **El bot se reinició**\n\n"
+                    "Tu video sigue en cola y se retomará donde quedó."
+                )
+            except Exception:
+                pass
+    
+    if restored:
+        print(f"♻️ {restored} trabajos recuperados tras el reinicio")
 
 async def health_check(request):
     """Health check endpoint for keep-alive (Render, UptimeRobot, etc)"""
@@ -570,12 +1296,21 @@ async def health_check(request):
         "message": "Bot is running 24/7 ✅"
     })
 
+async def metrics_handler(request):
+    """Métricas en formato de texto de Prometheus"""
+    return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8',
+                        headers={'X-Content-Type-Options': 'nosniff'})
+
 async def start_web_server():
     """Start aiohttp web server on PORT (for Render) or 8080 (local)"""
     port = int(os.getenv('PORT', 8080))
     web_app = web.Application()
     web_app.router.add_get('/health', health_check)
     web_app.router.add_get('/', health_check)
+    web_app.router.add_get('/metrics', metrics_handler)
+    if ENCODE_BACKEND == 'broker':
+        add_worker_routes(web_app, broker)
+    add_api_routes(web_app, job_api)
     
     runner = web.AppRunner(web_app)
     await runner.setup()
@@ -597,6 +1332,11 @@ async def main():
         async with app:
             await app.get_me()
             print("🔗 Bot connected to Telegram!")
+            await restore_state()
+            spool.start()
+            if ENCODE_BACKEND == 'broker':
+                broker.start()
+            queue_manager.start(run_job, cost=cost_model.job_cost)
             await asyncio.Event().wait()
     except Exception as e:
         print(f"❌ Error: {e}")
@@ -0,0 +1,415 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import aiohttp
+from aiohttp import web
+from config import BROKER_DB_PATH, WORKER_TOKEN, WORKER_TIMEOUT, TASK_MAX_ATTEMPTS, MAX_FILE_SIZE
+
+class TaskBroker:
+    """
+    Cola de encodes compartida entre el bot (productor) y los procesos worker.py
+    (consumidores), en SQLite. Los workers de la misma máquina la usan directamente;
+    los de otras máquinas pasan por los endpoints HTTP del bot (HttpBrokerClient).
+
+    Una tarea pasa por pending -> running -> done/failed/cancelled. Cada
+    actualización de un worker se valida contra worker_id, así que si la tarea
+    se reasigna (worker caído o reenvío tras un reinicio) el worker viejo se entera
+    en su próximo reporte y aborta.
+    """
+    def __init__(self, db_path=BROKER_DB_PATH):
+        self.db_path = db_path
+        self._conn = None
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    def _connect(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS tasks ("
+                " id TEXT PRIMARY KEY,"
+                " input_path TEXT NOT NULL,"
+                " output_path TEXT NOT NULL,"
+                " quality TEXT NOT NULL,"
+                " target_size INTEGER,"
+                " status TEXT NOT NULL,"
+                " worker_id TEXT,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " progress REAL NOT NULL DEFAULT 0,"
+                " elapsed INTEGER NOT NULL DEFAULT 0,"
+                " current_size INTEGER NOT NULL DEFAULT 0,"
+                " result TEXT,"
+                " error TEXT,"
+                " created_at REAL NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, created_at)")
+            if 'load' not in [row[1] for row in conn.execute("PRAGMA table_info(tasks)")]:
+                # Bases creadas antes de mandar la carga con cada tarea
+                conn.execute("ALTER TABLE tasks ADD COLUMN load REAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS workers ("
+                " id TEXT PRIMARY KEY,"
+                " name TEXT NOT NULL,"
+                " slots INTEGER NOT NULL,"
+                " remote INTEGER NOT NULL DEFAULT 0,"
+                " registered_at REAL NOT NULL,"
+                " last_seen REAL NOT NULL)"
+            )
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _execute(self, query, params=(), fetch=False):
+        with self._lock:
+            conn = self._connect()
+            cursor = conn.execute(query, params)
+            rows = cursor.fetchall() if fetch else cursor.rowcount
+            conn.commit()
+            return rows
+
+    async def _run(self, query, params=(), fetch=False):
+        return await asyncio.to_thread(self._execute, query, params, fetch)
+
+    # --- Lado del bot ---
+
+    def start(self):
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.create_task(self._reaper_loop())
+
+    async def load(self, backlog=0):
+        """
+        Carga de encode vista desde el bot: tareas que esperarían por cada slot de los
+        workers vivos contando una más y `backlog` trabajos aún en la cola del bot. Va
+        con cada tarea porque en el worker queue_manager está vacío.
+        """
+        rows = await self._run(
+            "SELECT (SELECT COUNT(*) FROM tasks WHERE status IN ('pending', 'running')), "
+            "(SELECT COALESCE(SUM(slots), 0) FROM workers WHERE last_seen >= ?)",
+            (time.time() - WORKER_TIMEOUT,), True
+        )
+        busy, slots = rows[0]
+        return max(busy + 1 + backlog - slots, 0) / max(slots, 1)
+
+    async def submit(self, task_id, input_path, output_path, quality, target_size=None, backlog=0):
+        load = await self.load(backlog)
+        now = time.time()
+        await self._run(
+            "INSERT OR REPLACE INTO tasks (id, input_path, output_path, quality, target_size, status, "
+            "worker_id, attempts, load, created_at, updated_at) VALUES (?, ?, ?, ?, ?, 'pending', NULL, 0, ?, ?, ?)",
+            (task_id, os.path.abspath(input_path), os.path.abspath(output_path), quality, target_size, load, now, now)
+        )
+
+    async def cancel(self, task_id):
+        await self._run(
+            "UPDATE tasks SET status = 'cancelled', updated_at = ? WHERE id = ? AND status IN ('pending', 'running')",
+            (time.time(), task_id)
+        )
+
+    async def run(self, task_id, input_path, output_path, quality, target_size=None,
+                  progress_callback=None, cancelled=None, poll_interval=1.0, backlog=0):
+        """
+        Encola el encode y espera a que un worker lo termine, reenviando el progreso.
+        Devuelve el resultado de compress_video, o None si falló o se canceló.
+        """
+        await self.submit(task_id, input_path, output_path, quality, target_size, backlog)
+        last_progress = None
+        try:
+            while True:
+                if cancelled and cancelled():
+                    await self.cancel(task_id)
+                    return None
+                rows = await self._run(
+                    "SELECT status, progress, elapsed, current_size, result, error FROM tasks WHERE id = ?",
+                    (task_id,), True
+                )
+                if not rows:
+                    return None
+                status, progress, elapsed, current_size, result, error = rows[0]
+                if status == 'done':
+                    return json.loads(result) if result else None
+                if status in ('failed', 'cancelled'):
+                    if error:
+                        print(f"❌ Encode remoto {task_id} falló: {error}")
+                    return None
+                if progress_callback and status == 'running' and progress != last_progress:
+                    last_progress = progress
+                    await progress_callback(progress, elapsed, current_size)
+                await asyncio.sleep(poll_interval)
+        except asyncio.CancelledError:
+            await self.cancel(task_id)
+            raise
+
+    async def requeue_stale(self):
+        """Devuelve a la cola las tareas de workers sin heartbeat; tras varios intentos, las da por fallidas."""
+        limit = time.time() - WORKER_TIMEOUT
+        stale = "worker_id IN (SELECT id FROM workers WHERE last_seen < ?)"
+        await self._run(
+            f"UPDATE tasks SET status = 'failed', error = 'worker sin respuesta', updated_at = ? "
+            f"WHERE status = 'running' AND attempts + 1 >= ? AND {stale}",
+            (time.time(), TASK_MAX_ATTEMPTS, limit)
+        )
+        requeued = await self._run(
+            f"UPDATE tasks SET status = 'pending', worker_id = NULL, attempts = attempts + 1, updated_at = ? "
+            f"WHERE status = 'running' AND {stale}",
+            (time.time(), limit)
+        )
+        await self._run("DELETE FROM workers WHERE last_seen < ?", (limit - WORKER_TIMEOUT,))
+        if requeued:
+            print(f"🔁 {requeued} encodes reencolados (worker caído)")
+
+    async def _reaper_loop(self):
+        while True:
+            await asyncio.sleep(WORKER_TIMEOUT / 2)
+            try:
+                await self.requeue_stale()
+            except Exception as e:
+                print(f"Error revisando workers: {e}")
+
+    # --- Lado del worker ---
+
+    async def register(self, name, slots, remote=False):
+        worker_id = uuid.uuid4().hex[:12]
+        now = time.time()
+        await self._run(
+            "INSERT INTO workers (id, name, slots, remote, registered_at, last_seen) VALUES (?, ?, ?, ?, ?, ?)",
+            (worker_id, name, slots, int(remote), now, now)
+        )
+        return worker_id
+
+    async def heartbeat(self, worker_id):
+        """Actualiza last_seen. Devuelve False si el worker ya no está registrado."""
+        updated = await self._run("UPDATE workers SET last_seen = ? WHERE id = ?", (time.time(), worker_id))
+        return updated > 0
+
+    def _claim(self, worker_id):
+        with self._lock:
+            conn = self._connect()
+            # BEGIN IMMEDIATE: dos workers no pueden tomar la misma tarea
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT id, input_path, output_path, quality, target_size, load FROM tasks "
+                    "WHERE status = 'pending' ORDER BY created_at LIMIT 1"
+                ).fetchone()
+                if row:
+                    conn.execute(
+                        "UPDATE tasks SET status = 'running', worker_id = ?, progress = 0, updated_at = ? WHERE id = ?",
+                        (worker_id, time.time(), row[0])
+                    )
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        if not row:
+            return None
+        return {
+            'id': row[0], 'input_path': row[1], 'output_path': row[2], 'quality': row[3],
+            'target_size': row[4], 'load': row[5]
+        }
+
+    async def claim(self, worker_id):
+        return await asyncio.to_thread(self._claim, worker_id)
+
+    async def progress(self, task_id, worker_id, progress, elapsed=0, current_size=0):
+        """Guarda el progreso. Devuelve True si la tarea ya no es de este worker (cancelada o reasignada)."""
+        updated = await self._run(
+            "UPDATE tasks SET progress = ?, elapsed = ?, current_size = ?, updated_at = ? "
+            "WHERE id = ? AND worker_id = ? AND status = 'running'",
+            (progress, elapsed, current_size, time.time(), task_id, worker_id)
+        )
+        return updated == 0
+
+    async def complete(self, task_id, worker_id, result):
+        await self._run(
+            "UPDATE tasks SET status = 'done', result = ?, progress = 1, updated_at = ? "
+            "WHERE id = ? AND worker_id = ? AND status = 'running'",
+            (json.dumps(result), time.time(), task_id, worker_id)
+        )
+
+    async def fail(self, task_id, worker_id, error):
+        await self._run(
+            "UPDATE tasks SET status = 'failed', error = ?, updated_at = ? "
+            "WHERE id = ? AND worker_id = ? AND status = 'running'",
+            (str(error)[:500], time.time(), task_id, worker_id)
+        )
+
+    async def fetch_input(self, task, workdir):
+        # Mismo sistema de archivos: el worker lee y escribe directamente en el workspace del bot
+        return task['input_path'], task['output_path']
+
+    async def send_output(self, task, output_path):
+        pass
+
+    async def owns(self, task_id, worker_id):
+        rows = await self._run(
+            "SELECT input_path, output_path FROM tasks WHERE id = ? AND worker_id = ? AND status = 'running'",
+            (task_id, worker_id), True
+        )
+        return rows[0] if rows else None
+
+class HttpBrokerClient:
+    """Lado worker del broker a través de los endpoints /workers y /tasks del bot."""
+    def __init__(self, base_url, token=WORKER_TOKEN):
+        self.base_url = base_url.rstrip('/')
+        self.headers = {'Authorization': f'Bearer {token}'}
+        self.session = None
+
+    async def _session(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                headers=self.headers, timeout=aiohttp.ClientTimeout(total=None, sock_read=300)
+            )
+        return self.session
+
+    async def _post(self, path, payload=None):
+        session = await self._session()
+        async with session.post(f"{self.base_url}{path}", json=payload or {}) as response:
+            if response.status == 204:
+                return None
+            response.raise_for_status()
+            return await response.json()
+
+    async def register(self, name, slots, remote=True):
+        return (await self._post('/workers/register', {'name': name, 'slots': slots}))['worker_id']
+
+    async def heartbeat(self, worker_id):
+        return (await self._post(f'/workers/{worker_id}/heartbeat'))['registered']
+
+    async def claim(self, worker_id):
+        return await self._post(f'/workers/{worker_id}/claim')
+
+    async def progress(self, task_id, worker_id, progress, elapsed=0, current_size=0):
+        data = await self._post(f'/tasks/{task_id}/progress', {
+            'worker_id': worker_id, 'progress': progress, 'elapsed': elapsed, 'current_size': current_size
+        })
+        return data['cancelled']
+
+    async def complete(self, task_id, worker_id, result):
+        await self._post(f'/tasks/{task_id}/complete', {'worker_id': worker_id, 'result': result})
+
+    async def fail(self, task_id, worker_id, error):
+        await self._post(f'/tasks/{task_id}/fail', {'worker_id': worker_id, 'error': str(error)[:500]})
+
+    async def fetch_input(self, task, workdir):
+        """Descarga la entrada de la tarea a `workdir`; devuelve (entrada, salida) locales."""
+        os.makedirs(workdir, exist_ok=True)
+        input_path = os.path.join(workdir, 'input' + os.path.splitext(task['input_path'])[1])
+        output_path = os.path.join(workdir, 'output.mp4')
+        session = await self._session()
+        url = f"{self.base_url}/tasks/{task['id']}/input?worker_id={task['worker_id']}"
+        async with session.get(url) as response:
+            response.raise_for_status()
+            with open(input_path, 'wb') as f:
+                async for chunk in response.content.iter_chunked(1024 * 1024):
+                    f.write(chunk)
+        return input_path, output_path
+
+    async def send_output(self, task, output_path):
+        if not os.path.exists(output_path):
+            # Passthrough: no hay salida nueva, el bot reenvía el original
+            return
+        session = await self._session()
+        url = f"{self.base_url}/tasks/{task['id']}/output?worker_id={task['worker_id']}"
+        with open(output_path, 'rb') as f:
+            async with session.put(url, data=f) as response:
+                response.raise_for_status()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+def add_worker_routes(web_app, broker):
+    """Endpoints para workers remotos. Sólo se publican si hay WORKER_TOKEN."""
+    if not WORKER_TOKEN:
+        return
+
+    @web.middleware
+    async def auth(request, handler):
+        if request.path.startswith(('/workers/', '/tasks/')):
+            if request.headers.get('Authorization') != f'Bearer {WORKER_TOKEN}':
+                raise web.HTTPUnauthorized()
+        return await handler(request)
+
+    web_app.middlewares.append(auth)
+
+    async def register(request):
+        data = await request.json()
+        worker_id = await broker.register(str(data.get('name', 'worker'))[:64], int(data.get('slots', 1)), remote=True)
+        return web.json_response({'worker_id': worker_id})
+
+    async def heartbeat(request):
+        return web.json_response({'registered': await broker.heartbeat(request.match_info['worker_id'])})
+
+    async def claim(request):
+        worker_id = request.match_info['worker_id']
+        task = await broker.claim(worker_id)
+        if task is None:
+            return web.Response(status=204)
+        task['worker_id'] = worker_id
+        return web.json_response(task)
+
+    async def progress(request):
+        data = await request.json()
+        cancelled = await broker.progress(
+            request.match_info['task_id'], data['worker_id'],
+            float(data.get('progress', 0)), int(data.get('elapsed', 0)), int(data.get('current_size', 0))
+        )
+        return web.json_response({'cancelled': cancelled})
+
+    async def complete(request):
+        data = await request.json()
+        await broker.complete(request.match_info['task_id'], data['worker_id'], data.get('result'))
+        return web.json_response({'ok': True})
+
+    async def fail(request):
+        data = await request.json()
+        await broker.fail(request.match_info['task_id'], data['worker_id'], data.get('error', ''))
+        return web.json_response({'ok': True})
+
+    async def task_input(request):
+        paths = await broker.owns(request.match_info['task_id'], request.query.get('worker_id', ''))
+        if not paths:
+            raise web.HTTPNotFound()
+        return web.FileResponse(paths[0])
+
+    async def task_output(request):
+        paths = await broker.owns(request.match_info['task_id'], request.query.get('worker_id', ''))
+        if not paths:
+            raise web.HTTPNotFound()
+        if (request.content_length or 0) > MAX_FILE_SIZE:
+            raise web.HTTPRequestEntityTooLarge(MAX_FILE_SIZE, request.content_length)
+        # La salida va al workspace del trabajo, cuya reserva en el spool ya la incluye;
+        # las escrituras no bloquean el loop y el cuerpo no puede superar MAX_FILE_SIZE
+        partial = paths[1] + '.part'
+        received = 0
+        f = await asyncio.to_thread(open, partial, 'wb')
+        try:
+            async for chunk in request.content.iter_chunked(1024 * 1024):
+                received += len(chunk)
+                if received > MAX_FILE_SIZE:
+                    raise web.HTTPRequestEntityTooLarge(MAX_FILE_SIZE, received)
+                await asyncio.to_thread(f.write, chunk)
+        except BaseException:
+            await asyncio.to_thread(f.close)
+            await asyncio.to_thread(os.remove, partial)
+            raise
+        await asyncio.to_thread(f.close)
+        os.replace(partial, paths[1])
+        return web.json_response({'ok': True})
+
+    web_app.router.add_post('/workers/register', register)
+    web_app.router.add_post('/workers/{worker_id}/heartbeat', heartbeat)
+    web_app.router.add_post('/workers/{worker_id}/claim', claim)
+    web_app.router.add_post('/tasks/{task_id}/progress', progress)
+    web_app.router.add_post('/tasks/{task_id}/complete', complete)
+    web_app.router.add_post('/tasks/{task_id}/fail', fail)
+    web_app.router.add_get('/tasks/{task_id}/input', task_input)
+    web_app.router.add_put('/tasks/{task_id}/output', task_output)
+
+broker = TaskBroker()
@@ -0,0 +1,48 @@
+import asyncio
+
+class JobCancelled(Exception):
+    """El trabajo se canceló con /cancel: corta la etapa en curso."""
+
+class CancelToken:
+    """
+    Cancelación cooperativa de un trabajo. /cancel sólo lo marca y cada etapa
+    reacciona en su propio punto: las transferencias desde su callback de progreso
+    (stop_transmission en Pyrogram), FFmpeg con un kill en cuanto se marca y el
+    resto del pipeline con `check()` entre pasos.
+    """
+    def __init__(self):
+        self.event = asyncio.Event()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def cancel(self):
+        self.event.set()
+
+    def check(self):
+        if self.event.is_set():
+            raise JobCancelled()
+
+    async def wait(self):
+        await self.event.wait()
+
+    async def wait_for(self, awaitable):
+        """
+        Espera `awaitable` (un semáforo, un resultado en caché...) salvo que antes se
+        cancele el trabajo: entonces la espera se abandona y se lanza JobCancelled.
+        """
+        self.check()
+        task = asyncio.ensure_future(awaitable)
+        waiter = asyncio.ensure_future(self.event.wait())
+        try:
+            await asyncio.wait((task, waiter), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            waiter.cancel()
+            if not task.done():
+                task.cancel()
+                # La espera se deshace antes de seguir (un semáforo no queda tomado)
+                await asyncio.gather(task, return_exceptions=True)
+        if task.cancelled():
+            raise JobCancelled()
+        return task.result()
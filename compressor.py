@@ -2,7 +2,20 @@ import os
 import asyncio
 import subprocess
 import json
+import hashlib
+import shutil
 from utils import get_file_size, format_bytes
+from media_probe import media_probe
+from metrics import metrics
+from tracing import tracer
+from encoder_policy import encoder_policy
+from crf_analysis import crf_analyzer
+from supervisor import supervisor
+from cancellation import CancelToken
+from config import (
+    FFMPEG_THREADS, CPU_COUNT, SEGMENTED_ENCODE, SEGMENT_MIN_DURATION, SEGMENT_MIN_LENGTH, MAX_SEGMENTS,
+    TWO_PASS_MAX_DURATION, PREVIEW_LENGTH
+)
 
 QUALITY_PRESETS = {
     '240p': {
@@ -42,20 +55,80 @@ QUALITY_PRESETS = {
     }
 }
 
+# Calidades que se comparan en la vista previa (las de los botones, salvo 'original')
+PREVIEW_QUALITIES = ['240p', '360p', '480p', '720p']
+
+# Nombre del códec (ffprobe) que produce cada encoder
+ENCODER_CODECS = {
+    'libx265': 'hevc',
+    'libx264': 'h264'
+}
+
+# Margen sobre el bitrate del preset para considerar que la entrada ya lo cumple
+BITRATE_TOLERANCE = 1.1
+
+AAC_AUDIO_ARGS = ['-acodec', 'aac', '-b:a', '128k']
+LOW_AUDIO_ARGS = ['-acodec', 'aac', '-b:a', '64k']
+
+# Modo tamaño objetivo: margen para el contenedor, tope VBV y bitrate mínimo de video
+TARGET_SIZE_OVERHEAD = 0.05
+TARGET_VBV_MAXRATE = 1.2
+MIN_TARGET_VIDEO_BITRATE = 100000
+
+# Cortar y unir segmentos es copia de streams: mucho más rápido que tiempo real.
+# Pasado este plazo (base + duración / velocidad mínima) se da por colgado
+COPY_TIMEOUT_BASE = 60
+COPY_MIN_SPEED = 5
+
+# MP4 fragmentado: FFmpeg sólo agrega bytes al final, así que el archivo se puede
+# subir mientras se escribe (en lugar de +faststart, que lo reescribe al terminar)
+FRAGMENTED_MOVFLAGS = ['-movflags', 'frag_keyframe+empty_moov+default_base_moof']
+
+def scaled_progress(callback, start, span):
+    """Adapta un progress_callback para que una fase ocupe [start, start + span] del total."""
+    if not callback:
+        return None
+    async def scaled(progress, elapsed=0, current_size=0):
+        await callback(start + progress * span, elapsed, current_size)
+    return scaled
+
+def parse_bitrate(value):
+    """'500k' -> 500000, '2M' -> 2000000"""
+    value = str(value).strip().lower()
+    multipliers = {'k': 1000, 'm': 1000000}
+    if value and value[-1] in multipliers:
+        return int(float(value[:-1]) * multipliers[value[-1]])
+    return int(float(value))
+
 class VideoCompressor:
     def __init__(self):
-        self.cancel_flag = {}
+        # Token de cancelación por clave (job.id o id de tarea del broker); los FFmpeg en curso lo vigilan
+        self.cancel_tokens = {}
         self.user_quality = {}
+        self.user_target_size = {}
+    
+    def cancel_token(self, key, token=None):
+        """
+        Token de la clave `key`. Con `token` (el job.cancel_token del trabajo) lo registra
+        en lugar de cualquier otro: el trabajo tiene un solo token de principio a fin.
+        """
+        if token is not None:
+            self.cancel_tokens[key] = token
+            return token
+        return self.cancel_tokens.setdefault(key, CancelToken())
     
-    def set_cancel_flag(self, user_id, value=True):
-        self.cancel_flag[user_id] = value
+    def set_cancel_flag(self, key, value=True):
+        if value:
+            self.cancel_token(key).cancel()
+        else:
+            self.clear_cancel_flag(key)
     
-    def should_cancel(self, user_id):
-        return self.cancel_flag.get(user_id, False)
+    def should_cancel(self, key):
+        token = self.cancel_tokens.get(key)
+        return token is not None and token.cancelled
     
-    def clear_cancel_flag(self, user_id):
-        if user_id in self.cancel_flag:
-            del self.cancel_flag[user_id]
+    def clear_cancel_flag(self, key):
+        self.cancel_tokens.pop(key, None)
     
     def set_user_quality(self, user_id, quality):
         self.user_quality[user_id] = quality
@@ -63,7 +136,191 @@ class VideoCompressor:
     def get_user_quality(self, user_id):
         return self.user_quality.get(user_id, '360p')
     
-    async def compress_video(self, input_path, output_path, user_id, quality='360p', progress_callback=None):
+    def set_user_target_size(self, user_id, size_mb):
+        if size_mb:
+            self.user_target_size[user_id] = size_mb
+        else:
+            self.user_target_size.pop(user_id, None)
+    
+    def get_user_target_size(self, user_id):
+        return self.user_target_size.get(user_id)
+    
+    def encode_args(self, preset, threads=None, audio_args=None, rate=None):
+        """
+        Argumentos de FFmpeg que determinan el resultado del encode.
+        Con threads=None se omiten los parámetros de hilos (no cambian la salida).
+        `rate` ({'bitrate', 'pass', 'stats'}) sustituye el CRF del preset por un
+        bitrate objetivo con tope VBV, opcionalmente en dos pasadas.
+        `preset['speed']` (lo pone encoder_policy) reemplaza el preset ultrafast.
+        """
+        x265_params = 'log-level=error:aq-mode=0'
+        args = ['-vcodec', preset['codec']]
+        if not rate:
+            args.extend(['-crf', str(preset['crf'])])
+        args.extend(['-preset', preset.get('speed', 'ultrafast')])
+        args.extend(audio_args or ['-acodec', 'copy'])
+        args.extend(['-g', '30'])
+        
+        if threads:
+            args.extend(['-threads', str(threads)])
+            x265_params += f':pools={threads}'
+        if rate and rate.get('pass'):
+            x265_params += f":pass={rate['pass']}:stats={rate['stats']}"
+            if rate['pass'] == 1:
+                x265_params += ':slow-firstpass=0'
+        if preset['codec'] == 'libx265':
+            args.extend(['-x265-params', x265_params])
+        
+        if preset['resolution']:
+            args.extend(['-vf', f"scale={preset['resolution']}:flags=fast_bilinear"])
+        else:
+            args.extend(['-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2:flags=fast_bilinear'])
+        
+        if rate:
+            bitrate = int(rate['bitrate'])
+            args.extend([
+                '-b:v', str(bitrate),
+                '-maxrate', str(int(bitrate * TARGET_VBV_MAXRATE)),
+                '-bufsize', str(bitrate * 2)
+            ])
+        elif preset['bitrate']:
+            args.extend(['-b:v', preset['bitrate']])
+        
+        return args
+    
+    def params_hash(self, quality, target_size=None):
+        """Hash estable de los parámetros de encode de un preset (clave de caché)."""
+        preset = QUALITY_PRESETS.get(quality, QUALITY_PRESETS['360p'])
+        params = self.encode_args(preset)
+        if target_size:
+            params = params + ['target_size', str(target_size)]
+        payload = json.dumps(params, separators=(',', ':'))
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:16]
+    
+    def target_rate(self, info, duration, target_size):
+        """
+        Bitrate de video para que el archivo final pese ~target_size bytes:
+        presupuesto total menos el audio y un margen para el contenedor.
+        Devuelve (bitrate de video en bps, argumentos de audio).
+        """
+        audio_args = self._audio_args(info)
+        has_audio = info is None or bool(info.audio_streams)
+        if audio_args == AAC_AUDIO_ARGS:
+            audio_bps = 128000
+        else:
+            audio_bps = (info.audio_bitrate if info else 0) or (128000 if has_audio else 0)
+        
+        budget = target_size * 8 * (1 - TARGET_SIZE_OVERHEAD) / max(duration, 1)
+        video_bps = budget - audio_bps
+        if video_bps < MIN_TARGET_VIDEO_BITRATE and audio_bps > 64000:
+            # Con objetivos muy justos se sacrifica audio antes que video
+            audio_args = LOW_AUDIO_ARGS
+            video_bps = budget - 64000
+        return max(int(video_bps), MIN_TARGET_VIDEO_BITRATE), audio_args
+    
+    def plan(self, info, quality, target_size=None):
+        """
+        Elige la acción más barata que cumple el preset según el análisis de la entrada:
+        'passthrough' (se reenvía el original), 'remux' (copia de streams a MP4),
+        'audio' (copia el video y sólo recodifica el audio) o 'encode'.
+        Con `target_size` basta con que la entrada ya quepa en ese tamaño.
+        """
+        if info is None or info.video is None:
+            return 'encode'
+        
+        if target_size:
+            if info.size and info.size <= target_size:
+                return self._copy_action(info)
+            return 'encode'
+        
+        preset = QUALITY_PRESETS.get(quality, QUALITY_PRESETS['360p'])
+        if info.video_codec != ENCODER_CODECS.get(preset['codec']):
+            return 'encode'
+        
+        if preset['resolution']:
+            target = sorted(int(x) for x in preset['resolution'].split(':'))
+            source = sorted((info.width, info.height))
+            if source[0] > target[0] or source[1] > target[1]:
+                return 'encode'
+        
+        if preset['bitrate']:
+            limit = parse_bitrate(preset['bitrate']) * BITRATE_TOLERANCE
+            if not info.video_bitrate or info.video_bitrate > limit:
+                return 'encode'
+        
+        return self._copy_action(info)
+    
+    def _copy_action(self, info):
+        if not info.audio_copyable:
+            return 'audio'
+        if info.is_mp4:
+            return 'passthrough'
+        return 'remux'
+    
+    def _audio_args(self, info):
+        if info is None or info.audio_copyable:
+            return ['-acodec', 'copy']
+        return AAC_AUDIO_ARGS
+    
+    def _remux_cmd(self, input_arg, output_path, info, fragmented=False):
+        cmd = [
+            'ffmpeg', '-i', input_arg,
+            '-map', '0:v:0', '-map', '0:a?',
+            '-vcodec', 'copy'
+        ]
+        cmd.extend(self._audio_args(info))
+        cmd.extend(FRAGMENTED_MOVFLAGS if fragmented else ['-movflags', '+faststart'])
+        cmd.extend([
+            '-progress', 'pipe:1',
+            '-y',
+            '-loglevel', 'error',
+            output_path
+        ])
+        return cmd
+    
+    def _ffmpeg_cmd(self, input_arg, output_path, preset, audio_args=None, rate=None, fragmented=False):
+        # Build FFmpeg command - VELOCIDAD MÁXIMA con calidad aceptable
+        cmd = ['ffmpeg', '-i', input_arg]
+        cmd.extend(self.encode_args(preset, threads=FFMPEG_THREADS, audio_args=audio_args, rate=rate))
+        if fragmented:
+            cmd.extend(FRAGMENTED_MOVFLAGS)
+        cmd.extend([
+            '-progress', 'pipe:1',
+            '-y',
+            '-loglevel', 'error',
+            output_path
+        ])
+        return cmd
+    
+    def segment_count(self, duration):
+        """Número de segmentos para un encode en paralelo (1 = encode normal)."""
+        if not SEGMENTED_ENCODE or duration < SEGMENT_MIN_DURATION:
+            return 1
+        by_cores = CPU_COUNT // FFMPEG_THREADS
+        by_length = int(duration // SEGMENT_MIN_LENGTH)
+        return max(1, min(MAX_SEGMENTS, by_cores, by_length))
+    
+    def needs_file(self, info, quality, duration, target_size=None):
+        """
+        True si el encode rinde más con el original en disco que en streaming: videos
+        largos (segmentos en paralelo) o encodes que pasan por el análisis de CRF.
+        """
+        if self.segment_count(duration) > 1:
+            return True
+        if target_size or self.plan(info, quality, target_size) != 'encode':
+            return False
+        return crf_analyzer.applies(quality, QUALITY_PRESETS.get(quality, QUALITY_PRESETS['360p']), duration)
+    
+    async def compress_video(self, input_path, output_path, user_id, quality='360p', progress_callback=None,
+                             borrow_slots=None, target_size=None, fragmented=False, load=None):
+        """
+        `borrow_slots(n)` es un context manager asíncrono opcional que intenta reservar
+        hasta n slots de encode adicionales y devuelve cuántos consiguió; con él los
+        videos largos se codifican por segmentos en paralelo.
+        `target_size` (bytes) cambia el CRF del preset por un bitrate calculado para
+        que el resultado quepa en ese tamaño.
+        Con `fragmented` la salida es MP4 fragmentado, que se puede subir mientras crece.
+        """
         try:
             if self.should_cancel(user_id):
                 return None
@@ -71,113 +328,437 @@ class VideoCompressor:
             # Get original file size first (before any processing)
             original_size = get_file_size(input_path)
             
-            try:
-                result = await asyncio.create_subprocess_exec(
-                    'ffprobe', '-v', 'error', '-show_format', '-of', 'json', input_path,
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE
-                )
-                stdout, _ = await result.communicate()
-                probe = json.loads(stdout)
-                duration = float(probe['format'].get('duration', 0))
-                if duration <= 0:
-                    duration = 1
-            except Exception as e:
-                print(f"Error probing video: {e}")
+            with tracer.span('probe'):
+                info = await media_probe.probe(input_path)
+            duration = info.duration if info else 0
+            if duration <= 0:
                 duration = 1
             
             preset = QUALITY_PRESETS.get(quality, QUALITY_PRESETS['360p'])
             
-            # Build FFmpeg command - VELOCIDAD MÁXIMA con calidad aceptable
-            cmd = [
-                'ffmpeg',
-                '-i', input_path,
-                '-vcodec', preset['codec'],
-                '-crf', str(preset['crf']),
-                '-preset', 'ultrafast',
-                '-acodec', 'copy',
-                '-threads', '0',
-                '-g', '30',
-                '-x265-params', 'log-level=error:aq-mode=0',
-            ]
+            action = self.plan(info, quality, target_size)
+            print(f"🔎 Acción elegida: {action}")
+            if action == 'passthrough':
+                return self._with_target(self._original_result(original_size, preset, duration, action), target_size)
+            if action in ('remux', 'audio'):
+                cmd = self._remux_cmd(input_path, output_path, info, fragmented)
+                if not await self._run_ffmpeg(cmd, output_path, user_id, duration, progress_callback):
+                    return None
+                result = await self._build_result(original_size, output_path, preset, action)
+                return self._with_target(result, target_size)
             
-            if preset['resolution']:
-                cmd.extend(['-vf', f"scale={preset['resolution']}:flags=fast_bilinear"])
+            rate = None
+            audio_args = self._audio_args(info)
+            preset = encoder_policy.apply(quality, preset, duration, target_size, load)
+            if not target_size:
+                # Con tamaño objetivo manda el bitrate; el CRF sólo importa sin él
+                preset = await crf_analyzer.tune(
+                    input_path, output_path, quality, preset, duration, self.cancel_token(user_id)
+                )
+                if self.should_cancel(user_id):
+                    return None
+            if target_size:
+                video_bps, audio_args = self.target_rate(info, duration, target_size)
+                rate = {'bitrate': video_bps}
+                print(f"🎯 Tamaño objetivo {format_bytes(target_size)}: video a {video_bps // 1000} kbps")
+                
+                if duration <= TWO_PASS_MAX_DURATION:
+                    ok = await self._encode_two_pass(
+                        input_path, output_path, user_id, preset, duration,
+                        audio_args, rate, progress_callback, fragmented
+                    )
+                    if not ok:
+                        return None
+                    result = await self._build_result(original_size, output_path, preset, action)
+                    return self._with_target(result, target_size, '2-pass')
+            
+            segments = self.segment_count(duration)
+            if segments > 1 and borrow_slots:
+                # Cada segmento extra necesita un slot de encode libre: en una máquina
+                # ocupada se degrada solo a un encode normal
+                async with borrow_slots(segments - 1) as extra:
+                    if extra > 0:
+                        # El resultado dice en cuántos se repartió: no es la velocidad de un solo slot
+                        preset = dict(preset, encoder=dict(preset.get('encoder') or {}, segments=1 + extra))
+                        ok = await self._compress_segmented(
+                            input_path, output_path, user_id, preset, duration,
+                            segments, 1 + extra, progress_callback, audio_args, rate, fragmented
+                        )
+                        if not ok:
+                            return None
+                        result = await self._build_result(original_size, output_path, preset, action)
+                        return self._with_target(result, target_size, '1-pass VBV')
+            
+            cmd = self._ffmpeg_cmd(input_path, output_path, preset, audio_args, rate, fragmented)
+            
+            started = asyncio.get_event_loop().time()
+            if not await self._run_ffmpeg(cmd, output_path, user_id, duration, progress_callback):
+                return None
+            # Sólo el encode simple mide la velocidad propia del escalón (sin segmentos ni pasadas)
+            encoder_policy.record(preset['encoder']['rung'], quality, duration,
+                                  asyncio.get_event_loop().time() - started)
+            result = await self._build_result(original_size, output_path, preset, action)
+            return self._with_target(result, target_size, '1-pass VBV')
+                
+        except Exception as e:
+            print(f"Compression error: {e}")
+            return None
+    
+    async def compress_stream(self, stream, output_path, user_id, quality='360p', progress_callback=None,
+                              duration=0, input_size=0, target_size=None, fragmented=False):
+        """
+        Igual que compress_video, pero FFmpeg lee la entrada por stdin mientras se
+        descarga (`stream` es un MediaStream), sin escribir el original a disco.
+        En modo tamaño objetivo sólo se puede hacer una pasada (con tope VBV), y no
+        hay análisis de CRF: needs_file() deja esos encodes para la descarga a disco.
+        """
+        try:
+            if self.should_cancel(user_id):
+                await stream.aclose()
+                return None
+            
+            info = stream.info or await media_probe.probe(data=stream.head, size=input_size)
+            if not duration and info:
+                duration = info.duration
+            
+            preset = QUALITY_PRESETS.get(quality, QUALITY_PRESETS['360p'])
+            
+            action = self.plan(info, quality, target_size)
+            print(f"🔎 Acción elegida (streaming): {action}")
+            if action == 'passthrough':
+                # Nada que hacer: se corta la descarga y se reenvía el original
+                await stream.aclose()
+                return self._with_target(self._original_result(input_size, preset, duration, action), target_size)
+            if action == 'encode':
+                preset = encoder_policy.apply(quality, preset, duration, target_size)
+            if action in ('remux', 'audio'):
+                cmd = self._remux_cmd('pipe:0', output_path, info, fragmented)
+            elif target_size:
+                video_bps, audio_args = self.target_rate(info, duration, target_size)
+                cmd = self._ffmpeg_cmd('pipe:0', output_path, preset, audio_args, {'bitrate': video_bps}, fragmented)
             else:
-                cmd.extend(['-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2:flags=fast_bilinear'])
+                cmd = self._ffmpeg_cmd('pipe:0', output_path, preset, self._audio_args(info), fragmented=fragmented)
             
-            if preset['bitrate']:
-                cmd.extend(['-b:v', preset['bitrate']])
+            # Sin duración conocida el progreso se estima por bytes entregados a FFmpeg
+            fallback_progress = None
+            if duration <= 0:
+                duration = 1
+                if input_size:
+                    fallback_progress = lambda: stream.bytes_read / input_size
             
-            cmd.extend([
-                '-progress', 'pipe:1',
-                '-y',
-                '-loglevel', 'error',
-                output_path
-            ])
+            ok = await self._run_ffmpeg(
+                cmd, output_path, user_id, duration, progress_callback,
+                input_stream=stream, fallback_progress=fallback_progress
+            )
+            if not ok:
+                return None
+            result = await self._build_result(input_size or stream.bytes_read, output_path, preset, action)
+            return self._with_target(result, target_size, '1-pass VBV')
+        
+        except Exception as e:
+            print(f"Compression error: {e}")
+            return None
+    
+    async def preview(self, input_path, work_dir, user_id, qualities=PREVIEW_QUALITIES, workers=1):
+        """
+        Codifica un clip de PREVIEW_LENGTH segundos del medio del video con cada calidad
+        (hasta `workers` a la vez), con los mismos parámetros que tendría el encode
+        completo ahora. Devuelve {calidad: {'path', 'size', 'projected_size', 'action'}}:
+        el tamaño final se proyecta con el bitrate de la muestra y la duración del video.
+        Las calidades que no necesitan encode ('passthrough', 'remux', 'audio') no
+        tienen clip y proyectan el tamaño del original.
+        """
+        info = await media_probe.probe(input_path)
+        original_size = get_file_size(input_path)
+        duration = info.duration if info else 0
+        length = min(PREVIEW_LENGTH, duration) if duration > 0 else PREVIEW_LENGTH
+        start = max(duration / 2 - length / 2, 0)
+        audio_args = self._audio_args(info)
+        os.makedirs(work_dir, exist_ok=True)
+        pool = asyncio.Semaphore(max(workers, 1))
+        
+        async def encode(quality):
+            action = self.plan(info, quality)
+            if action != 'encode':
+                return {'path': None, 'size': 0, 'projected_size': original_size, 'action': action}
+            # Los clips no se entregan: no cuentan como elecciones de encoder
+            preset = encoder_policy.apply(quality, QUALITY_PRESETS[quality], duration, count=False)
+            clip = os.path.join(work_dir, f"preview_{quality}.mp4")
+            cmd = ['ffmpeg', '-ss', f"{start:.2f}", '-t', f"{length:.2f}", '-i', input_path]
+            cmd.extend(self.encode_args(preset, threads=FFMPEG_THREADS, audio_args=audio_args))
+            cmd.extend(['-movflags', '+faststart', '-progress', 'pipe:1', '-y', '-loglevel', 'error', clip])
+            async with pool:
+                if not await self._run_ffmpeg(cmd, clip, user_id, length, None):
+                    return None
+            size = get_file_size(clip)
+            projected = size * duration / length if duration > length else size
+            return {'path': clip, 'size': size, 'projected_size': int(projected), 'action': action}
+        
+        results = await asyncio.gather(*(encode(quality) for quality in qualities))
+        previews = {quality: result for quality, result in zip(qualities, results) if result}
+        print(f"👀 Vista previa: {len(previews)} calidades, clip de {length:.0f}s desde {start:.0f}s")
+        return previews
+    
+    async def _encode_two_pass(self, input_path, output_path, user_id, preset, duration,
+                               audio_args, rate, progress_callback, fragmented=False):
+        """Dos pasadas de x265: la primera (rápida, sin audio) sólo genera estadísticas."""
+        stats_path = output_path + ".x265.log"
+        try:
+            first = dict(rate, **{'pass': 1, 'stats': stats_path})
+            cmd = ['ffmpeg', '-i', input_path]
+            cmd.extend(self.encode_args(preset, threads=FFMPEG_THREADS, audio_args=['-an'], rate=first))
+            cmd.extend(['-progress', 'pipe:1', '-y', '-loglevel', 'error', '-f', 'null', '-'])
+            # La salida de la primera pasada es el archivo de estadísticas
+            ok = await self._run_ffmpeg(
+                cmd, stats_path, user_id, duration, scaled_progress(progress_callback, 0, 0.3)
+            )
+            if not ok:
+                return False
             
-            # Use subprocess for better control on large files
-            proc = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
+            second = dict(rate, **{'pass': 2, 'stats': stats_path})
+            cmd = self._ffmpeg_cmd(input_path, output_path, preset, audio_args, second, fragmented)
+            return await self._run_ffmpeg(
+                cmd, output_path, user_id, duration, scaled_progress(progress_callback, 0.3, 0.7)
             )
+        finally:
+            for path in (stats_path, stats_path + ".cutree", stats_path + ".temp"):
+                if os.path.exists(path):
+                    os.remove(path)
+    
+    def _with_target(self, result, target_size, rate_control=None):
+        """Añade al resultado cuánto se desvió del tamaño objetivo."""
+        if result and target_size:
+            result['target_size'] = target_size
+            result['target_size_str'] = format_bytes(target_size)
+            result['target_deviation'] = (result['compressed_size'] - target_size) / target_size * 100
+            if rate_control and not result.get('use_original'):
+                result['rate_control'] = rate_control
+        return result
+    
+    async def _compress_segmented(self, input_path, output_path, user_id, preset, duration,
+                                  segments, workers, progress_callback, audio_args=None, rate=None,
+                                  fragmented=False):
+        """
+        Corta el video en keyframes (copia de stream), codifica los segmentos en paralelo
+        con los mismos parámetros y los une sin recodificar, con el audio del original.
+        """
+        work_dir = output_path + ".segments"
+        os.makedirs(work_dir, exist_ok=True)
+        try:
+            print(f"🧩 Encode por segmentos: {segments} segmentos, {workers} en paralelo")
+            
+            split_cmd = [
+                'ffmpeg', '-i', input_path,
+                '-map', '0:v:0', '-c', 'copy',
+                '-f', 'segment',
+                '-segment_time', f"{duration / segments:.3f}",
+                '-segment_format', 'matroska',
+                '-reset_timestamps', '1',
+                '-y', '-loglevel', 'error',
+                os.path.join(work_dir, 'part_%03d.mkv')
+            ]
+            if not await self._run_simple(split_cmd, user_id, duration):
+                return False
+            
+            parts = sorted(f for f in os.listdir(work_dir) if f.startswith('part_'))
+            if not parts:
+                return False
+            
+            encoded = [os.path.join(work_dir, f"enc_{i:03d}.mkv") for i in range(len(parts))]
+            times = [0.0] * len(parts)
+            pool = asyncio.Semaphore(workers)
+            
+            async def encode_part(i):
+                async with pool:
+                    cmd = ['ffmpeg', '-i', os.path.join(work_dir, parts[i])]
+                    cmd.extend(self.encode_args(preset, threads=FFMPEG_THREADS, rate=rate))
+                    cmd.extend(['-an', '-progress', 'pipe:1', '-y', '-loglevel', 'error', encoded[i]])
+                    return await self._run_ffmpeg(
+                        cmd, encoded[i], user_id, duration, None,
+                        on_time=lambda t: times.__setitem__(i, t)
+                    )
+            
+            async def report_progress():
+                # Progreso agregado: suma de lo codificado en todos los segmentos
+                start_time = asyncio.get_event_loop().time()
+                last_update = 0
+                while True:
+                    await asyncio.sleep(1)
+                    progress = min(sum(times) / duration, 1.0)
+                    if progress_callback and (progress - last_update >= 0.02 or progress >= 0.99):
+                        elapsed = int(asyncio.get_event_loop().time() - start_time)
+                        current_size = sum(get_file_size(p) for p in encoded if os.path.exists(p))
+                        print(f"🎬 Comprimiendo (segmentos)... {progress*100:.1f}% | ⏱️ {elapsed}s | 📦 {format_bytes(current_size)}")
+                        await progress_callback(progress, elapsed, current_size)
+                        last_update = progress
+            
+            tasks = [asyncio.create_task(encode_part(i)) for i in range(len(parts))]
+            reporter = asyncio.create_task(report_progress())
+            try:
+                for finished in asyncio.as_completed(tasks):
+                    if not await finished:
+                        return False
+            finally:
+                reporter.cancel()
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, reporter, return_exceptions=True)
+            
+            list_path = os.path.join(work_dir, 'list.txt')
+            with open(list_path, 'w') as f:
+                for path in encoded:
+                    f.write(f"file '{os.path.abspath(path)}'\n")
+            
+            concat_cmd = [
+                'ffmpeg',
+                '-f', 'concat', '-safe', '0', '-i', list_path,
+                '-i', input_path,
+                '-map', '0:v:0', '-map', '1:a?',
+                '-vcodec', 'copy'
+            ]
+            concat_cmd.extend(audio_args or ['-acodec', 'copy'])
+            if fragmented:
+                concat_cmd.extend(FRAGMENTED_MOVFLAGS)
+            concat_cmd.extend([
+                '-y', '-loglevel', 'error',
+                output_path
+            ])
+            if not await self._run_simple(concat_cmd, user_id, duration):
+                return False
             
+            if progress_callback:
+                await progress_callback(1.0, 0, get_file_size(output_path))
+            return os.path.exists(output_path)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    
+    async def _run_simple(self, cmd, user_id, duration):
+        """Copia de streams sin seguimiento de progreso (corte/unión); True si terminó bien."""
+        returncode, _, stderr = await supervisor.run(
+            cmd, 'bulk', timeout=COPY_TIMEOUT_BASE + duration / COPY_MIN_SPEED, token=self.cancel_token(user_id)
+        )
+        if returncode != 0:
+            print(f"FFmpeg error: {stderr}")
+        return returncode == 0
+    
+    async def _feed_stdin(self, proc, stream):
+        try:
+            async for chunk in stream:
+                proc.stdin.write(chunk)
+                await proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # FFmpeg terminó antes de consumir toda la entrada
+            pass
+        finally:
+            await stream.aclose()
+            try:
+                proc.stdin.close()
+            except Exception:
+                pass
+    
+    async def _kill_on_cancel(self, proc, token):
+        await token.wait()
+        await proc.kill()
+    
+    async def _run_ffmpeg(self, cmd, output_path, user_id, duration, progress_callback,
+                          input_stream=None, fallback_progress=None, on_time=None):
+        # Los clips cortos pasan por delante de los videos largos; cada encode en sus CPUs
+        proc = await supervisor.spawn(
+            cmd, supervisor.priority_for(duration), stdin=input_stream is not None, stdout=True, pin=True
+        )
+        # /cancel mata a FFmpeg en el acto, sin esperar a su próxima línea de progreso
+        killer = asyncio.create_task(self._kill_on_cancel(proc, self.cancel_token(user_id)))
+        try:
+            feeder = asyncio.create_task(self._feed_stdin(proc, input_stream)) if input_stream else None
+        
+            async def abort():
+                await proc.kill()
+                if feeder:
+                    feeder.cancel()
+                if os.path.exists(output_path):
+                    try:
+                        os.remove(output_path)
+                    except:
+                        pass
+        
             last_update = 0
+            fps = 0
+            speed = 0
             start_time = asyncio.get_event_loop().time()
             while True:
                 if self.should_cancel(user_id):
-                    proc.kill()
-                    try:
-                        await asyncio.wait_for(proc.wait(), timeout=2)
-                    except:
-                        pass
-                    if os.path.exists(output_path):
-                        try:
-                            os.remove(output_path)
-                        except:
-                            pass
-                    return None
-                
+                    await abort()
+                    return False
+            
                 try:
                     line = await asyncio.wait_for(proc.stdout.readline(), timeout=300)
                 except asyncio.TimeoutError:
                     print("Compression timeout - killing process")
-                    proc.kill()
-                    return None
-                    
+                    await abort()
+                    return False
+                except asyncio.CancelledError:
+                    # No dejar procesos huérfanos si se cancela la tarea (p. ej. otro segmento falló)
+                    await abort()
+                    raise
+                
                 if not line:
                     break
-                
+            
                 try:
                     line = line.decode('utf-8').strip()
                 except:
                     continue
-                
+            
                 if line.startswith('out_time_ms='):
                     try:
                         time_ms = int(line.split('=')[1])
                         time_s = time_ms / 1000000.0
-                        progress = min(time_s / duration, 1.0)
-                        
+                        if on_time:
+                            on_time(time_s)
+                        if fallback_progress:
+                            progress = min(fallback_progress(), 1.0)
+                        else:
+                            progress = min(time_s / duration, 1.0)
+                    
                         if progress_callback and (progress - last_update >= 0.02 or progress >= 0.99):
                             current_time = asyncio.get_event_loop().time()
                             elapsed = int(current_time - start_time)
                             current_size = get_file_size(output_path) if os.path.exists(output_path) else 0
-                            
+                        
                             # Calcular velocidad de compresión
                             speed_mbs = (current_size / (1024 * 1024)) / max(elapsed, 1) if elapsed > 0 else 0
-                            
+                        
                             # Mostrar en consola
                             print(f"🎬 Comprimiendo... {progress*100:.1f}% | ⏱️ {elapsed}s | 🎛️ {speed_mbs:.2f} MB/s | 📦 {format_bytes(current_size)}")
-                            
+                        
                             await progress_callback(progress, elapsed, current_size)
                             last_update = progress
                     except:
                         pass
-            
+                elif line.startswith('fps=') or line.startswith('speed='):
+                    # Promedios de toda la ejecución; 'N/A' hasta el primer frame
+                    key, _, value = line.partition('=')
+                    try:
+                        value = float(value.rstrip('x'))
+                    except ValueError:
+                        continue
+                    if key == 'fps':
+                        fps = value
+                    else:
+                        speed = value
+        
             await proc.wait()
-            
+            if self.should_cancel(user_id):
+                await abort()
+                return False
+            if feeder:
+                # Un fallo de la descarga invalida el encode aunque FFmpeg haya terminado bien
+                try:
+                    await feeder
+                except Exception as e:
+                    print(f"Error en la descarga en streaming: {e}")
+                    return False
+        
             # Log final de compresión
             final_time = asyncio.get_event_loop().time() - start_time
             if os.path.exists(output_path):
@@ -185,38 +766,64 @@ class VideoCompressor:
                 final_speed = (final_size / (1024 * 1024)) / max(final_time, 1)
                 print(f"✅ Compresión completada | ⏱️ {int(final_time)}s | 🎛️ {final_speed:.2f} MB/s | 📦 {format_bytes(final_size)}")
             
-            if proc.returncode == 0 and os.path.exists(output_path):
-                out_duration = 0
-                try:
-                    result = await asyncio.create_subprocess_exec(
-                        'ffprobe', '-v', 'error', '-show_format', '-of', 'json', output_path,
-                        stdout=asyncio.subprocess.PIPE,
-                        stderr=asyncio.subprocess.PIPE
-                    )
-                    stdout, _ = await result.communicate()
-                    probe_out = json.loads(stdout)
-                    out_duration = float(probe_out['format'].get('duration', 0))
-                except:
-                    out_duration = 0
-                
-                compressed_size = get_file_size(output_path)
-                reduction = ((original_size - compressed_size) / original_size * 100) if original_size > 0 else 0
-                
-                return {
-                    'success': True,
-                    'original_size': original_size,
-                    'compressed_size': compressed_size,
-                    'reduction': reduction,
-                    'original_size_str': format_bytes(original_size),
-                    'compressed_size_str': format_bytes(compressed_size),
-                    'duration': out_duration,
-                    'quality': preset['name']
-                }
-            else:
-                return None
-                
-        except Exception as e:
-            print(f"Compression error: {e}")
-            return None
+            # Los remux (-vcodec copy) no dicen nada de la velocidad del encoder
+            remux = '-vcodec' in cmd and cmd[cmd.index('-vcodec') + 1] == 'copy'
+            if proc.returncode == 0 and not remux:
+                if speed > 0:
+                    metrics.encode_speed.observe(speed)
+                if fps > 0:
+                    metrics.encode_fps.observe(fps)
+        
+            if proc.returncode != 0:
+                print(f"FFmpeg error: {proc.stderr_tail()}")
+            return proc.returncode == 0 and os.path.exists(output_path)
+        finally:
+            killer.cancel()
+            # Pase lo que pase (error, cancelación de la tarea) no queda un FFmpeg suelto
+            await proc.reap()
+    
+    def _original_result(self, original_size, preset, duration, action):
+        """Resultado cuando se devuelve el archivo original en lugar de una versión nueva."""
+        return {
+            'success': True,
+            'original_size': original_size,
+            'compressed_size': original_size,
+            'reduction': 0,
+            'original_size_str': format_bytes(original_size),
+            'compressed_size_str': format_bytes(original_size),
+            'duration': duration,
+            'quality': preset['name'],
+            'action': action,
+            'encoder': preset.get('encoder'),
+            'use_original': True
+        }
+    
+    async def _build_result(self, original_size, output_path, preset, action='encode'):
+        compressed_size = get_file_size(output_path)
+        with tracer.span('probe_output'):
+            info = await media_probe.probe(output_path)
+        out_duration = info.duration if info else 0
+        
+        if original_size > 0 and compressed_size >= original_size:
+            # Nunca se devuelve un "comprimido" más grande que el original
+            print(f"⚠️ Resultado ({format_bytes(compressed_size)}) no menor que el original: se reenvía el original")
+            return self._original_result(original_size, preset, out_duration, action)
+        
+        reduction = ((original_size - compressed_size) / original_size * 100) if original_size > 0 else 0
+        
+        return {
+            'success': True,
+            'original_size': original_size,
+            'compressed_size': compressed_size,
+            'reduction': reduction,
+            'original_size_str': format_bytes(original_size),
+            'compressed_size_str': format_bytes(compressed_size),
+            'duration': out_duration,
+            'width': info.width if info else 0,
+            'height': info.height if info else 0,
+            'quality': preset['name'],
+            'action': action,
+            'encoder': preset.get('encoder')
+        }
 
 compressor = VideoCompressor()
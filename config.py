@@ -14,5 +14,130 @@ MAX_FILE_SIZE = 2000 * 1024 * 1024
 CONCURRENT_DOWNLOADS = 10
 WORKER_THREADS = 4
 
-if not os.path.exists(DOWNLOAD_DIR):
-    os.makedirs(DOWNLOAD_DIR)
+def _available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+CPU_COUNT = _available_cpus()
+
+# Scheduler global: x265 ultrafast apenas escala más allá de unos pocos hilos,
+# así que es mejor varios encodes simultáneos con pocos hilos cada uno
+FFMPEG_THREADS_PER_JOB = int(os.getenv("FFMPEG_THREADS_PER_JOB", "4"))
+ENCODE_SLOTS = int(os.getenv("ENCODE_SLOTS", str(max(1, CPU_COUNT // FFMPEG_THREADS_PER_JOB))))
+FFMPEG_THREADS = max(1, CPU_COUNT // ENCODE_SLOTS)
+# Supervisor de FFmpeg: clips de hasta esta duración (s) van con prioridad interactiva,
+# cada encode en su propio grupo de CPUs y, opcionalmente, memoria/CPU acotadas
+# (FFMPEG_CGROUP: cgroup v2 delegado al bot; sin él la memoria se limita con RLIMIT_AS)
+FFMPEG_INTERACTIVE_MAX_DURATION = int(os.getenv("FFMPEG_INTERACTIVE_MAX_DURATION", "180"))
+FFMPEG_PIN_CPUS = os.getenv("FFMPEG_PIN_CPUS", "1") == "1"
+FFMPEG_MEMORY_LIMIT = int(os.getenv("FFMPEG_MEMORY_LIMIT_MB", "0")) * 1024 * 1024
+FFMPEG_CPU_QUOTA = float(os.getenv("FFMPEG_CPU_QUOTA", "0"))
+FFMPEG_CGROUP = os.getenv("FFMPEG_CGROUP", "")
+DOWNLOAD_SLOTS = int(os.getenv("DOWNLOAD_SLOTS", "4"))
+UPLOAD_SLOTS = int(os.getenv("UPLOAD_SLOTS", "4"))
+MAX_ACTIVE_JOBS = int(os.getenv("MAX_ACTIVE_JOBS", str(DOWNLOAD_SLOTS + ENCODE_SLOTS + UPLOAD_SLOTS)))
+MAX_JOBS_PER_USER = int(os.getenv("MAX_JOBS_PER_USER", "1"))
+
+# Orden de la cola: 'sjf' (primero lo más corto según el modelo de costos, con
+# reparto justo entre usuarios y envejecimiento) o 'rr' (round-robin por usuario)
+SCHED_POLICY = os.getenv("SCHED_POLICY", "sjf")
+SCHED_AGING = float(os.getenv("SCHED_AGING", "1.0"))
+SCHED_SHARE_HALFLIFE = int(os.getenv("SCHED_SHARE_HALFLIFE", "1800"))
+
+# Comprimir mientras se descarga (MP4 con moov al inicio, MKV, FLV, TS)
+STREAMING_DOWNLOAD = os.getenv("STREAMING_DOWNLOAD", "1") == "1"
+
+# Encode por segmentos en paralelo para videos largos (segundos)
+SEGMENTED_ENCODE = os.getenv("SEGMENTED_ENCODE", "1") == "1"
+SEGMENT_MIN_DURATION = int(os.getenv("SEGMENT_MIN_DURATION", "600"))
+SEGMENT_MIN_LENGTH = int(os.getenv("SEGMENT_MIN_LENGTH", "120"))
+MAX_SEGMENTS = int(os.getenv("MAX_SEGMENTS", "8"))
+
+# Descarga por rangos en paralelo (varias conexiones de media) para archivos grandes
+PARALLEL_DOWNLOAD = os.getenv("PARALLEL_DOWNLOAD", "1") == "1"
+PARALLEL_DOWNLOAD_MIN = int(os.getenv("PARALLEL_DOWNLOAD_MIN_MB", "20")) * 1024 * 1024
+PARALLEL_DOWNLOAD_CONNECTIONS = int(os.getenv("PARALLEL_DOWNLOAD_CONNECTIONS", "4"))
+PARALLEL_DOWNLOAD_RANGE = int(os.getenv("PARALLEL_DOWNLOAD_RANGE_MB", "16")) * 1024 * 1024
+# Enlaces de /url y de la API hacia la red local o interna (por defecto sólo direcciones públicas)
+URL_ALLOW_PRIVATE = os.getenv("URL_ALLOW_PRIVATE", "0") == "1"
+
+# Subida de resultados grandes repartida entre varias conexiones de media
+PARALLEL_UPLOAD = os.getenv("PARALLEL_UPLOAD", "1") == "1"
+UPLOAD_CONNECTIONS = int(os.getenv("UPLOAD_CONNECTIONS", "4"))
+
+# Subir mientras se comprime: salida en MP4 fragmentado y partes enviadas según crece
+STREAMING_UPLOAD = os.getenv("STREAMING_UPLOAD", "0") == "1"
+STREAM_UPLOAD_WORKERS = int(os.getenv("STREAM_UPLOAD_WORKERS", "4"))
+
+# Modo tamaño objetivo (/size): dos pasadas sólo hasta esta duración (segundos)
+TWO_PASS_MAX_DURATION = int(os.getenv("TWO_PASS_MAX_DURATION", "900"))
+TARGET_SIZE_OPTIONS = [50, 200]
+MAX_TARGET_SIZE_MB = 2000
+
+# Vista previa: clip de PREVIEW_LENGTH s por calidad antes del encode completo; si el
+# usuario no elige en PREVIEW_TIMEOUT s se sigue con la calidad predeterminada
+PREVIEW_LENGTH = int(os.getenv("PREVIEW_LENGTH", "5"))
+PREVIEW_TIMEOUT = int(os.getenv("PREVIEW_TIMEOUT", "120"))
+
+# Encoder adaptativo: presets lentos de x265 con la máquina libre, rápidos o x264 con cola
+ADAPTIVE_ENCODER = os.getenv("ADAPTIVE_ENCODER", "1") == "1"
+POLICY_BACKLOG = float(os.getenv("POLICY_BACKLOG", "3"))
+POLICY_SLOW_MAX_DURATION = int(os.getenv("POLICY_SLOW_MAX_DURATION", "600"))
+POLICY_MIN_SPEED = float(os.getenv("POLICY_MIN_SPEED", "1.0"))
+
+# CRF por video: encodes de muestra a varios CRF antes del encode completo, usando
+# como mucho esta fracción del tiempo estimado del encode
+CRF_ANALYSIS = os.getenv("CRF_ANALYSIS", "1") == "1"
+CRF_ANALYSIS_BUDGET = float(os.getenv("CRF_ANALYSIS_BUDGET", "0.1"))
+
+# Spool: un directorio por trabajo, reserva de disco y expulsión LRU de huérfanos
+SPOOL_DIR = os.path.join(DOWNLOAD_DIR, "jobs")
+SPOOL_MIN_FREE = int(os.getenv("SPOOL_MIN_FREE_MB", "1024")) * 1024 * 1024
+SPOOL_MAX_AGE = int(os.getenv("SPOOL_MAX_AGE", str(6 * 3600)))
+SPOOL_SCAN_INTERVAL = int(os.getenv("SPOOL_SCAN_INTERVAL", "300"))
+SPOOL_MAX_WAIT = int(os.getenv("SPOOL_MAX_WAIT", "1800"))
+
+# Ediciones de mensajes de estado: Telegram tolera ~1 mensaje/s por chat y ~30/s en total
+STATUS_CHAT_RATE = float(os.getenv("STATUS_CHAT_RATE", "0.5"))
+STATUS_CHAT_BURST = int(os.getenv("STATUS_CHAT_BURST", "3"))
+STATUS_GLOBAL_RATE = float(os.getenv("STATUS_GLOBAL_RATE", "20"))
+STATUS_GLOBAL_BURST = int(os.getenv("STATUS_GLOBAL_BURST", "20"))
+
+# Datos persistentes (fuera de DOWNLOAD_DIR para que /cache no los borre)
+DATA_DIR = os.getenv("DATA_DIR", "data")
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", os.path.join(DATA_DIR, "results.db"))
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", os.path.join(DATA_DIR, "jobs.db"))
+JOB_RETENTION = int(os.getenv("JOB_RETENTION", str(7 * 24 * 3600)))
+
+# Workers de encode: 'local' comprime en este proceso; 'broker' encola los encodes
+# para procesos worker.py (misma máquina vía SQLite u otras vía HTTP con WORKER_TOKEN)
+ENCODE_BACKEND = os.getenv("ENCODE_BACKEND", "local")
+BROKER_DB_PATH = os.getenv("BROKER_DB_PATH", os.path.join(DATA_DIR, "broker.db"))
+WORKER_TOKEN = os.getenv("WORKER_TOKEN", "")
+WORKER_HEARTBEAT = int(os.getenv("WORKER_HEARTBEAT", "10"))
+WORKER_TIMEOUT = int(os.getenv("WORKER_TIMEOUT", "60"))
+TASK_MAX_ATTEMPTS = int(os.getenv("TASK_MAX_ATTEMPTS", "3"))
+
+# API HTTP de trabajos (/api/jobs) para herramientas internas; sólo se publica con API_TOKEN.
+# API_PATHS: directorios (separados por ':') donde la API puede leer entradas y dejar salidas
+API_TOKEN = os.getenv("API_TOKEN", "")
+API_PATHS = [os.path.realpath(path) for path in os.getenv("API_PATHS", "").split(os.pathsep) if path]
+API_OUTPUT_DIR = os.getenv("API_OUTPUT_DIR", os.path.join(DATA_DIR, "api"))
+API_JOBS_PER_CLIENT = int(os.getenv("API_JOBS_PER_CLIENT", str(ENCODE_SLOTS)))
+API_RESULT_TTL = int(os.getenv("API_RESULT_TTL", str(24 * 3600)))
+
+# Trazas por trabajo para /stats y /trace: las últimas TRACE_JOBS en memoria y, con
+# TRACE_LOG_PATH, una línea JSON por trabajo en disco (rota al pasar TRACE_LOG_MAX_MB)
+TRACE_JOBS = int(os.getenv("TRACE_JOBS", "200"))
+TRACE_LOG_PATH = os.getenv("TRACE_LOG_PATH", "")
+TRACE_LOG_MAX = int(os.getenv("TRACE_LOG_MAX_MB", "20")) * 1024 * 1024
+# Trabajos que resume /stats
+STATS_WINDOW = int(os.getenv("STATS_WINDOW", "100"))
+# Usuarios de Telegram (ids separados por comas) que pueden usar /trace
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if user_id}
+
+for directory in (DOWNLOAD_DIR, DATA_DIR):
+    if not os.path.exists(directory):
+        os.makedirs(directory)
@@ -0,0 +1,158 @@
+import heapq
+import time
+from queue_manager import queue_manager
+from config import ENCODE_SLOTS, TWO_PASS_MAX_DURATION
+
+# Valores de partida hasta tener mediciones propias (se ajustan con cada trabajo)
+DEFAULT_DOWNLOAD_RATE = 3 * 1024 * 1024
+DEFAULT_UPLOAD_RATE = 3 * 1024 * 1024
+DEFAULT_INPUT_BITRATE = 2500000
+# Velocidad de encode (x tiempo real a 30 fps) según la altura de la entrada
+DEFAULT_ENCODE_SPEED = {'sd': 3.0, 'hd': 1.5, 'fhd': 0.8, 'uhd': 0.3}
+# Tamaño de salida / tamaño de entrada por calidad
+DEFAULT_SIZE_RATIO = {'240p': 0.15, '360p': 0.25, '480p': 0.35, '720p': 0.5, 'original': 0.7}
+# Costo relativo de decodificar cada códec de entrada (h264 = 1)
+CODEC_FACTOR = {'hevc': 1.3, 'vp9': 1.3, 'av1': 1.6, 'mpeg4': 0.9}
+# Códec probable según el mime_type de Telegram o del enlace, mientras no hay probe
+MIME_CODECS = {'video/webm': 'vp9'}
+# Dos pasadas del modo tamaño objetivo frente a un encode simple
+TWO_PASS_FACTOR = 1.4
+EWMA_ALPHA = 0.3
+
+def height_bucket(height):
+    if height <= 0 or height <= 480:
+        return 'sd'
+    if height <= 720:
+        return 'hd'
+    if height <= 1080:
+        return 'fhd'
+    return 'uhd'
+
+class CostModel:
+    """
+    Estima cuánto tarda cada etapa de un trabajo (descarga, encode, subida) a partir
+    de los metadatos del video y de las velocidades medidas en los últimos trabajos
+    de esta máquina. Alimenta el orden de la cola y el tiempo estimado que se le
+    muestra al usuario al recibir el video.
+    """
+    def __init__(self):
+        self.rates = {'download': DEFAULT_DOWNLOAD_RATE, 'upload': DEFAULT_UPLOAD_RATE}
+        self.input_bitrate = DEFAULT_INPUT_BITRATE
+        self.encode_speeds = {}
+        self.size_ratios = dict(DEFAULT_SIZE_RATIO)
+
+    def _ewma(self, previous, value):
+        return previous + EWMA_ALPHA * (value - previous)
+
+    def features(self, job):
+        """
+        Lo que se sabe del video: metadatos de Telegram o del enlace antes de descargarlo
+        y, cuando ya hay un probe (job.info o el de un archivo local), sus fps y códec,
+        igual que en observe_encode.
+        """
+        media = job.media
+        info = job.info or getattr(media, 'info', None)
+        size = getattr(media, 'file_size', 0) or 0
+        duration = getattr(media, 'duration', 0) or (info.duration if info else 0)
+        if not duration and size:
+            # Los documentos no traen duración: se deduce del bitrate habitual
+            duration = size * 8 / self.input_bitrate
+        if info and info.video_codec:
+            codec = info.video_codec
+        else:
+            mime_type = getattr(media, 'mime_type', None) or getattr(media, 'content_type', None) or ''
+            codec = MIME_CODECS.get(mime_type.lower())
+        return {
+            'size': size,
+            'duration': duration,
+            'height': getattr(media, 'height', 0) or (info.height if info else 0),
+            'fps': (info.fps if info else 0) or 30,
+            'codec': codec
+        }
+
+    def encode_speed(self, quality, height):
+        key = (quality, height_bucket(height))
+        return self.encode_speeds.get(key, DEFAULT_ENCODE_SPEED[key[1]])
+
+    def predict(self, job, features=None):
+        """Segundos estimados por etapa: {'download', 'encode', 'upload', 'total'}."""
+        features = features or self.features(job)
+        size = features['size']
+        work = features['duration'] * features['fps'] / 30 * CODEC_FACTOR.get(features['codec'], 1.0)
+        encode = work / self.encode_speed(job.quality, features['height'])
+        output = size * self.size_ratios.get(job.quality, DEFAULT_SIZE_RATIO['360p'])
+        if job.target_size:
+            if features['duration'] <= TWO_PASS_MAX_DURATION:
+                # Los más largos van en una pasada con tope VBV
+                encode *= TWO_PASS_FACTOR
+            output = min(output, job.target_size * 1024 * 1024)
+        estimate = {
+            'download': size / self.rates['download'],
+            'encode': encode,
+            'upload': output / self.rates['upload']
+        }
+        estimate['total'] = sum(estimate.values())
+        return estimate
+
+    def job_cost(self, job):
+        """Costo con el que el scheduler ordena la cola (segundos de trabajo total)."""
+        return self.predict(job)['total']
+
+    def eta(self, job):
+        """Posición en la cola, espera hasta empezar y duración estimadas para `job` (en cola o por encolar)."""
+        now = time.time()
+        # El encode es el cuello de botella: lo que queda de los trabajos en curso y
+        # el encode de los que van delante se asignan al slot de encode que se libera
+        # antes; el trabajo empieza cuando queda uno libre
+        slots = [0.0] * max(ENCODE_SLOTS, 1)
+        for running in queue_manager.active_jobs.values():
+            remaining = self.predict(running)['total'] - (now - (running.started_at or now))
+            heapq.heapreplace(slots, slots[0] + max(remaining, 0))
+        order = queue_manager.pending_order()
+        if job not in order:
+            order = queue_manager.pending_order(extra=job)
+        position = order.index(job)
+        for ahead in order[:position]:
+            heapq.heapreplace(slots, slots[0] + self.predict(ahead)['encode'])
+        return {
+            'position': position,
+            'wait': slots[0],
+            'duration': self.predict(job)['total']
+        }
+
+    def observe_transfer(self, direction, size, elapsed):
+        """Velocidad de una descarga ('download') o subida ('upload') terminada."""
+        if size <= 0 or elapsed <= 0.5:
+            return
+        self.rates[direction] = self._ewma(self.rates[direction], size / elapsed)
+
+    def observe_encode(self, quality, info, elapsed, result=None):
+        """
+        Velocidad de un encode terminado, normalizada a 30 fps y al códec de entrada.
+        `result` dice cómo se hizo: sólo las dos pasadas cuentan doble trabajo, el
+        análisis de CRF se descuenta y los encodes por segmentos no se miden (su
+        velocidad es la de varios slots a la vez).
+        """
+        if info is None or info.duration <= 1:
+            return
+        encoder = (result or {}).get('encoder') or {}
+        if encoder.get('segments', 1) > 1:
+            return
+        elapsed -= (encoder.get('crf_analysis') or {}).get('seconds', 0)
+        if elapsed <= 0:
+            return
+        work = info.duration * (info.fps or 30) / 30 * CODEC_FACTOR.get(info.video_codec, 1.0)
+        if (result or {}).get('rate_control') == '2-pass':
+            work *= TWO_PASS_FACTOR
+        key = (quality, height_bucket(info.height))
+        speed = work / elapsed
+        self.encode_speeds[key] = self._ewma(self.encode_speeds.get(key, speed), speed)
+        if info.size and info.duration:
+            self.input_bitrate = self._ewma(self.input_bitrate, info.size * 8 / info.duration)
+
+    def observe_result(self, quality, result):
+        if result and result.get('original_size') and not result.get('target_size'):
+            ratio = result['compressed_size'] / result['original_size']
+            self.size_ratios[quality] = self._ewma(self.size_ratios.get(quality, ratio), ratio)
+
+cost_model = CostModel()
@@ -0,0 +1,173 @@
+import os
+import re
+import shutil
+import time
+from encoder_policy import encoder_policy
+from metrics import metrics
+from tracing import tracer
+from supervisor import supervisor
+from config import CRF_ANALYSIS, CRF_ANALYSIS_BUDGET, FFMPEG_THREADS
+
+# SSIM mínimo (salida vs. fuente escalada a la resolución del preset) por preset:
+# las calidades bajas toleran más pérdida porque ya sacrifican detalle al escalar
+SSIM_FLOORS = {
+    '240p': 0.90,
+    '360p': 0.93,
+    '480p': 0.95,
+    '720p': 0.96,
+    'original': 0.96
+}
+
+SAMPLE_WINDOWS = 3
+SAMPLE_LENGTH = 2
+CRF_STEP = 2
+MAX_CRF_UP = 6
+MAX_CRF_DOWN = 4
+
+class CrfAnalyzer:
+    """
+    Ajusta el CRF de cada video antes del encode completo: codifica unas ventanas
+    cortas del original a varios CRF y se queda con el más alto que cumple el SSIM
+    mínimo del preset. Un screencast estático sube de CRF (archivo más chico) y un
+    video con mucho movimiento baja. El análisis no pasa de CRF_ANALYSIS_BUDGET del
+    tiempo estimado del encode; si no alcanza, se usa el CRF del preset.
+
+    Sus FFmpeg van con prioridad 'background': el análisis es opcional, así que con
+    la máquina ocupada cede la CPU a los encodes y, si se queda sin presupuesto,
+    el trabajo sigue con el CRF del preset.
+    """
+    def _budget(self, quality, preset, duration):
+        """(presupuesto, costo de una prueba) en segundos, o None si el análisis no corre."""
+        if not CRF_ANALYSIS or SSIM_FLOORS.get(quality) is None or 'crf' not in preset:
+            return None
+        rung = (preset.get('encoder') or {}).get('rung')
+        speed = encoder_policy.expected_speed(rung, quality)
+        budget = CRF_ANALYSIS_BUDGET * duration / speed
+        trial_cost = SAMPLE_WINDOWS * SAMPLE_LENGTH / speed
+        # Referencia + al menos dos pruebas; si no entran, el análisis no compensa
+        if budget < 3 * trial_cost:
+            return None
+        return budget, trial_cost
+
+    def applies(self, quality, preset, duration):
+        """
+        True si tune() analizaría este encode. Las ventanas de muestra se toman a lo
+        largo de todo el video, así que hace falta el archivo en disco: el encode en
+        streaming no pasa por el análisis y el bot lo evita cuando esto es True.
+        """
+        return self._budget(quality, preset, duration) is not None
+
+    async def tune(self, input_path, work_path, quality, preset, duration, token=None):
+        """Devuelve el preset con el CRF elegido (y el detalle en preset['encoder'])."""
+        limits = self._budget(quality, preset, duration)
+        if limits is None:
+            return preset
+        budget, trial_cost = limits
+        floor = SSIM_FLOORS[quality]
+
+        work_dir = work_path + ".analysis"
+        os.makedirs(work_dir, exist_ok=True)
+        started = time.monotonic()
+        limits = (started + budget, token)
+        base = preset['crf']
+        trials = {}
+        try:
+            reference = os.path.join(work_dir, "reference.mkv")
+            if not await self._extract_reference(input_path, reference, preset, duration, limits):
+                return preset
+
+            async def score(crf):
+                if token and token.cancelled:
+                    return None
+                if time.monotonic() - started + trial_cost > budget:
+                    return None
+                trials[crf] = await self._trial(reference, work_dir, preset, crf, limits)
+                return trials[crf]
+
+            best = None
+            ssim = await score(base)
+            if ssim is not None and ssim >= floor:
+                best = base
+                crf = base + CRF_STEP
+                while crf <= min(base + MAX_CRF_UP, 51):
+                    ssim = await score(crf)
+                    if ssim is None or ssim < floor:
+                        break
+                    best = crf
+                    crf += CRF_STEP
+            elif ssim is not None:
+                crf = base - CRF_STEP
+                while crf >= max(base - MAX_CRF_DOWN, 0):
+                    ssim = await score(crf)
+                    if ssim is None:
+                        break
+                    best = crf
+                    if ssim >= floor:
+                        break
+                    crf -= CRF_STEP
+
+            elapsed = time.monotonic() - started
+            metrics.phase_duration.observe(elapsed, phase='crf_analysis')
+            tracer.record('crf_analysis', elapsed)
+            if best is None:
+                return preset
+            tuned = dict(preset)
+            tuned['crf'] = best
+            tuned['encoder'] = dict(preset.get('encoder') or {}, crf=best, crf_analysis={
+                'base_crf': base,
+                'ssim_floor': floor,
+                'trials': {str(crf): round(value, 4) for crf, value in trials.items() if value is not None},
+                'seconds': round(elapsed, 1)
+            })
+            print(f"🔬 CRF {base} -> {best} ({len(trials)} pruebas, {elapsed:.1f}s de {budget:.1f}s)")
+            return tuned
+        except Exception as e:
+            print(f"Error en el análisis de CRF: {e}")
+            return preset
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    async def _run(self, cmd, limits):
+        """FFmpeg del análisis: de fondo, sin pasarse del presupuesto y cortado por /cancel."""
+        deadline, token = limits
+        return await supervisor.run(cmd, 'background', timeout=max(deadline - time.monotonic(), 1), token=token)
+
+    async def _extract_reference(self, input_path, reference, preset, duration, limits):
+        """Une las ventanas de muestra, ya escaladas como en el encode, en un archivo sin pérdida."""
+        cmd = ['ffmpeg', '-y', '-loglevel', 'error']
+        for i in range(SAMPLE_WINDOWS):
+            start = duration * (i + 1) / (SAMPLE_WINDOWS + 1)
+            cmd.extend(['-ss', f"{start:.2f}", '-t', str(SAMPLE_LENGTH), '-i', input_path])
+        if preset['resolution']:
+            scale = f"scale={preset['resolution']}:flags=fast_bilinear"
+        else:
+            scale = 'scale=trunc(iw/2)*2:trunc(ih/2)*2:flags=fast_bilinear'
+        chains = ''.join(f"[{i}:v:0]{scale},setsar=1[v{i}];" for i in range(SAMPLE_WINDOWS))
+        inputs = ''.join(f"[v{i}]" for i in range(SAMPLE_WINDOWS))
+        cmd.extend([
+            '-filter_complex', f"{chains}{inputs}concat=n={SAMPLE_WINDOWS}:v=1:a=0[out]",
+            '-map', '[out]', '-c:v', 'ffv1', '-threads', str(FFMPEG_THREADS), reference
+        ])
+        returncode, _, _ = await self._run(cmd, limits)
+        return returncode == 0 and os.path.exists(reference)
+
+    async def _trial(self, reference, work_dir, preset, crf, limits):
+        """Codifica la referencia con `crf` y devuelve su SSIM."""
+        from compressor import compressor
+
+        trial = os.path.join(work_dir, f"crf{crf}.mp4")
+        cmd = ['ffmpeg', '-y', '-loglevel', 'error', '-i', reference]
+        cmd.extend(compressor.encode_args(dict(preset, crf=crf), threads=FFMPEG_THREADS, audio_args=['-an']))
+        cmd.append(trial)
+        returncode, _, _ = await self._run(cmd, limits)
+        if returncode != 0:
+            return None
+
+        returncode, _, stderr = await self._run([
+            'ffmpeg', '-hide_banner', '-i', trial, '-i', reference,
+            '-lavfi', '[0:v][1:v]ssim', '-f', 'null', '-'
+        ], limits)
+        match = re.search(r'SSIM .*All:([\d.]+)', stderr)
+        return float(match.group(1)) if returncode == 0 and match else None
+
+crf_analyzer = CrfAnalyzer()
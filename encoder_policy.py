@@ -0,0 +1,133 @@
+import time
+from queue_manager import queue_manager
+from metrics import metrics
+from config import (
+    ADAPTIVE_ENCODER, ENCODE_SLOTS, POLICY_BACKLOG, POLICY_SLOW_MAX_DURATION, POLICY_MIN_SPEED
+)
+
+# Escalera de encoders, del más lento (archivos más chicos) al más rápido.
+# x264 necesitaría ~5 puntos menos de CRF que x265 para igualar calidad; con cola se
+# acepta algo menos de calidad a cambio de no inflar el archivo (y la subida).
+# `expected_speed` es una estimación conservadora (x tiempo real) hasta tener mediciones.
+ENCODER_LADDER = [
+    {'name': 'hevc-medium', 'codec': 'libx265', 'preset': 'medium', 'crf_offset': 0, 'expected_speed': 0.3},
+    {'name': 'hevc-veryfast', 'codec': 'libx265', 'preset': 'veryfast', 'crf_offset': 0, 'expected_speed': 1.0},
+    {'name': 'hevc-ultrafast', 'codec': 'libx265', 'preset': 'ultrafast', 'crf_offset': 0, 'expected_speed': 2.0},
+    {'name': 'avc-superfast', 'codec': 'libx264', 'preset': 'superfast', 'crf_offset': -2, 'expected_speed': 4.0}
+]
+DEFAULT_RUNG = 'hevc-ultrafast'
+
+# Peso de la última medición en la media móvil de velocidad por escalón, y cuánto
+# vale una medición: pasado ese tiempo el escalón se vuelve a probar
+SPEED_EWMA_ALPHA = 0.3
+SPEED_TTL = 3600
+
+class EncoderPolicy:
+    """
+    Elige el preset/códec de cada encode según la carga: con la máquina libre se
+    usan presets lentos de x265 (archivos más chicos, subidas más rápidas); con
+    cola se baja a presets rápidos o a x264 para acotar la latencia.
+    """
+    def __init__(self):
+        self.ladder = {rung['name']: index for index, rung in enumerate(ENCODER_LADDER)}
+        self.speeds = {}
+        # Escalón fijo sin importar la carga (benchmark: resultados comparables)
+        self.pinned = None
+
+    def load(self):
+        """Trabajos esperando por cada slot de encode (0 = nadie espera)."""
+        waiting = queue_manager.pending_count() + queue_manager.stage_waiting['encode']
+        return waiting / max(ENCODE_SLOTS, 1)
+
+    def speed(self, rung_name, quality):
+        entry = self.speeds.get((rung_name, quality))
+        if entry is None or time.monotonic() - entry[1] > SPEED_TTL:
+            return None
+        return entry[0]
+
+    def expected_speed(self, rung_name, quality):
+        """Velocidad medida del escalón o, si no hay, la estimación de ENCODER_LADDER."""
+        speed = self.speed(rung_name, quality)
+        if speed is not None:
+            return speed
+        index = self.ladder.get(rung_name, self.ladder[DEFAULT_RUNG])
+        return ENCODER_LADDER[index]['expected_speed']
+
+    def choose(self, duration, quality, target_size=None, load=None):
+        """Devuelve (escalón, carga, motivo). `load` viene del bot en los encodes de un worker."""
+        if self.pinned:
+            return ENCODER_LADDER[self.ladder[self.pinned]], 0, 'pinned'
+        if not ADAPTIVE_ENCODER:
+            return ENCODER_LADDER[self.ladder[DEFAULT_RUNG]], 0, 'fixed'
+
+        if load is None:
+            load = self.load()
+        if load >= POLICY_BACKLOG:
+            index, reason = len(ENCODER_LADDER) - 1, 'backlog'
+        elif load >= 1:
+            index, reason = self.ladder['hevc-ultrafast'], 'busy'
+        elif load > 0 or duration > POLICY_SLOW_MAX_DURATION:
+            index, reason = self.ladder['hevc-veryfast'], 'light'
+        else:
+            index, reason = 0, 'idle'
+
+        if target_size:
+            # Las dos pasadas usan el archivo de estadísticas de x265
+            index = min(index, self.ladder['hevc-ultrafast'])
+
+        # Latencia acotada: se salta un escalón si su velocidad medida no llega al mínimo.
+        # Sin mediciones se prueba (la estimación no basta: un escalón que nunca corre
+        # nunca tendría con qué pasar el filtro); la medición vence a las SPEED_TTL.
+        limit = self.ladder['hevc-ultrafast'] if target_size else len(ENCODER_LADDER) - 1
+        while index < limit:
+            speed = self.speed(ENCODER_LADDER[index]['name'], quality)
+            if speed is None or speed >= POLICY_MIN_SPEED:
+                break
+            index += 1
+            reason += '+slow'
+        return ENCODER_LADDER[index], load, reason
+
+    def serves(self, encoder, duration, quality, target_size=None):
+        """
+        Si un resultado hecho con `encoder` (su result['encoder']) vale para un encode que
+        empezara ahora: no si hoy se elegiría un escalón más lento, de mejor compresión.
+        """
+        if not encoder or encoder.get('rung') not in self.ladder:
+            return True
+        rung, _, _ = self.choose(duration, quality, target_size)
+        return self.ladder[encoder['rung']] <= self.ladder[rung['name']]
+
+    def apply(self, quality, preset, duration, target_size=None, load=None, count=True):
+        """
+        Copia del preset de calidad con el encoder elegido; `preset['encoder']` queda en el
+        resultado. Con count=False (clips de vista previa) no suma a encoder_choices.
+        """
+        rung, load, reason = self.choose(duration, quality, target_size, load)
+        effective = dict(preset)
+        effective['codec'] = rung['codec']
+        effective['speed'] = rung['preset']
+        effective['crf'] = preset['crf'] + rung['crf_offset']
+        effective['encoder'] = {
+            'rung': rung['name'],
+            'codec': rung['codec'],
+            'preset': rung['preset'],
+            'crf': effective['crf'],
+            'load': round(load, 2),
+            'reason': reason
+        }
+        if count:
+            metrics.encoder_choices.inc(rung=rung['name'])
+        print(f"🧭 Encoder {rung['name']} (carga {load:.2f}, {reason})")
+        return effective
+
+    def record(self, rung_name, quality, duration, elapsed):
+        """Registra la velocidad (múltiplo de tiempo real) de un encode terminado."""
+        if elapsed <= 0 or duration <= 1:
+            return
+        speed = duration / elapsed
+        previous = self.speed(rung_name, quality)
+        if previous is not None:
+            speed = previous + SPEED_EWMA_ALPHA * (speed - previous)
+        self.speeds[(rung_name, quality)] = (speed, time.monotonic())
+
+encoder_policy = EncoderPolicy()
@@ -0,0 +1,145 @@
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import struct
+from collections import defaultdict
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct('iIII')
+# Sin inotify: espera creciente entre comprobaciones, desde 10 ms hasta medio segundo
+POLL_START = 0.01
+POLL_MAX = 0.5
+
+class FileWatcher:
+    """
+    Espera a que un archivo aparezca con su nombre final sin dormir en intervalos
+    fijos. En Linux usa inotify sobre el directorio y despierta con el rename
+    (IN_MOVED_TO, como el .temp de Pyrogram al terminar la descarga) o con el
+    cierre tras escribirlo (IN_CLOSE_WRITE). Sin inotify, sondea con espera creciente.
+    """
+    def __init__(self):
+        self.fd = None
+        self.libc = None
+        self.available = None
+        self.watches = {}
+        self.watch_dirs = {}
+        self.watch_refs = defaultdict(int)
+        self.waiters = defaultdict(set)
+
+    def _setup(self):
+        if self.available is not None:
+            return self.available
+        self.available = False
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1")
+            asyncio.get_running_loop().add_reader(fd, self._on_readable)
+        except (OSError, AttributeError, NotImplementedError) as e:
+            print(f"inotify no disponible, se sondean los archivos: {e}")
+            return False
+        self.libc = libc
+        self.fd = fd
+        self.available = True
+        return True
+
+    def _watch(self, directory):
+        if directory not in self.watches:
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch {directory}")
+            self.watches[directory] = wd
+            self.watch_dirs[wd] = directory
+        self.watch_refs[directory] += 1
+
+    def _unwatch(self, directory):
+        self.watch_refs[directory] -= 1
+        if self.watch_refs[directory] > 0:
+            return
+        del self.watch_refs[directory]
+        wd = self.watches.pop(directory, None)
+        if wd is not None and self.watch_dirs.pop(wd, None) is not None:
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def _on_readable(self):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                # Se perdieron eventos: se revisa a mano todo lo que se espera
+                for path in list(self.waiters):
+                    if self._ready(path):
+                        self._wake(path)
+                continue
+            if mask & IN_IGNORED:
+                # El directorio se borró: el kernel ya quitó la vigilancia
+                directory = self.watch_dirs.pop(wd, None)
+                self.watches.pop(directory, None)
+                continue
+            directory = self.watch_dirs.get(wd)
+            if directory and name and mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                self._wake(os.path.join(directory, os.fsdecode(name)))
+
+    def _wake(self, path):
+        for future in self.waiters.get(path, ()):
+            if not future.done():
+                future.set_result(path)
+
+    def _ready(self, path):
+        return os.path.isfile(path)
+
+    async def wait(self, path, timeout=30):
+        """Ruta del archivo en cuanto existe con su nombre final, o None si pasa `timeout`."""
+        path = os.path.abspath(path)
+        if self._ready(path):
+            return path
+        if not self._setup():
+            return await self._poll(path, timeout)
+        directory = os.path.dirname(path)
+        try:
+            self._watch(directory)
+        except OSError:
+            return await self._poll(path, timeout)
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[path].add(future)
+        try:
+            # Pudo aparecer entre la primera comprobación y la vigilancia
+            if self._ready(path):
+                return path
+            try:
+                return await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                return path if self._ready(path) else None
+        finally:
+            self.waiters[path].discard(future)
+            if not self.waiters[path]:
+                del self.waiters[path]
+            self._unwatch(directory)
+
+    async def _poll(self, path, timeout):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        delay = POLL_START
+        while not self._ready(path):
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return None
+            await asyncio.sleep(min(delay, remaining))
+            delay = min(delay * 2, POLL_MAX)
+        return path
+
+file_watcher = FileWatcher()
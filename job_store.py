@@ -0,0 +1,131 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from config import JOB_DB_PATH, JOB_RETENTION
+
+# Estados en orden; los tres primeros tras 'queued' son las etapas que se pueden retomar
+ACTIVE_STATES = ('queued', 'downloading', 'encoding', 'uploading')
+FINAL_STATES = ('done', 'failed', 'cancelled')
+
+class JobStore:
+    """
+    Registro persistente de trabajos y preferencias de usuario (SQLite en modo WAL).
+    Cada cambio de etapa queda escrito antes de empezarla, así que tras un reinicio
+    o un OOM los trabajos sin terminar se pueden rehidratar y retomar.
+    """
+    def __init__(self, db_path=JOB_DB_PATH):
+        self.db_path = db_path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY,"
+                " user_id INTEGER NOT NULL,"
+                " chat_id INTEGER NOT NULL,"
+                " message_id INTEGER NOT NULL,"
+                " quality TEXT NOT NULL,"
+                " target_size INTEGER,"
+                " state TEXT NOT NULL,"
+                " result TEXT,"
+                " created_at REAL NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)")
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]
+            if 'url' not in columns:
+                # Bases creadas antes de /url
+                conn.execute("ALTER TABLE jobs ADD COLUMN url TEXT")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS user_settings ("
+                " user_id INTEGER PRIMARY KEY,"
+                " quality TEXT,"
+                " target_size INTEGER)"
+            )
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _execute(self, query, params=(), fetch=False):
+        with self._lock:
+            conn = self._connect()
+            cursor = conn.execute(query, params)
+            rows = cursor.fetchall() if fetch else None
+            conn.commit()
+            return rows
+
+    async def _run(self, query, params=(), fetch=False):
+        try:
+            return await asyncio.to_thread(self._execute, query, params, fetch)
+        except Exception as e:
+            print(f"Error en el registro de trabajos: {e}")
+            return [] if fetch else None
+
+    async def save(self, job):
+        """Inserta o actualiza el trabajo con su calidad/tamaño objetivo actuales."""
+        now = time.time()
+        await self._run(
+            "INSERT INTO jobs (id, user_id, chat_id, message_id, quality, target_size, state, result, created_at, updated_at, url) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET quality = excluded.quality, target_size = excluded.target_size, "
+            "updated_at = excluded.updated_at",
+            (job.id, job.user_id, job.message.chat.id, job.message.id, job.quality, job.target_size,
+             job.state, json.dumps(job.result) if job.result else None, job.created_at, now, job.url)
+        )
+
+    async def set_state(self, job, state, result=None):
+        job.state = state
+        if result is not None:
+            job.result = result
+        await self._run(
+            "UPDATE jobs SET state = ?, result = ?, updated_at = ? WHERE id = ?",
+            (state, json.dumps(job.result) if job.result else None, time.time(), job.id)
+        )
+
+    async def cancel_queued(self, jobs):
+        for job in jobs:
+            await self.set_state(job, 'cancelled')
+
+    async def unfinished(self):
+        """Trabajos sin terminar, en orden de llegada."""
+        rows = await self._run(
+            "SELECT id, user_id, chat_id, message_id, quality, target_size, state, result, created_at, url "
+            "FROM jobs WHERE state IN (?, ?, ?, ?) ORDER BY created_at",
+            ACTIVE_STATES, True
+        )
+        jobs = []
+        for row in rows:
+            jobs.append({
+                'id': row[0], 'user_id': row[1], 'chat_id': row[2], 'message_id': row[3],
+                'quality': row[4], 'target_size': row[5], 'state': row[6],
+                'result': json.loads(row[7]) if row[7] else None, 'created_at': row[8], 'url': row[9]
+            })
+        return jobs
+
+    async def mark(self, job_id, state):
+        await self._run("UPDATE jobs SET state = ?, updated_at = ? WHERE id = ?", (state, time.time(), job_id))
+
+    async def prune(self, max_age=JOB_RETENTION):
+        await self._run(
+            "DELETE FROM jobs WHERE state IN (?, ?, ?) AND updated_at < ?",
+            (*FINAL_STATES, time.time() - max_age)
+        )
+
+    async def save_settings(self, user_id, quality=None, target_size=None):
+        await self._run(
+            "INSERT OR REPLACE INTO user_settings (user_id, quality, target_size) VALUES (?, ?, ?)",
+            (user_id, quality, target_size)
+        )
+
+    async def load_settings(self):
+        rows = await self._run("SELECT user_id, quality, target_size FROM user_settings", fetch=True)
+        return {user_id: (quality, target_size) for user_id, quality, target_size in rows}
+
+job_store = JobStore()
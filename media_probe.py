@@ -0,0 +1,140 @@
+import json
+import os
+from collections import OrderedDict
+from supervisor import supervisor
+
+# Códecs de audio que se pueden copiar tal cual dentro de un MP4
+MP4_AUDIO_CODECS = ('aac', 'mp3', 'ac3', 'eac3')
+MP4_FORMATS = ('mov', 'mp4', 'm4a', '3gp')
+# Un archivo dañado puede dejar a ffprobe leyendo sin fin
+PROBE_TIMEOUT = 60
+
+class MediaInfo:
+    """Resultado de un ffprobe (-show_format -show_streams) con accesos de conveniencia."""
+    def __init__(self, data, size=0):
+        self.format = data.get('format', {})
+        self.streams = data.get('streams', [])
+        self.size = size or int(self.format.get('size', 0) or 0)
+
+    @property
+    def duration(self):
+        try:
+            return float(self.format.get('duration', 0) or 0)
+        except ValueError:
+            return 0
+
+    @property
+    def format_name(self):
+        return self.format.get('format_name', '')
+
+    @property
+    def is_mp4(self):
+        return any(name in MP4_FORMATS for name in self.format_name.split(','))
+
+    @property
+    def video(self):
+        for stream in self.streams:
+            if stream.get('codec_type') == 'video' and not stream.get('disposition', {}).get('attached_pic'):
+                return stream
+        return None
+
+    @property
+    def audio_streams(self):
+        return [s for s in self.streams if s.get('codec_type') == 'audio']
+
+    @property
+    def video_codec(self):
+        return (self.video or {}).get('codec_name')
+
+    @property
+    def width(self):
+        return int((self.video or {}).get('width', 0) or 0)
+
+    @property
+    def height(self):
+        return int((self.video or {}).get('height', 0) or 0)
+
+    @property
+    def fps(self):
+        """Cuadros por segundo promedio (0 si ffprobe no lo informa)."""
+        video = self.video or {}
+        for key in ('avg_frame_rate', 'r_frame_rate'):
+            num, _, den = str(video.get(key, '0/0')).partition('/')
+            try:
+                value = float(num) / float(den or 1)
+            except (ValueError, ZeroDivisionError):
+                continue
+            if value > 0:
+                return value
+        return 0
+
+    @property
+    def audio_bitrate(self):
+        total = 0
+        for stream in self.audio_streams:
+            try:
+                total += int(stream.get('bit_rate', 0) or 0)
+            except ValueError:
+                pass
+        return total
+
+    @property
+    def video_bitrate(self):
+        """Bitrate de video en bps; si el stream no lo declara se estima del total."""
+        try:
+            declared = int((self.video or {}).get('bit_rate', 0) or 0)
+        except ValueError:
+            declared = 0
+        if declared:
+            return declared
+        if self.size and self.duration > 0:
+            return max(int(self.size * 8 / self.duration) - self.audio_bitrate, 0)
+        return 0
+
+    @property
+    def audio_copyable(self):
+        return all(s.get('codec_name') in MP4_AUDIO_CODECS for s in self.audio_streams)
+
+class MediaProbe:
+    """Ejecuta ffprobe una sola vez por archivo y guarda el resultado mientras dure el trabajo."""
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+
+    async def probe(self, input_path=None, data=None, size=0):
+        """Analiza un archivo o los primeros bytes de un stream (`data`). None si falla."""
+        key = None
+        if input_path:
+            try:
+                stat = os.stat(input_path)
+                key = (os.path.abspath(input_path), stat.st_size, stat.st_mtime_ns)
+                size = size or stat.st_size
+            except OSError:
+                return None
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        try:
+            # ffprobe está en el camino del usuario (antes de encolar o de empezar): prioridad interactiva
+            _, stdout, _ = await supervisor.run(
+                ['ffprobe', '-v', 'error', '-show_format', '-show_streams', '-of', 'json', input_path or 'pipe:0'],
+                'interactive', input=data, stdout=True, timeout=PROBE_TIMEOUT
+            )
+            info = MediaInfo(json.loads(stdout), size=size)
+        except Exception as e:
+            print(f"Error probing video: {e}")
+            return None
+
+        if key:
+            self._cache[key] = info
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return info
+
+    def forget(self, input_path):
+        path = os.path.abspath(input_path)
+        for key in [k for k in self._cache if k[0] == path]:
+            del self._cache[key]
+
+media_probe = MediaProbe()
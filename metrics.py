@@ -0,0 +1,145 @@
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Buckets pensados para este bot: throughput en MB/s, velocidades de encode en
+# múltiplos de tiempo real y duraciones de fase de segundos a una hora
+THROUGHPUT_BUCKETS = (0.25, 0.5, 1, 2, 5, 10, 20, 50, 100)
+SPEED_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 16, 32)
+FPS_BUCKETS = (10, 25, 50, 100, 200, 400, 800)
+RATIO_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.8, 1.0)
+DURATION_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 3600)
+
+def _labels(labels):
+    if not labels:
+        return ''
+    parts = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{name}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.values = defaultdict(float)
+
+    def inc(self, amount=1, **labels):
+        self.values[tuple(sorted(labels.items()))] += amount
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, labels, value
+
+class Gauge:
+    """Gauge con valor propio o calculado en cada scrape (`collect` devuelve [(labels, valor)])."""
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, collect=None):
+        self.name = name
+        self.help = help_text
+        self.collect = collect
+        self.values = defaultdict(float)
+
+    def inc(self, amount=1, **labels):
+        self.values[tuple(sorted(labels.items()))] += amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        values = self.values
+        if self.collect:
+            values = {tuple(sorted(labels.items())): value for labels, value in self.collect()}
+        for labels, value in values.items():
+            yield self.name, labels, value
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self.counts = {}
+        self.sums = defaultdict(float)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        counts = self.counts.setdefault(key, [0] * len(self.buckets))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        self.sums[key] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def samples(self):
+        for key, counts in self.counts.items():
+            for bound, count in zip(self.buckets, counts):
+                yield f'{self.name}_bucket', key + (('le', _number(bound)),), count
+            yield f'{self.name}_sum', key, self.sums[key]
+            yield f'{self.name}_count', key, counts[-1]
+
+class Metrics:
+    """
+    Registro de métricas del bot expuesto en /metrics con el formato de texto de
+    Prometheus. Sin dependencias: los valores viven en memoria del proceso.
+    """
+    def __init__(self):
+        self.registry = []
+        self.download_throughput = self.histogram(
+            'download_throughput_mbps', 'Velocidad de descarga por trabajo (MB/s)', THROUGHPUT_BUCKETS)
+        self.upload_throughput = self.histogram(
+            'upload_throughput_mbps', 'Velocidad de subida por trabajo (MB/s)', THROUGHPUT_BUCKETS)
+        self.encode_speed = self.histogram(
+            'encode_speed_realtime', 'Velocidad de FFmpeg en múltiplos de tiempo real', SPEED_BUCKETS)
+        self.encode_fps = self.histogram('encode_fps', 'Frames por segundo de FFmpeg', FPS_BUCKETS)
+        self.size_ratio = self.histogram(
+            'output_size_ratio', 'Tamaño de salida / tamaño de entrada por preset', RATIO_BUCKETS)
+        self.phase_duration = self.histogram(
+            'job_phase_seconds', 'Duración de cada fase de un trabajo', DURATION_BUCKETS)
+        self.encoder_choices = self.counter('encoder_choices_total', 'Encodes por escalón del encoder adaptativo')
+        self.jobs = self.counter('jobs_total', 'Trabajos terminados por resultado')
+        self.errors = self.counter('job_errors_total', 'Errores de trabajos por causa')
+
+    def counter(self, name, help_text):
+        return self._register(Counter(name, help_text))
+
+    def gauge(self, name, help_text, collect=None):
+        return self._register(Gauge(name, help_text, collect))
+
+    def histogram(self, name, help_text, buckets):
+        return self._register(Histogram(name, help_text, buckets))
+
+    def _register(self, metric):
+        metric.name = f'videobot_{metric.name}'
+        self.registry.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.registry:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{_labels(labels)} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
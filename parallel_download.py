@@ -0,0 +1,283 @@
+import asyncio
+import ipaddress
+import os
+import aiohttp
+from pyrogram import raw, StopTransmission
+from pyrogram.file_id import FileId
+from pyrogram.session import Session, Auth
+from cancellation import JobCancelled
+from config import PARALLEL_DOWNLOAD_CONNECTIONS, PARALLEL_DOWNLOAD_RANGE, URL_ALLOW_PRIVATE
+
+# upload.GetFile pide bloques de hasta 1 MB alineados a su tamaño
+CHUNK_SIZE = 1024 * 1024
+RANGE_RETRIES = 4
+
+class RangeFetchError(Exception):
+    pass
+
+class BlockedAddressError(ValueError):
+    """El enlace apunta (directo, por DNS o tras una redirección) a una dirección no pública."""
+
+def is_public_address(host):
+    try:
+        address = ipaddress.ip_address(host.split('%')[0])
+    except ValueError:
+        return False
+    if address.version == 6 and address.ipv4_mapped:
+        address = address.ipv4_mapped
+    return address.is_global and not address.is_multicast
+
+class PublicConnector(aiohttp.TCPConnector):
+    """
+    Sólo abre conexiones a direcciones públicas. Se comprueban las IPs ya resueltas
+    de cada conexión, así que también cubre las redirecciones y un DNS que cambie
+    entre el probe y la descarga.
+    """
+    async def _resolve_host(self, host, port, traces=None):
+        hosts = await super()._resolve_host(host, port, traces=traces)
+        for entry in hosts:
+            if not is_public_address(entry['host']):
+                raise BlockedAddressError(f"{host} apunta a una dirección no pública ({entry['host']})")
+        return hosts
+
+def http_session(allow_private=False, **kwargs):
+    """ClientSession para enlaces de usuarios: sin `allow_private` no sale de internet."""
+    return aiohttp.ClientSession(connector=None if allow_private else PublicConnector(), **kwargs)
+
+class ParallelDownloader:
+    """
+    Descarga un archivo partiéndolo en rangos que varias conexiones piden en
+    paralelo. Cada bloque se escribe con pwrite en su offset de un archivo
+    preasignado, así que el orden de llegada no importa. Un rango que falla se
+    reintenta desde el último bloque escrito, en la misma u otra conexión.
+
+    `fetcher` abre las conexiones: `await fetcher.open()` devuelve un objeto con
+    `await read(offset, limit)` y `await close()` (ver TelegramFetcher y HttpFetcher).
+    """
+    def __init__(self, fetcher, connections=PARALLEL_DOWNLOAD_CONNECTIONS, range_size=PARALLEL_DOWNLOAD_RANGE):
+        self.fetcher = fetcher
+        self.connections = max(1, connections)
+        self.range_size = max(CHUNK_SIZE, range_size // CHUNK_SIZE * CHUNK_SIZE)
+        self.downloaded = 0
+
+    def split(self, size):
+        return [(start, min(start + self.range_size, size)) for start in range(0, size, self.range_size)]
+
+    async def download(self, path, size, progress=None):
+        """
+        Descarga `size` bytes a `path`; lanza RangeFetchError si un rango agota sus
+        reintentos. Los rangos terminados se anotan en `path`.ranges: si la descarga
+        se corta (error o reinicio del bot), la siguiente sólo pide los que faltan.
+        """
+        journal_path = path + ".ranges"
+        done = self._load_journal(journal_path, path, size)
+        pending = asyncio.Queue()
+        for start, end in self.split(size):
+            if start in done:
+                self.downloaded += end - start
+            else:
+                pending.put_nowait((start, start, end, 0))
+        if done:
+            print(f"♻️ Descarga retomada: {len(done)} rangos ya estaban completos")
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | (0 if done else os.O_TRUNC), 0o644)
+        journal = open(journal_path, 'a' if done else 'w')
+        try:
+            if not done:
+                journal.write(f"{size}\n")
+                journal.flush()
+                try:
+                    os.posix_fallocate(fd, 0, size)
+                except (AttributeError, OSError):
+                    os.ftruncate(fd, size)
+
+            async def worker():
+                conn = await self.fetcher.open()
+                try:
+                    while True:
+                        try:
+                            start, offset, end, attempts = pending.get_nowait()
+                        except asyncio.QueueEmpty:
+                            return
+                        try:
+                            while offset < end:
+                                data = await conn.read(offset, min(CHUNK_SIZE, end - offset))
+                                if not data:
+                                    raise RangeFetchError(f"bloque vacío en {offset}")
+                                await asyncio.to_thread(os.pwrite, fd, data, offset)
+                                offset += len(data)
+                                self.downloaded += len(data)
+                                if progress:
+                                    await progress(self.downloaded, size)
+                            journal.write(f"{start}\n")
+                            journal.flush()
+                        except (StopTransmission, JobCancelled):
+                            # Cancelado desde el callback de progreso: no se reintenta
+                            raise
+                        except Exception as e:
+                            if attempts + 1 >= RANGE_RETRIES:
+                                raise RangeFetchError(f"rango {start}-{end}: {e}") from e
+                            print(f"⚠️ Reintentando rango {offset}-{end} ({e})")
+                            # Lo que ya se escribió queda; se pide sólo el resto
+                            await asyncio.sleep(attempts + 1)
+                            pending.put_nowait((start, offset, end, attempts + 1))
+                finally:
+                    await conn.close()
+
+            workers = [asyncio.create_task(worker()) for _ in range(min(self.connections, pending.qsize()))]
+            try:
+                await asyncio.gather(*workers)
+            finally:
+                for task in workers:
+                    task.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+        finally:
+            os.close(fd)
+            journal.close()
+        os.remove(journal_path)
+
+    @staticmethod
+    def discard(path):
+        """
+        Borra una descarga por rangos abandonada: el archivo preasignado ya tiene el
+        tamaño final y, sin su journal, parecería completo.
+        """
+        for leftover in (path, path + ".ranges"):
+            try:
+                os.remove(leftover)
+            except FileNotFoundError:
+                pass
+
+    def _load_journal(self, journal_path, path, size):
+        """Rangos ya escritos por una descarga anterior del mismo archivo (mismo tamaño)."""
+        if not os.path.exists(journal_path) or not os.path.exists(path):
+            return set()
+        try:
+            with open(journal_path) as f:
+                lines = f.read().split()
+            if not lines or int(lines[0]) != size:
+                return set()
+            return {int(line) for line in lines[1:]}
+        except (OSError, ValueError):
+            return set()
+
+class TelegramFetcher:
+    """Conexiones de media al DC del archivo, con upload.GetFile por bloques."""
+    def __init__(self, client, file_id):
+        self.client = client
+        self.file_id = FileId.decode(file_id)
+        self.location = raw.types.InputDocumentFileLocation(
+            id=self.file_id.media_id,
+            access_hash=self.file_id.access_hash,
+            file_reference=self.file_id.file_reference,
+            thumb_size=self.file_id.thumbnail_size
+        )
+        self.auth_key = None
+        self.authorized = False
+        self._lock = asyncio.Lock()
+
+    async def open(self):
+        dc_id = self.file_id.dc_id
+        test_mode = await self.client.storage.test_mode()
+        foreign = dc_id != await self.client.storage.dc_id()
+        async with self._lock:
+            # Una sola clave (y autorización) por descarga, compartida por todas las conexiones
+            if self.auth_key is None:
+                self.auth_key = (await Auth(self.client, dc_id, test_mode).create()
+                                 if foreign else await self.client.storage.auth_key())
+            session = Session(self.client, dc_id, self.auth_key, test_mode, is_media=True)
+            await session.start()
+            if foreign and not self.authorized:
+                try:
+                    exported = await self.client.invoke(raw.functions.auth.ExportAuthorization(dc_id=dc_id))
+                    await session.invoke(raw.functions.auth.ImportAuthorization(
+                        id=exported.id, bytes=exported.bytes
+                    ))
+                except Exception:
+                    await session.stop()
+                    raise
+                self.authorized = True
+        return _TelegramConnection(session, self.location)
+
+class _TelegramConnection:
+    def __init__(self, session, location):
+        self.session = session
+        self.location = location
+
+    async def read(self, offset, limit):
+        r = await self.session.invoke(
+            raw.functions.upload.GetFile(location=self.location, offset=offset, limit=CHUNK_SIZE),
+            sleep_threshold=30
+        )
+        return r.bytes[:limit]
+
+    async def close(self):
+        await self.session.stop()
+
+class HttpFetcher:
+    """Rangos HTTP (Range: bytes=a-b) de un servidor que los admita."""
+    def __init__(self, url, headers=None, allow_private=URL_ALLOW_PRIVATE):
+        self.url = url
+        self.headers = headers or {}
+        self.allow_private = allow_private
+
+    async def probe(self):
+        """
+        Metadatos del recurso: {'size', 'ranges', 'type', 'etag', 'name', 'url'} (tamaño 0
+        si el servidor no lo informa). Si HEAD no está permitido se pide el primer byte.
+        """
+        async with http_session(self.allow_private, headers=self.headers) as session:
+            async with session.head(self.url, allow_redirects=True) as resp:
+                if resp.status not in (403, 405):
+                    resp.raise_for_status()
+                    return self._describe(resp, int(resp.headers.get('Content-Length', 0) or 0))
+            async with session.get(self.url, headers={'Range': 'bytes=0-0'}) as resp:
+                resp.raise_for_status()
+                if resp.status == 206:
+                    size = int(resp.headers.get('Content-Range', '*/0').rpartition('/')[2] or 0)
+                else:
+                    size = int(resp.headers.get('Content-Length', 0) or 0)
+                return self._describe(resp, size, ranges=resp.status == 206)
+
+    def _describe(self, resp, size, ranges=None):
+        if ranges is None:
+            ranges = resp.headers.get('Accept-Ranges', '').lower() == 'bytes'
+        name = ''
+        disposition = resp.headers.get('Content-Disposition', '')
+        if 'filename=' in disposition:
+            name = disposition.split('filename=')[-1].strip('"\' ;')
+        return {
+            'size': size,
+            'ranges': ranges and size > 0,
+            'type': resp.headers.get('Content-Type', '').split(';')[0].strip().lower(),
+            'etag': resp.headers.get('ETag', ''),
+            'name': name or os.path.basename(resp.url.path),
+            'url': str(resp.url)
+        }
+
+    async def open(self):
+        return _HttpConnection(self.url, http_session(
+            self.allow_private, headers=self.headers, timeout=aiohttp.ClientTimeout(total=None, sock_read=60)
+        ))
+
+class _HttpConnection:
+    def __init__(self, url, session):
+        self.url = url
+        self.session = session
+
+    async def read(self, offset, limit):
+        headers = {'Range': f"bytes={offset}-{offset + limit - 1}"}
+        async with self.session.get(self.url, headers=headers) as resp:
+            if resp.status != 206:
+                raise RangeFetchError(f"HTTP {resp.status} pidiendo un rango")
+            # Nunca más de lo pedido, aunque el servidor mande de más
+            data = bytearray()
+            while len(data) < limit:
+                chunk = await resp.content.read(limit - len(data))
+                if not chunk:
+                    break
+                data += chunk
+            return bytes(data)
+
+    async def close(self):
+        await self.session.close()
@@ -1,17 +1,113 @@
 import asyncio
-from collections import defaultdict
+import time
+import uuid
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+from metrics import metrics
+from cancellation import CancelToken
+from config import (
+    DOWNLOAD_SLOTS, ENCODE_SLOTS, UPLOAD_SLOTS, MAX_ACTIVE_JOBS, MAX_JOBS_PER_USER,
+    SCHED_POLICY, SCHED_AGING, SCHED_SHARE_HALFLIFE, ENCODE_BACKEND
+)
+
+class Job:
+    def __init__(self, user_id, message, quality, target_size=None, job_id=None, created_at=None, source=None):
+        self.user_id = user_id
+        self.message = message
+        # UrlSource para los trabajos de /url (el mensaje es el comando, sin video)
+        self.source = source
+        self.quality = quality
+        self.target_size = target_size
+        self.created_at = created_at or time.time()
+        self.id = job_id or uuid.uuid4().hex[:12]
+        # Último estado persistido y resultado del encode (para retomar tras un reinicio)
+        self.state = 'queued'
+        self.result = None
+        self.started_at = None
+        # Probe de la entrada cuando ya se hizo: fps y códec reales para el modelo de costos
+        self.info = None
+        # /cancel lo marca; cada etapa del pipeline lo revisa
+        self.cancel_token = CancelToken()
+    
+    @property
+    def media(self):
+        return self.source or self.message.video or self.message.document
+    
+    @property
+    def url(self):
+        return getattr(self.source, 'url', None)
 
 class QueueManager:
-    def __init__(self):
-        self.queues = defaultdict(asyncio.Queue)
-        self.active_tasks = {}
+    """
+    Scheduler global: una cola por usuario y un límite de concurrencia independiente
+    por etapa (descarga, encode, subida). Con la política 'sjf' sale primero el
+    trabajo de menor puntaje = costo estimado + uso reciente del usuario - espera
+    (reparto justo y sin inanición); con 'rr', round-robin entre usuarios.
+    """
+    def __init__(self, max_active_jobs=MAX_ACTIVE_JOBS, max_jobs_per_user=MAX_JOBS_PER_USER, policy=SCHED_POLICY):
+        self.queues = defaultdict(deque)
+        self.rotation = deque()
+        self.running = defaultdict(int)
         self.processing = set()
+        self.max_active_jobs = max_active_jobs
+        self.max_jobs_per_user = max_jobs_per_user
+        # Límites propios de algunos usuarios (clientes de la API)
+        self.user_limits = {}
+        self.active_tasks = set()
+        self.active_jobs = {}
+        self.policy = policy
+        self.cost = None
+        # Segundos de trabajo estimado despachados por usuario, con decaimiento exponencial
+        self.usage = {}
+        self.stage_limits = {
+            'download': DOWNLOAD_SLOTS,
+            'encode': ENCODE_SLOTS,
+            'upload': UPLOAD_SLOTS
+        }
+        self.stage_semaphores = {name: asyncio.Semaphore(limit) for name, limit in self.stage_limits.items()}
+        self.stage_active = defaultdict(int)
+        self.stage_waiting = defaultdict(int)
+        # Con workers externos ENCODE_SLOTS (CPUs de este proceso) no limita los encodes
+        self.remote_encode = ENCODE_BACKEND == 'broker'
+        self._wakeup = asyncio.Event()
+        self._dispatcher = None
+        self._runner = None
+    
+    def start(self, runner, cost=None):
+        """
+        Arranca el dispatcher global. `runner` es una corrutina que procesa un Job y
+        `cost(job)` estima sus segundos de trabajo (sin él se usa round-robin).
+        """
+        self._runner = runner
+        self.cost = cost
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch_loop())
     
     async def add_to_queue(self, user_id, task):
-        await self.queues[user_id].put(task)
+        self.queues[user_id].append(task)
+        if user_id not in self.rotation:
+            self.rotation.append(user_id)
+        self._wakeup.set()
     
     def get_queue_position(self, user_id):
-        return self.queues[user_id].qsize()
+        return len(self.queues.get(user_id, ()))
+    
+    def find_job(self, user_id, message_id):
+        """Trabajo aún en cola (no iniciado) del mensaje `message_id`."""
+        for job in self.queues.get(user_id, ()):
+            if job.message.id == message_id:
+                return job
+        return None
+    
+    def find_active(self, user_id, message_id):
+        """Trabajo ya despachado (en curso) del mensaje `message_id`."""
+        for job in self.active_jobs.values():
+            if job.user_id == user_id and job.message and job.message.id == message_id:
+                return job
+        return None
+    
+    def pending_count(self):
+        return sum(len(queue) for queue in self.queues.values())
     
     def is_processing(self, user_id):
         return user_id in self.processing
@@ -22,20 +118,191 @@ class QueueManager:
         else:
             self.processing.discard(user_id)
     
-    async def get_next_task(self, user_id):
-        if self.queues[user_id].empty():
-            return None
-        try:
-            task = self.queues[user_id].get_nowait()
-            return task
-        except asyncio.QueueEmpty:
-            return None
+    def user_limit(self, user_id):
+        return self.user_limits.get(user_id, self.max_jobs_per_user)
+    
+    def remove(self, job):
+        """Saca de la cola un trabajo aún no iniciado. False si ya no estaba en cola."""
+        if job not in self.queues.get(job.user_id, ()):
+            return False
+        self._take(job)
+        return True
     
     def clear_queue(self, user_id):
-        while not self.queues[user_id].empty():
-            try:
-                self.queues[user_id].get_nowait()
-            except:
-                break
+        """Vacía la cola del usuario y devuelve los trabajos descartados."""
+        return list(self.queues.pop(user_id, ()))
+    
+    @asynccontextmanager
+    async def stage(self, name, token=None):
+        """
+        Reserva un slot de la etapa `name` mientras dure el bloque. Con `token` la espera
+        por el slot se corta con JobCancelled si se cancela el trabajo.
+        """
+        semaphore = self.stage_semaphores[name]
+        self.stage_waiting[name] += 1
+        try:
+            if token is None:
+                await semaphore.acquire()
+            else:
+                await token.wait_for(semaphore.acquire())
+        finally:
+            self.stage_waiting[name] -= 1
+        self.stage_active[name] += 1
+        try:
+            yield
+        finally:
+            self.stage_active[name] -= 1
+            semaphore.release()
+    
+    @asynccontextmanager
+    async def encode_stage(self, token=None):
+        """
+        Slot de encode. Con ENCODE_BACKEND=broker el encode corre en los workers: la
+        cola del broker ya reparte las tareas según los slots que anuncia cada worker,
+        así que aquí sólo se cuenta (un semáforo por CPUs locales anularía el escalado).
+        """
+        if not self.remote_encode:
+            async with self.stage('encode', token):
+                yield
+            return
+        self.stage_active['encode'] += 1
+        try:
+            yield
+        finally:
+            self.stage_active['encode'] -= 1
+    
+    @asynccontextmanager
+    async def borrow(self, name, count):
+        """Toma sin esperar hasta `count` slots libres extra de la etapa `name`; devuelve cuántos obtuvo."""
+        semaphore = self.stage_semaphores[name]
+        granted = 0
+        while granted < count and not semaphore.locked():
+            await semaphore.acquire()
+            granted += 1
+        self.stage_active[name] += granted
+        try:
+            yield granted
+        finally:
+            self.stage_active[name] -= granted
+            for _ in range(granted):
+                semaphore.release()
+    
+    def _usage(self, user_id, now):
+        value, stamp = self.usage.get(user_id, (0, now))
+        return value * 0.5 ** ((now - stamp) / SCHED_SHARE_HALFLIFE)
+    
+    def _score(self, job, now):
+        return self.cost(job) + self._usage(job.user_id, now) - SCHED_AGING * (now - job.created_at)
+    
+    def _take(self, job):
+        queue = self.queues[job.user_id]
+        queue.remove(job)
+        if not queue:
+            self.queues.pop(job.user_id, None)
+            if job.user_id in self.rotation:
+                self.rotation.remove(job.user_id)
+        return job
+    
+    def _next_job(self):
+        if self.policy == 'sjf' and self.cost:
+            now = time.time()
+            candidates = [
+                job for user_id, queue in self.queues.items()
+                if self.running[user_id] < self.user_limit(user_id) for job in queue
+            ]
+            if not candidates:
+                return None
+            return self._take(min(candidates, key=lambda job: self._score(job, now)))
+        
+        # Round-robin: se recorre la rotación una vez buscando un usuario con trabajo
+        # pendiente que no haya alcanzado su límite de trabajos simultáneos
+        for _ in range(len(self.rotation)):
+            user_id = self.rotation.popleft()
+            queue = self.queues[user_id]
+            if not queue:
+                self.queues.pop(user_id, None)
+                continue
+            if self.running[user_id] >= self.user_limit(user_id):
+                self.rotation.append(user_id)
+                continue
+            job = queue.popleft()
+            if queue:
+                self.rotation.append(user_id)
+            else:
+                self.queues.pop(user_id, None)
+            return job
+        return None
+    
+    async def _dispatch_loop(self):
+        while True:
+            job = None
+            if len(self.active_tasks) < self.max_active_jobs:
+                job = self._next_job()
+            if job is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            self._launch(job)
+    
+    def pending_order(self, extra=None):
+        """Trabajos en cola (más `extra`, aún sin encolar) en el orden en que se despacharían."""
+        pending = [job for queue in self.queues.values() for job in queue]
+        if extra is not None:
+            pending.append(extra)
+        if self.policy == 'sjf' and self.cost:
+            now = time.time()
+            return sorted(pending, key=lambda job: self._score(job, now))
+        # Round-robin: una vuelta por usuario, empezando por el siguiente de la rotación
+        queues = {user_id: deque(queue) for user_id, queue in self.queues.items()}
+        order = [user_id for user_id in self.rotation if user_id in queues]
+        if extra is not None:
+            queues.setdefault(extra.user_id, deque()).append(extra)
+            if extra.user_id not in order:
+                order.append(extra.user_id)
+        result = []
+        while order:
+            for user_id in list(order):
+                result.append(queues[user_id].popleft())
+                if not queues[user_id]:
+                    order.remove(user_id)
+        return result
+    
+    def _launch(self, job):
+        user_id = job.user_id
+        if self.cost:
+            now = time.time()
+            self.usage[user_id] = (self._usage(user_id, now) + self.cost(job), now)
+        job.started_at = time.time()
+        self.active_jobs[job.id] = job
+        self.running[user_id] += 1
+        self.mark_processing(user_id, True)
+        self.active_tasks.add(asyncio.create_task(self._run(job)))
+    
+    async def _run(self, job):
+        try:
+            await self._runner(job)
+        except Exception as e:
+            print(f"Error en trabajo de {job.user_id}: {e}")
+        finally:
+            self.active_tasks.discard(asyncio.current_task())
+            self.active_jobs.pop(job.id, None)
+            user_id = job.user_id
+            self.running[user_id] -= 1
+            if self.running[user_id] <= 0:
+                del self.running[user_id]
+                self.mark_processing(user_id, False)
+            self._wakeup.set()
+    
+    def stage_depths(self):
+        """Profundidad de cola por etapa: trabajos sin despachar y esperando slot en cada etapa."""
+        depths = [({'stage': 'queued'}, self.pending_count())]
+        for name in self.stage_limits:
+            depths.append(({'stage': name}, self.stage_waiting[name]))
+        return depths
+    
+    def stage_usage(self):
+        return [({'stage': name}, self.stage_active[name]) for name in self.stage_limits]
 
 queue_manager = QueueManager()
+metrics.gauge('stage_queue_depth', 'Trabajos esperando por etapa', collect=queue_manager.stage_depths)
+metrics.gauge('stage_active_jobs', 'Slots ocupados por etapa', collect=queue_manager.stage_usage)
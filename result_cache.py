@@ -0,0 +1,119 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from config import CACHE_DB_PATH
+
+class ResultCache:
+    """
+    Caché persistente de resultados: (file_unique_id, preset, hash de parámetros)
+    -> file_id del video comprimido ya subido a Telegram + sus estadísticas.
+    Los trabajos idénticos en curso se agrupan: sólo uno codifica y el resto espera.
+    """
+    def __init__(self, db_path=CACHE_DB_PATH):
+        self.db_path = db_path
+        self.in_flight = {}
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                " file_unique_id TEXT NOT NULL,"
+                " preset TEXT NOT NULL,"
+                " params_hash TEXT NOT NULL,"
+                " file_id TEXT NOT NULL,"
+                " stats TEXT NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " hits INTEGER NOT NULL DEFAULT 0,"
+                " PRIMARY KEY (file_unique_id, preset, params_hash))"
+            )
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _execute(self, query, params=(), fetch=False):
+        with self._lock:
+            conn = self._connect()
+            cursor = conn.execute(query, params)
+            rows = cursor.fetchall() if fetch else None
+            conn.commit()
+            return rows
+
+    @staticmethod
+    def make_key(file_unique_id, preset, params_hash):
+        return (file_unique_id, preset, params_hash)
+
+    async def get(self, key):
+        try:
+            rows = await asyncio.to_thread(
+                self._execute,
+                "SELECT file_id, stats FROM results WHERE file_unique_id = ? AND preset = ? AND params_hash = ?",
+                key, True
+            )
+            if not rows:
+                return None
+            await asyncio.to_thread(
+                self._execute,
+                "UPDATE results SET hits = hits + 1 WHERE file_unique_id = ? AND preset = ? AND params_hash = ?",
+                key
+            )
+            file_id, stats = rows[0]
+            return {'file_id': file_id, 'stats': json.loads(stats)}
+        except Exception as e:
+            print(f"Error leyendo caché de resultados: {e}")
+            return None
+
+    async def acquire(self, key, accept=None):
+        """
+        Devuelve la entrada cacheada si existe (esperando a un trabajo idéntico en curso).
+        Si devuelve None, quien llama queda a cargo de producir el resultado y debe
+        llamar a complete() al terminar, haya tenido éxito o no. Con `accept`, una
+        entrada guardada que no lo cumple cuenta como ausente y se vuelve a producir;
+        la de un trabajo idéntico que termina mientras se espera se acepta siempre.
+        """
+        while True:
+            entry = await self.get(key)
+            if entry and (accept is None or accept(entry)):
+                return entry
+            future = self.in_flight.get(key)
+            if future is None:
+                self.in_flight[key] = asyncio.get_running_loop().create_future()
+                return None
+            entry = await asyncio.shield(future)
+            if entry:
+                return entry
+            # El trabajo original falló: se vuelve a intentar y quizá se reclama el slot
+
+    async def complete(self, key, file_id=None, stats=None):
+        entry = None
+        if file_id:
+            entry = {'file_id': file_id, 'stats': stats or {}}
+            try:
+                await asyncio.to_thread(
+                    self._execute,
+                    "INSERT OR REPLACE INTO results (file_unique_id, preset, params_hash, file_id, stats, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (*key, file_id, json.dumps(stats or {}), time.time())
+                )
+            except Exception as e:
+                print(f"Error guardando en caché de resultados: {e}")
+        future = self.in_flight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(entry)
+
+    async def invalidate(self, key):
+        try:
+            await asyncio.to_thread(
+                self._execute,
+                "DELETE FROM results WHERE file_unique_id = ? AND preset = ? AND params_hash = ?",
+                key
+            )
+        except Exception as e:
+            print(f"Error invalidando caché de resultados: {e}")
+
+result_cache = ResultCache()
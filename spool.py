@@ -0,0 +1,231 @@
+import asyncio
+import os
+import shutil
+import time
+from cancellation import JobCancelled
+from config import DOWNLOAD_DIR, SPOOL_DIR, SPOOL_MIN_FREE, SPOOL_MAX_AGE, SPOOL_SCAN_INTERVAL, SPOOL_MAX_WAIT
+
+# Proporción estimada salida/entrada por preset, para reservar espacio antes de descargar
+OUTPUT_RATIOS = {
+    '240p': 0.3,
+    '360p': 0.4,
+    '480p': 0.6,
+    '720p': 0.8,
+    'original': 1.0
+}
+
+class SpoolFullError(Exception):
+    pass
+
+def path_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, name))
+            except OSError:
+                pass
+    return total
+
+def last_used(path):
+    """Último acceso/modificación de un archivo o de cualquier cosa dentro de un directorio."""
+    latest = os.stat(path).st_mtime
+    if os.path.isdir(path):
+        for dirpath, _, filenames in os.walk(path):
+            for name in filenames:
+                try:
+                    stat = os.stat(os.path.join(dirpath, name))
+                    latest = max(latest, stat.st_mtime, stat.st_atime)
+                except OSError:
+                    pass
+    return latest
+
+def estimate_job_space(input_size, quality='360p', target_size=None, segmented=False):
+    """Bytes a reservar: entrada + salida proyectada (+ segmentos intermedios)."""
+    if target_size:
+        projected = min(target_size, input_size)
+    else:
+        projected = input_size * OUTPUT_RATIOS.get(quality, 1.0)
+    estimate = input_size + projected
+    if segmented:
+        estimate += input_size
+    return int(estimate)
+
+class Workspace:
+    def __init__(self, job_id, root, reserved):
+        self.job_id = job_id
+        self.dir = os.path.join(root, str(job_id))
+        self.reserved = reserved
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+class SpoolManager:
+    """
+    Directorio de trabajo aislado por trabajo, con reserva de espacio en disco antes
+    de descargar (admisión) y expulsión LRU de restos huérfanos en segundo plano.
+    """
+    def __init__(self, root=SPOOL_DIR, min_free=SPOOL_MIN_FREE):
+        self.root = os.path.abspath(root)
+        self.min_free = min_free
+        self.workspaces = {}
+        # Trabajos rehidratados tras un reinicio: su workspace no es un huérfano
+        self.retained = set()
+        self._space_freed = asyncio.Condition()
+        self._janitor = None
+        os.makedirs(self.root, exist_ok=True)
+
+    def start(self):
+        if self._janitor is None or self._janitor.done():
+            self._janitor = asyncio.create_task(self._janitor_loop())
+
+    def outstanding(self):
+        """Espacio reservado que los trabajos activos aún no han escrito."""
+        pending = 0
+        for workspace in self.workspaces.values():
+            pending += max(workspace.reserved - path_size(workspace.dir), 0)
+        return pending
+
+    def available(self):
+        return shutil.disk_usage(self.root).free - self.outstanding() - self.min_free
+
+    async def acquire(self, job_id, estimate, on_wait=None, cancelled=None):
+        """
+        Crea el workspace del trabajo reservando `estimate` bytes (o devuelve el que ya
+        tiene). Si no hay espacio, expulsa restos huérfanos y, si aún no alcanza, espera
+        a que otro trabajo libere; lanza JobCancelled si `cancelled()` se vuelve verdadero.
+        """
+        existing = self.workspaces.get(job_id)
+        if existing:
+            # Ya reservado por una etapa anterior del mismo trabajo (vista previa)
+            existing.reserved = max(existing.reserved, estimate)
+            return existing
+
+        capacity = shutil.disk_usage(self.root).total - self.min_free
+        if estimate > capacity:
+            raise SpoolFullError("El video es demasiado grande para el disco disponible.")
+
+        deadline = time.monotonic() + SPOOL_MAX_WAIT
+        notified = False
+        async with self._space_freed:
+            while self.available() < estimate:
+                # Recorrer y borrar huérfanos es E/S de disco: fuera del event loop
+                await asyncio.to_thread(self.evict, estimate - self.available())
+                if self.available() >= estimate:
+                    break
+                if time.monotonic() > deadline:
+                    raise SpoolFullError("No hay espacio en disco suficiente. Intenta más tarde.")
+                if cancelled and cancelled():
+                    raise JobCancelled()
+                if on_wait and not notified:
+                    notified = True
+                    await on_wait()
+                try:
+                    # Se revisa periódicamente: el espacio también lo liberan procesos externos
+                    await asyncio.wait_for(self._space_freed.wait(), timeout=10)
+                except asyncio.TimeoutError:
+                    pass
+
+            workspace = Workspace(job_id, self.root, estimate)
+            os.makedirs(workspace.dir, exist_ok=True)
+            self.workspaces[job_id] = workspace
+            return workspace
+
+    def adjust(self, workspace, estimate):
+        """Corrige la reserva cuando se conoce mejor el consumo (p. ej. descarga en streaming)."""
+        workspace.reserved = estimate
+
+    def retain(self, job_id):
+        self.retained.add(str(job_id))
+
+    async def forget(self, job_id):
+        """
+        Libera el workspace de un trabajo que no va a seguir (cancelado en cola), tanto
+        si ya lo reservó como si sólo quedó retenido tras un reinicio.
+        """
+        workspace = self.workspaces.get(job_id)
+        if workspace is None:
+            if str(job_id) not in self.retained:
+                return
+            workspace = Workspace(job_id, self.root, 0)
+        await self.release(workspace)
+
+    async def release(self, workspace):
+        self.workspaces.pop(workspace.job_id, None)
+        self.retained.discard(str(workspace.job_id))
+        await asyncio.to_thread(shutil.rmtree, workspace.dir, True)
+        async with self._space_freed:
+            self._space_freed.notify_all()
+
+    def is_active(self, path):
+        path = os.path.abspath(path)
+        # Copia de los valores: evict() corre en un hilo mientras el loop reserva workspaces
+        return any(path == w.dir or path.startswith(w.dir + os.sep) for w in list(self.workspaces.values()))
+
+    def orphans(self):
+        """Restos que no pertenecen a ningún trabajo activo, del menos usado al más reciente."""
+        candidates = []
+        for base in (self.root, os.path.abspath(DOWNLOAD_DIR)):
+            for name in os.listdir(base):
+                path = os.path.join(base, name)
+                if path == self.root or '.session' in name or self.is_active(path):
+                    continue
+                if base == self.root and name in self.retained:
+                    continue
+                try:
+                    candidates.append((last_used(path), path))
+                except OSError:
+                    pass
+        candidates.sort()
+        return [path for _, path in candidates]
+
+    def remove(self, path):
+        size = path_size(path)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+        return size
+
+    def evict(self, needed=0, max_age=None):
+        """Borra huérfanos LRU hasta liberar `needed` bytes, más los que superen `max_age`."""
+        freed = 0
+        now = time.time()
+        for path in self.orphans():
+            try:
+                expired = max_age is not None and now - last_used(path) > max_age
+                if freed >= needed and not expired:
+                    continue
+                freed += self.remove(path)
+                print(f"🧹 Spool: expulsado {path}")
+            except OSError as e:
+                print(f"Error expulsando {path}: {e}")
+        return freed
+
+    def purge(self):
+        """Borra todos los huérfanos (comando /cache). Devuelve (archivos, bytes)."""
+        count = 0
+        freed = 0
+        for path in self.orphans():
+            try:
+                freed += self.remove(path)
+                count += 1
+            except OSError as e:
+                print(f"Error deleting {path}: {e}")
+        return count, freed
+
+    async def _janitor_loop(self):
+        while True:
+            await asyncio.sleep(SPOOL_SCAN_INTERVAL)
+            try:
+                needed = max(-self.available(), 0)
+                freed = await asyncio.to_thread(self.evict, needed, SPOOL_MAX_AGE)
+                if freed:
+                    async with self._space_freed:
+                        self._space_freed.notify_all()
+            except Exception as e:
+                print(f"Error en limpieza del spool: {e}")
+
+spool = SpoolManager()
@@ -0,0 +1,153 @@
+import asyncio
+import time
+from collections import OrderedDict
+from pyrogram.errors import FloodWait, MessageNotModified, RPCError
+from tracing import tracer
+from config import STATUS_CHAT_RATE, STATUS_CHAT_BURST, STATUS_GLOBAL_RATE, STATUS_GLOBAL_BURST
+
+# Errores de red seguidos en un mismo mensaje antes de descartar su texto
+NETWORK_RETRIES = 3
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """Segundos hasta que haya un token disponible (0 si ya lo hay)."""
+        self._refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+class StatusUpdater:
+    """
+    Único punto de salida para editar mensajes de estado. Las actualizaciones se
+    agrupan por mensaje (sólo se envía el último texto), se respetan los límites
+    por chat y global de Telegram con token buckets, y un FloodWait pausa todas
+    las ediciones en vez de descartarse en silencio.
+    """
+    def __init__(self, chat_rate=STATUS_CHAT_RATE, chat_burst=STATUS_CHAT_BURST,
+                 global_rate=STATUS_GLOBAL_RATE, global_burst=STATUS_GLOBAL_BURST):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_buckets = {}
+        self.pending = {}
+        self.last_text = OrderedDict()
+        self.drainers = {}
+        self.paused_until = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.flood_waits = 0
+
+    @staticmethod
+    def _key(message):
+        return (message.chat.id, message.id)
+
+    def update(self, message, text):
+        """Programa una edición sin esperar. Si ya había una pendiente, se reemplaza."""
+        key = self._key(message)
+        if key in self.pending:
+            self.coalesced += 1
+        elif self.last_text.get(key) == text:
+            return
+        self.pending[key] = (message, text)
+        drainer = self.drainers.get(key)
+        if drainer is None or drainer.done():
+            self.drainers[key] = asyncio.create_task(self._drain(key))
+
+    async def delete(self, message):
+        """Descarta lo pendiente y borra el mensaje de estado."""
+        self.forget(message)
+        try:
+            await message.delete()
+        except Exception:
+            pass
+
+    def forget(self, message):
+        key = self._key(message)
+        self.pending.pop(key, None)
+        self.last_text.pop(key, None)
+        drainer = self.drainers.pop(key, None)
+        if drainer is not None and not drainer.done():
+            drainer.cancel()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _drain(self, key):
+        chat_bucket = self._chat_bucket(key[0])
+        failures = 0
+        while key in self.pending:
+            wait = max(chat_bucket.delay(), self.global_bucket.delay(), self.paused_until - time.monotonic())
+            if wait > 0:
+                # Mientras se espera, nuevas llamadas a update() reemplazan el texto pendiente
+                await asyncio.sleep(wait)
+                continue
+
+            message, text = self.pending.pop(key)
+            if self.last_text.get(key) == text:
+                continue
+            chat_bucket.take()
+            self.global_bucket.take()
+            try:
+                # El drainer hereda la traza del trabajo que lo creó
+                with tracer.span('status_edit'):
+                    await message.edit_text(text)
+                self._remember(key, text)
+                self.sent += 1
+                failures = 0
+            except FloodWait as e:
+                # El castigo es por sesión: se pausan todas las ediciones y se reintenta
+                self.flood_waits += 1
+                self.paused_until = max(self.paused_until, time.monotonic() + e.value)
+                print(f"⏳ FloodWait de {e.value}s en ediciones de estado")
+                self.pending.setdefault(key, (message, text))
+            except MessageNotModified:
+                self._remember(key, text)
+            except RPCError as e:
+                # Mensaje borrado, sin permisos, etc.: no tiene sentido seguir editándolo
+                print(f"Error editando mensaje de estado: {e}")
+                self.pending.pop(key, None)
+            except Exception as e:
+                # Red caída o timeout: el texto (quizá el estado final) se reintenta con el
+                # ritmo de los buckets, salvo que llegue uno más nuevo; tras varios fallos se descarta
+                failures += 1
+                print(f"Error de red editando mensaje de estado ({failures}/{NETWORK_RETRIES}): {e}")
+                if failures < NETWORK_RETRIES:
+                    self.pending.setdefault(key, (message, text))
+        if self.drainers.get(key) is asyncio.current_task():
+            del self.drainers[key]
+        self._prune()
+
+    def _remember(self, key, text):
+        self.last_text[key] = text
+        self.last_text.move_to_end(key)
+        while len(self.last_text) > 4096:
+            self.last_text.popitem(last=False)
+
+    def _prune(self):
+        """Olvida los buckets de chats inactivos (llenos y sin ediciones en curso)."""
+        if len(self.chat_buckets) <= 1024:
+            return
+        active = {key[0] for key in self.drainers}
+        for chat_id, bucket in list(self.chat_buckets.items()):
+            if chat_id not in active and bucket.delay() == 0 and bucket.tokens >= bucket.capacity:
+                del self.chat_buckets[chat_id]
+
+status_updater = StatusUpdater()
@@ -0,0 +1,265 @@
+import asyncio
+import math
+import mmap
+import os
+import time
+from pyrogram import raw, types, utils
+from pyrogram.session import Session
+from config import STREAM_UPLOAD_WORKERS, UPLOAD_CONNECTIONS
+
+PART_SIZE = 512 * 1024
+# Telegram sólo acepta partes "grandes" (sin tamaño total conocido) desde 10 MB;
+# por debajo la subida normal al final es igual de rápida
+BIG_FILE_MIN = 10 * 1024 * 1024
+POLL_INTERVAL = 0.5
+PART_RETRIES = 3
+# Partes en vuelo por conexión en la subida en paralelo
+PARTS_PER_CONNECTION = 2
+
+async def open_media_session(client):
+    session = Session(
+        client, await client.storage.dc_id(), await client.storage.auth_key(),
+        await client.storage.test_mode(), is_media=True
+    )
+    await session.start()
+    return session
+
+async def save_part(session, file_id, part, total, chunk):
+    """SaveBigFilePart con reintentos: una parte que falla no reinicia la subida."""
+    for attempt in range(PART_RETRIES):
+        try:
+            await session.invoke(raw.functions.upload.SaveBigFilePart(
+                file_id=file_id,
+                file_part=part,
+                file_total_parts=total,
+                bytes=chunk
+            ))
+            return
+        except Exception:
+            if attempt == PART_RETRIES - 1:
+                raise
+            await asyncio.sleep(1 + attempt)
+
+async def send_uploaded_video(client, message, input_file, caption, result, file_name):
+    """Envía como respuesta a `message` un archivo ya subido (equivale a reply_video)."""
+    attributes = [
+        raw.types.DocumentAttributeVideo(
+            supports_streaming=True,
+            duration=int(result.get('duration') or 0),
+            w=result.get('width') or 0,
+            h=result.get('height') or 0
+        ),
+        raw.types.DocumentAttributeFilename(file_name=file_name)
+    ]
+    r = await client.invoke(
+        raw.functions.messages.SendMedia(
+            peer=await client.resolve_peer(message.chat.id),
+            media=raw.types.InputMediaUploadedDocument(
+                mime_type="video/mp4", file=input_file, attributes=attributes
+            ),
+            reply_to_msg_id=message.id,
+            random_id=client.rnd_id(),
+            **await utils.parse_text_entities(client, caption, None, None)
+        )
+    )
+    for update in r.updates:
+        if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+            return await types.Message._parse(
+                client, update.message,
+                {user.id: user for user in r.users},
+                {chat.id: chat for chat in r.chats}
+            )
+    return None
+
+class ParallelUpload:
+    """
+    Sube un archivo terminado repartiendo sus partes entre UPLOAD_CONNECTIONS
+    sesiones de media (save_file de Pyrogram usa una sola y descarta las partes
+    que fallan). El archivo se lee con mmap y cada parte se reintenta sola.
+    """
+    def __init__(self, client, path, connections=UPLOAD_CONNECTIONS):
+        self.client = client
+        self.path = path
+        self.connections = max(1, connections)
+        self.file_id = client.rnd_id()
+        self.uploaded = 0
+
+    async def run(self, progress=None):
+        """Devuelve el InputFileBig para send_uploaded_video."""
+        size = os.path.getsize(self.path)
+        total = math.ceil(size / PART_SIZE)
+        parts = asyncio.Queue()
+        for part in range(total):
+            parts.put_nowait(part)
+
+        sessions = []
+        with open(self.path, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            async def worker(session):
+                while True:
+                    try:
+                        part = parts.get_nowait()
+                    except asyncio.QueueEmpty:
+                        return
+                    chunk = mm[part * PART_SIZE:(part + 1) * PART_SIZE]
+                    await save_part(session, self.file_id, part, total, chunk)
+                    self.uploaded += len(chunk)
+                    if progress:
+                        await progress(self.uploaded, size)
+
+            try:
+                openers = [
+                    asyncio.create_task(open_media_session(self.client))
+                    for _ in range(min(self.connections, total))
+                ]
+                try:
+                    await asyncio.gather(*openers, return_exceptions=True)
+                finally:
+                    # También si se cancela a mitad: las sesiones que llegaron a abrirse se cierran abajo
+                    for task in openers:
+                        task.cancel()
+                    await asyncio.gather(*openers, return_exceptions=True)
+                    sessions = [task.result() for task in openers if not task.cancelled() and not task.exception()]
+                errors = [task.exception() for task in openers if not task.cancelled() and task.exception()]
+                if errors:
+                    if not sessions:
+                        raise errors[0]
+                    print(f"⚠️ Subida en paralelo con {len(sessions)} de {len(openers)} conexiones: {errors[0]}")
+                workers = [
+                    asyncio.create_task(worker(session))
+                    for session in sessions for _ in range(PARTS_PER_CONNECTION)
+                ]
+                try:
+                    await asyncio.gather(*workers)
+                finally:
+                    for task in workers:
+                        task.cancel()
+                    await asyncio.gather(*workers, return_exceptions=True)
+            finally:
+                for session in sessions:
+                    await session.stop()
+        return raw.types.InputFileBig(id=self.file_id, parts=total, name=os.path.basename(self.path))
+
+class GrowingFileUpload:
+    """
+    Sube a Telegram un archivo mientras FFmpeg todavía lo escribe (MP4 fragmentado:
+    los bytes sólo se agregan al final). Las partes completas se envían con
+    file_total_parts=-1 y, cuando termina el encode, las que faltan con el total
+    real; así la subida termina poco después del encode en lugar de empezar ahí.
+    """
+    def __init__(self, client, path, file_name="video.mp4"):
+        self.client = client
+        self.path = path
+        self.file_name = file_name
+        self.file_id = client.rnd_id()
+        self.sent_parts = 0
+        self.final_size = None
+        self.finished = asyncio.Event()
+        self.finished_at = None
+        self.task = None
+
+    @property
+    def sent_bytes(self):
+        if self.final_size is not None:
+            return min(self.sent_parts * PART_SIZE, self.final_size)
+        return self.sent_parts * PART_SIZE
+
+    def start(self, slot=None):
+        """Arranca la subida en segundo plano; con `slot` (un context manager async) corre dentro de él."""
+        self.task = asyncio.create_task(self._run_in(slot) if slot else self._run())
+
+    def finish(self, ok):
+        """El encode terminó: con ok=False (error, cancelación, se reenvía el original) se abandona."""
+        if self.finished.is_set():
+            return
+        if ok and os.path.exists(self.path):
+            self.final_size = os.path.getsize(self.path)
+        self.finished_at = time.monotonic()
+        self.finished.set()
+
+    async def result(self):
+        """InputFileBig listo para enviar, o None si hay que subir el archivo como siempre."""
+        if self.task is None:
+            return None
+        try:
+            return await self.task
+        except Exception as e:
+            print(f"Error en la subida durante el encode: {e}")
+            return None
+
+    async def send(self, message, caption, result):
+        input_file = await self.result()
+        if input_file is None:
+            return None
+        return await send_uploaded_video(self.client, message, input_file, caption, result, self.file_name)
+
+    async def cancel(self):
+        self.finish(False)
+        if self.task and not self.task.done():
+            self.task.cancel()
+            try:
+                await self.task
+            except BaseException:
+                pass
+
+    async def _run_in(self, slot):
+        async with slot:
+            return await self._run()
+
+    def _written(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    async def _run(self):
+        session = None
+        fp = None
+        try:
+            while True:
+                done = self.finished.is_set()
+                if done and self.final_size is None:
+                    return None
+                size = self.final_size if done else self._written()
+
+                if session is None:
+                    if size <= BIG_FILE_MIN:
+                        if done:
+                            return None
+                        await self._wait()
+                        continue
+                    fp = open(self.path, 'rb')
+                    session = await open_media_session(self.client)
+
+                if done:
+                    total = math.ceil(size / PART_SIZE)
+                    ready = total
+                else:
+                    # La última parte completa se guarda para mandarla con el total real
+                    total = -1
+                    ready = max(size // PART_SIZE - 1, 0)
+
+                while self.sent_parts < ready:
+                    batch = range(self.sent_parts, min(ready, self.sent_parts + STREAM_UPLOAD_WORKERS))
+                    chunks = []
+                    for part in batch:
+                        fp.seek(part * PART_SIZE)
+                        chunks.append((part, fp.read(PART_SIZE)))
+                    await asyncio.gather(*(
+                        save_part(session, self.file_id, part, total, chunk) for part, chunk in chunks
+                    ))
+                    self.sent_parts += len(chunks)
+
+                if done:
+                    return raw.types.InputFileBig(id=self.file_id, parts=total, name=self.file_name)
+                await self._wait()
+        finally:
+            if fp:
+                fp.close()
+            if session:
+                await session.stop()
+
+    async def _wait(self):
+        try:
+            await asyncio.wait_for(self.finished.wait(), timeout=POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
@@ -0,0 +1,82 @@
+MATROSKA_MAGIC = b'\x1a\x45\xdf\xa3'
+MP4_BOXES = (b'ftyp', b'moov', b'mdat', b'free', b'skip', b'wide', b'pdin')
+TS_PACKET_SIZE = 188
+
+def mp4_moov_first(head):
+    """
+    Recorre las cajas de nivel superior de un MP4/MOV: True si 'moov' aparece
+    antes de 'mdat' (se puede decodificar sin buscar hacia el final del archivo).
+    """
+    offset = 0
+    while offset + 8 <= len(head):
+        size = int.from_bytes(head[offset:offset + 4], 'big')
+        box = head[offset + 4:offset + 8]
+        if box == b'moov':
+            return True
+        if box == b'mdat':
+            return False
+        if size == 1:
+            if offset + 16 > len(head):
+                return False
+            size = int.from_bytes(head[offset + 8:offset + 16], 'big')
+        elif size == 0:
+            # La caja ocupa el resto del archivo
+            return False
+        if size < 8:
+            return False
+        offset += size
+    return False
+
+def is_streamable(head):
+    """Decide por los primeros bytes si FFmpeg puede leer el contenedor desde un pipe."""
+    if head.startswith(MATROSKA_MAGIC) or head.startswith(b'FLV'):
+        return True
+    if len(head) > 2 * TS_PACKET_SIZE and head[0] == 0x47 and head[TS_PACKET_SIZE] == 0x47:
+        return True
+    if head[4:8] in MP4_BOXES:
+        return mp4_moov_first(head)
+    # AVI, WMV y desconocidos: se descargan a disco antes de comprimir
+    return False
+
+class MediaStream:
+    """Iterador asíncrono sobre los chunks de una descarga que ya entregó su primer chunk."""
+    def __init__(self, head, chunks):
+        self.head = head
+        self.chunks = chunks
+        self.bytes_read = 0
+        self.info = None
+        self._closed = False
+
+    async def __aiter__(self):
+        self.bytes_read += len(self.head)
+        yield self.head
+        async for chunk in self.chunks:
+            self.bytes_read += len(chunk)
+            yield chunk
+
+    async def aclose(self):
+        if not self._closed:
+            self._closed = True
+            try:
+                await self.chunks.aclose()
+            except Exception:
+                pass
+
+async def open_media_stream(client, message):
+    """
+    Empieza a descargar el video de `message` en streaming. Devuelve un MediaStream
+    si el contenedor admite lectura secuencial, o None para usar la descarga a disco.
+    """
+    chunks = client.stream_media(message)
+    try:
+        head = await chunks.__anext__()
+    except StopAsyncIteration:
+        return None
+    except Exception as e:
+        print(f"Error iniciando descarga en streaming: {e}")
+        return None
+
+    if not is_streamable(head):
+        await chunks.aclose()
+        return None
+    return MediaStream(head, chunks)
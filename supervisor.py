@@ -0,0 +1,292 @@
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import platform
+import resource
+import signal
+from collections import deque
+from cancellation import JobCancelled
+from metrics import metrics
+from config import (
+    FFMPEG_THREADS, FFMPEG_INTERACTIVE_MAX_DURATION, FFMPEG_PIN_CPUS, FFMPEG_MEMORY_LIMIT,
+    FFMPEG_CPU_QUOTA, FFMPEG_CGROUP
+)
+
+# Clases de prioridad: el bot (nice 0) siempre va por delante de cualquier FFmpeg,
+# los clips cortos por delante de los videos largos y el análisis de fondo al final.
+# ioclass: 2 = best-effort (nivel 0-7), 3 = idle
+PRIORITY_CLASSES = {
+    'interactive': {'nice': 5, 'ioclass': 2, 'iolevel': 4, 'cpu_weight': 200},
+    'bulk': {'nice': 12, 'ioclass': 2, 'iolevel': 7, 'cpu_weight': 50},
+    'background': {'nice': 19, 'ioclass': 3, 'iolevel': 0, 'cpu_weight': 10}
+}
+
+STDERR_LINES = 40
+STDERR_LINE_MAX = 512
+KILL_TIMEOUT = 5
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_SET_SYSCALL = {'x86_64': 251, 'aarch64': 30}
+
+class SupervisedProcess:
+    """
+    Proceso hijo bajo el supervisor. El stderr se drena siempre a un buffer circular
+    (un encode ruidoso no puede llenar el pipe y trabarse) y al salir del bloque
+    `async with` el proceso queda muerto y recogido, pase lo que pase.
+    """
+    def __init__(self, supervisor, proc, name, cpus=None, cgroup=None):
+        self.supervisor = supervisor
+        self.proc = proc
+        self.name = name
+        self.cpus = cpus
+        self.cgroup = cgroup
+        self.stderr_lines = deque(maxlen=STDERR_LINES)
+        self._drainer = asyncio.create_task(self._drain_stderr()) if proc.stderr else None
+        self._closed = False
+
+    @property
+    def pid(self):
+        return self.proc.pid
+
+    @property
+    def stdin(self):
+        return self.proc.stdin
+
+    @property
+    def stdout(self):
+        return self.proc.stdout
+
+    @property
+    def returncode(self):
+        return self.proc.returncode
+
+    async def _drain_stderr(self):
+        stderr = self.proc.stderr
+        while True:
+            try:
+                line = await stderr.readline()
+            except Exception as e:
+                # Una línea más larga que el límite del StreamReader se descarta y se sigue:
+                # dejar de leer trabaría al proceso con el pipe lleno
+                print(f"⚠️ {self.name} ({self.proc.pid}): error leyendo stderr: {e}")
+                if stderr.exception() is not None:
+                    # El pipe quedó en error: ya no llega nada más
+                    return
+                continue
+            if not line:
+                return
+            self.stderr_lines.append(line[:STDERR_LINE_MAX].decode('utf-8', 'ignore').rstrip())
+
+    def stderr_tail(self, chars=500):
+        return '\n'.join(self.stderr_lines)[-chars:]
+
+    async def wait(self):
+        await self.proc.wait()
+        if self._drainer:
+            # El pipe se cierra con el proceso: lo que quedaba ya está en el buffer
+            await asyncio.gather(self._drainer, return_exceptions=True)
+        self._close()
+        return self.proc.returncode
+
+    async def kill(self):
+        """SIGKILL al grupo del proceso y espera a recogerlo."""
+        if self.proc.returncode is None:
+            try:
+                os.killpg(self.proc.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                try:
+                    self.proc.kill()
+                except ProcessLookupError:
+                    pass
+            try:
+                await asyncio.wait_for(asyncio.shield(self.proc.wait()), timeout=KILL_TIMEOUT)
+            except asyncio.TimeoutError:
+                # Bloqueado en el kernel (disco): se recoge cuando salga
+                print(f"⚠️ {self.name} ({self.proc.pid}) no terminó tras SIGKILL")
+                asyncio.ensure_future(self.wait())
+                return
+        await self.wait()
+
+    def _close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self.supervisor._release(self)
+
+    async def __aenter__(self):
+        return self
+
+    async def reap(self):
+        """Mata el proceso si sigue vivo y lo recoge."""
+        if self.proc.returncode is None:
+            await self.kill()
+        else:
+            await self.wait()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.reap()
+
+class ProcessSupervisor:
+    """
+    Lanza todos los FFmpeg/ffprobe del bot con prioridad (nice/ionice) según su clase,
+    sin volcados de memoria, con un límite de memoria opcional (cgroup v2 con
+    FFMPEG_CGROUP o RLIMIT_AS sin él) y, para los encodes, fijados a un grupo de
+    CPUs propio de FFMPEG_THREADS núcleos para que no se pisen entre ellos.
+
+    Los límites se aplican desde el bot justo después de lanzar el proceso (sin
+    preexec_fn, que no es seguro con hilos): FFmpeg crea sus hilos de trabajo más
+    tarde, al abrir la entrada, y los heredan.
+    """
+    def __init__(self):
+        self.cpu_groups = self._cpu_groups()
+        self.group_usage = [0] * len(self.cpu_groups)
+        self.running = set()
+        self._libc = None
+        self._warned = set()
+
+    def _cpu_groups(self):
+        try:
+            cpus = sorted(os.sched_getaffinity(0))
+        except AttributeError:
+            return []
+        size = max(FFMPEG_THREADS, 1)
+        groups = [set(cpus[i:i + size]) for i in range(0, len(cpus) - size + 1, size)]
+        # Con un solo grupo fijar no aporta nada
+        return groups if FFMPEG_PIN_CPUS and len(groups) > 1 else []
+
+    def priority_for(self, duration):
+        # Duración desconocida (0 o el 1 de relleno del compresor): se asume larga
+        return 'interactive' if 1 < duration <= FFMPEG_INTERACTIVE_MAX_DURATION else 'bulk'
+
+    async def spawn(self, cmd, priority='bulk', stdin=False, stdout=False, pin=False):
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.PIPE if stdin else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE if stdout else asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+            # Grupo de procesos propio: se puede matar entero
+            start_new_session=True
+        )
+        cpus = self._pick_cpus() if pin else None
+        cgroup = self._limit(proc.pid, PRIORITY_CLASSES.get(priority, PRIORITY_CLASSES['bulk']), cpus)
+        process = SupervisedProcess(self, proc, os.path.basename(cmd[0]), cpus, cgroup)
+        self.running.add(process)
+        return process
+
+    async def run(self, cmd, priority='bulk', input=None, stdout=False, timeout=None, token=None):
+        """
+        Ejecuta un comando completo. Devuelve (returncode, stdout, cola de stderr); -1 si
+        se pasó de `timeout` o si se canceló el trabajo dueño de `token` (CancelToken).
+        """
+        async with await self.spawn(cmd, priority, stdin=input is not None, stdout=stdout) as process:
+            async def feed():
+                try:
+                    process.stdin.write(input)
+                    await process.stdin.drain()
+                except (BrokenPipeError, ConnectionResetError):
+                    # Al proceso le alcanzó con una parte de la entrada
+                    pass
+                process.stdin.close()
+
+            async def communicate():
+                reads = [process.stdout.read()] if stdout else []
+                if input is not None:
+                    reads.append(feed())
+                results = await asyncio.gather(*reads)
+                await process.wait()
+                return results[0] if stdout else b''
+
+            try:
+                waiting = communicate() if token is None else token.wait_for(communicate())
+                output = await asyncio.wait_for(waiting, timeout)
+            except asyncio.TimeoutError:
+                print(f"⏱️ {process.name} superó {timeout}s: se termina")
+                await process.kill()
+                return -1, b'', process.stderr_tail()
+            except JobCancelled:
+                await process.kill()
+                return -1, b'', process.stderr_tail()
+            return process.returncode, output, process.stderr_tail()
+
+    def process_counts(self):
+        """Todos los procesos vivos bajo el supervisor: encodes, análisis, probes, cortes."""
+        return [({}, len(self.running))]
+
+    def _pick_cpus(self):
+        if not self.cpu_groups:
+            return None
+        index = min(range(len(self.cpu_groups)), key=lambda i: self.group_usage[i])
+        self.group_usage[index] += 1
+        return index
+
+    def _release(self, process):
+        self.running.discard(process)
+        if process.cpus is not None:
+            self.group_usage[process.cpus] -= 1
+        if process.cgroup:
+            try:
+                os.rmdir(process.cgroup)
+            except OSError:
+                pass
+
+    def _limit(self, pid, klass, cpus):
+        """Aplica prioridad, CPUs y límites al proceso; todo es best-effort. Devuelve su cgroup."""
+        self._try('nice', os.setpriority, os.PRIO_PROCESS, pid, klass['nice'])
+        self._try('ionice', self._ionice, pid, klass['ioclass'], klass['iolevel'])
+        self._try('rlimit', resource.prlimit, pid, resource.RLIMIT_CORE, (0, 0))
+        if cpus is not None:
+            self._try('affinity', os.sched_setaffinity, pid, self.cpu_groups[cpus])
+        cgroup = None
+        if FFMPEG_CGROUP:
+            cgroup = self._try('cgroup', self._cgroup, pid, klass)
+        if FFMPEG_MEMORY_LIMIT and not cgroup:
+            self._try('rlimit', resource.prlimit, pid, resource.RLIMIT_AS, (FFMPEG_MEMORY_LIMIT, FFMPEG_MEMORY_LIMIT))
+        return cgroup
+
+    def _try(self, what, func, *args):
+        try:
+            return func(*args)
+        except (OSError, ValueError, AttributeError) as e:
+            if what not in self._warned:
+                # Una vez por tipo: en contenedores sin permisos fallaría con cada proceso
+                self._warned.add(what)
+                print(f"⚠️ Supervisor: no se pudo aplicar {what}: {e}")
+            return None
+
+    def _ionice(self, pid, ioclass, level):
+        number = IOPRIO_SET_SYSCALL.get(platform.machine())
+        if number is None:
+            raise OSError(f"ioprio_set no disponible en {platform.machine()}")
+        if self._libc is None:
+            self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if self._libc.syscall(number, IOPRIO_WHO_PROCESS, pid, (ioclass << IOPRIO_CLASS_SHIFT) | level) < 0:
+            raise OSError(ctypes.get_errno(), "ioprio_set")
+
+    def _cgroup(self, pid, klass):
+        """cgroup v2 hijo de FFMPEG_CGROUP (delegado y con los controladores cpu/memory activos)."""
+        path = os.path.join(FFMPEG_CGROUP, f"ffmpeg-{pid}")
+        os.makedirs(path, exist_ok=True)
+        settings = {'cpu.weight': klass['cpu_weight']}
+        if FFMPEG_MEMORY_LIMIT:
+            settings['memory.max'] = FFMPEG_MEMORY_LIMIT
+            # Sin swap y con OOM acotado a este FFmpeg: el kernel no elige al bot
+            settings['memory.swap.max'] = 0
+            settings['memory.oom.group'] = 1
+        if FFMPEG_CPU_QUOTA:
+            settings['cpu.max'] = f"{int(FFMPEG_CPU_QUOTA * 100000)} 100000"
+        for name, value in settings.items():
+            self._try(name, self._write, os.path.join(path, name), value)
+        try:
+            self._write(os.path.join(path, 'cgroup.procs'), pid)
+        except OSError:
+            os.rmdir(path)
+            raise
+        return path
+
+    def _write(self, path, value):
+        with open(path, 'w') as f:
+            f.write(str(value))
+
+supervisor = ProcessSupervisor()
+metrics.gauge('ffmpeg_processes', 'Procesos FFmpeg en ejecución', collect=supervisor.process_counts)
@@ -0,0 +1,45 @@
+import asyncio
+import os
+import pytest
+import api
+from api import JobApi, allowed_path
+
+@pytest.fixture
+def roots(tmp_path, monkeypatch):
+    inside = tmp_path / "inside"
+    outside = tmp_path / "outside"
+    inside.mkdir()
+    outside.mkdir()
+    monkeypatch.setattr(api, 'API_PATHS', [os.path.realpath(inside)])
+    return inside, outside
+
+def test_allowed_path_resolves_symlinks(roots):
+    inside, outside = roots
+    (inside / "link.mp4").symlink_to(outside / "target.mp4")
+    assert allowed_path(str(inside / "video.mp4"))
+    assert not allowed_path(str(inside / "link.mp4"))
+    assert not allowed_path(str(inside) + "-other/video.mp4")
+
+def test_submit_rejects_a_symlinked_output_path(roots):
+    inside, outside = roots
+    (outside / "target.mp4").write_bytes(b'original')
+    (inside / "out.mp4").symlink_to(outside / "target.mp4")
+    (inside / "in.mp4").write_bytes(b'\x00')
+    data = {'path': str(inside / "in.mp4"), 'output_path': str(inside / "out.mp4")}
+    with pytest.raises(PermissionError):
+        asyncio.run(JobApi().submit(data))
+    assert (outside / "target.mp4").read_bytes() == b'original'
+
+def test_deliver_checks_the_destination_again(roots, tmp_path):
+    inside, outside = roots
+    result = tmp_path / "output.mp4"
+    result.write_bytes(b'compressed')
+    job = type('Job', (), {'id': 'job1', 'output_path': str(inside / "out.mp4")})()
+    # El enlace aparece después de encolar el trabajo
+    (inside / "out.mp4").symlink_to(outside / "target.mp4")
+    with pytest.raises(PermissionError):
+        JobApi()._deliver(job, str(result), False)
+    assert not (outside / "target.mp4").exists()
+    os.remove(inside / "out.mp4")
+    assert JobApi()._deliver(job, str(result), False) == os.path.realpath(inside / "out.mp4")
+    assert (inside / "out.mp4").read_bytes() == b'compressed'
@@ -0,0 +1,93 @@
+import asyncio
+import aiohttp
+from aiohttp import web
+import broker as broker_module
+from broker import TaskBroker, add_worker_routes
+from queue_manager import QueueManager
+
+WORKER_SLOTS = 4
+
+def test_broker_encodes_are_not_limited_by_local_slots(tmp_path):
+    async def main():
+        broker = TaskBroker(str(tmp_path / "broker.db"))
+        queue = QueueManager()
+        # Front end de pocos núcleos: un solo slot de encode local
+        queue.stage_semaphores['encode'] = asyncio.Semaphore(1)
+        queue.remote_encode = True
+        worker_id = await broker.register("worker", WORKER_SLOTS)
+
+        async def encode(i):
+            async with queue.encode_stage():
+                return await broker.run(f"task-{i}", f"/in{i}", f"/out{i}", '360p', poll_interval=0.01)
+
+        async def worker():
+            # Sólo termina cuando tiene todas las tareas corriendo a la vez
+            claimed = []
+            while len(claimed) < WORKER_SLOTS:
+                task = await broker.claim(worker_id)
+                if task:
+                    claimed.append(task)
+                else:
+                    await asyncio.sleep(0.01)
+            assert queue.stage_active['encode'] == WORKER_SLOTS
+            for task in claimed:
+                await broker.complete(task['id'], worker_id, {'ok': task['id']})
+
+        results = await asyncio.wait_for(
+            asyncio.gather(worker(), *(encode(i) for i in range(WORKER_SLOTS))), timeout=10
+        )
+        assert results[1:] == [{'ok': f"task-{i}"} for i in range(WORKER_SLOTS)]
+
+    asyncio.run(main())
+
+def test_tasks_carry_front_end_load(tmp_path):
+    async def main():
+        broker = TaskBroker(str(tmp_path / "broker.db"))
+        worker_id = await broker.register("worker", 2)
+        # Dos slots: las dos primeras entran, la tercera ya espera y además hay 3 en la cola del bot
+        for i in range(2):
+            await broker.submit(f"task-{i}", f"/in{i}", f"/out{i}", '360p')
+        await broker.submit("task-2", "/in2", "/out2", '360p', backlog=3)
+        loads = [(await broker.claim(worker_id))['load'] for _ in range(3)]
+        assert loads == [0, 0, 2]
+
+    asyncio.run(main())
+
+def test_task_output_is_capped(tmp_path, monkeypatch):
+    monkeypatch.setattr(broker_module, 'WORKER_TOKEN', 'secret')
+    monkeypatch.setattr(broker_module, 'MAX_FILE_SIZE', 3 * 1024 * 1024)
+
+    async def main():
+        broker = TaskBroker(str(tmp_path / "broker.db"))
+        app = web.Application()
+        add_worker_routes(app, broker)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        base = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+        worker_id = await broker.register("worker", 2)
+        outputs = [str(tmp_path / f"out{i}.mp4") for i in range(2)]
+        for i, output in enumerate(outputs):
+            await broker.submit(f"task-{i}", "/in", output, '360p')
+            await broker.claim(worker_id)
+
+        async def chunks(size):
+            for _ in range(size):
+                yield b'\x00' * (1024 * 1024)
+
+        try:
+            async with aiohttp.ClientSession(headers={'Authorization': 'Bearer secret'}) as session:
+                url = base + "/tasks/{}/output?worker_id=" + worker_id
+                async with session.put(url.format('task-0'), data=chunks(2)) as response:
+                    assert response.status == 200
+                # Sin Content-Length: se corta al pasar el tope y no queda el .part
+                async with session.put(url.format('task-1'), data=chunks(5)) as response:
+                    assert response.status == 413
+        finally:
+            await runner.cleanup()
+        assert (tmp_path / "out0.mp4").stat().st_size == 2 * 1024 * 1024
+        assert not (tmp_path / "out1.mp4").exists()
+        assert not (tmp_path / "out1.mp4.part").exists()
+
+    asyncio.run(main())
@@ -0,0 +1,50 @@
+import asyncio
+import pytest
+from cancellation import CancelToken, JobCancelled
+from compressor import compressor
+from queue_manager import QueueManager
+from result_cache import ResultCache
+
+def test_job_keeps_a_single_token():
+    token = CancelToken()
+    # Un FFmpeg anterior (vista previa) dejó su propio token bajo la misma clave
+    compressor.cancel_token('job-1')
+    assert compressor.cancel_token('job-1', token) is token
+    token.cancel()
+    assert compressor.should_cancel('job-1')
+    compressor.clear_cancel_flag('job-1')
+
+def test_cancel_while_waiting_for_a_stage():
+    async def main():
+        queue = QueueManager()
+        queue.stage_semaphores['encode'] = asyncio.Semaphore(1)
+        token = CancelToken()
+        async with queue.stage('encode'):
+            waiting = asyncio.create_task(queue.stage('encode', token).__aenter__())
+            await asyncio.sleep(0.01)
+            assert queue.stage_waiting['encode'] == 1
+            token.cancel()
+            with pytest.raises(JobCancelled):
+                await asyncio.wait_for(waiting, timeout=1)
+        assert queue.stage_waiting['encode'] == 0
+        # El slot no quedó tomado por la espera abandonada
+        async with queue.stage('encode'):
+            pass
+
+    asyncio.run(main())
+
+def test_cancel_while_waiting_for_an_identical_job(tmp_path):
+    async def main():
+        cache = ResultCache(str(tmp_path / "cache.db"))
+        key = cache.make_key('file', '360p', 'hash')
+        assert await cache.acquire(key) is None
+        token = CancelToken()
+        waiting = asyncio.create_task(token.wait_for(cache.acquire(key)))
+        await asyncio.sleep(0.05)
+        token.cancel()
+        with pytest.raises(JobCancelled):
+            await asyncio.wait_for(waiting, timeout=1)
+        await cache.complete(key, 'file-id', {})
+        assert (await cache.acquire(key))['file_id'] == 'file-id'
+
+    asyncio.run(main())
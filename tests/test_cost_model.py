@@ -0,0 +1,41 @@
+from types import SimpleNamespace
+from cost_model import cost_model, CostModel
+from queue_manager import Job
+
+def job_for(media, info=None):
+    job = Job(1, SimpleNamespace(video=media, document=None, id=1), '360p')
+    job.info = info
+    return job
+
+def test_features_use_probe_fps_and_codec():
+    media = SimpleNamespace(file_size=50 * 1024 * 1024, duration=100, height=720, mime_type='video/mp4')
+    plain = cost_model.features(job_for(media))
+    assert (plain['fps'], plain['codec']) == (30, None)
+
+    info = SimpleNamespace(fps=60, video_codec='hevc', duration=100, height=720)
+    probed = cost_model.features(job_for(media, info))
+    assert (probed['fps'], probed['codec']) == (60, 'hevc')
+    # 60 fps en HEVC: el doble de cuadros y decodificación más cara
+    assert cost_model.predict(job_for(media, info))['encode'] > 2 * cost_model.predict(job_for(media))['encode']
+
+def test_features_guess_codec_from_mime_type():
+    media = SimpleNamespace(file_size=1024, duration=10, height=0, mime_type='video/webm')
+    assert cost_model.features(job_for(media))['codec'] == 'vp9'
+
+def test_observe_encode_counts_only_real_encode_work():
+    model = CostModel()
+    info = SimpleNamespace(fps=30, video_codec='h264', duration=100, height=720, size=0)
+    model.observe_encode('360p', info, 50, {'rate_control': '1-pass VBV'})
+    assert model.encode_speed('360p', 720) == 2.0
+    # Dos pasadas: el mismo tiempo cubre más trabajo
+    model = CostModel()
+    model.observe_encode('360p', info, 70, {'rate_control': '2-pass'})
+    assert model.encode_speed('360p', 720) == 2.0
+    # El análisis de CRF no es tiempo de encode
+    model = CostModel()
+    model.observe_encode('360p', info, 80, {'encoder': {'crf_analysis': {'seconds': 30}}})
+    assert model.encode_speed('360p', 720) == 2.0
+    # Por segmentos la velocidad es la de varios slots: no se aprende
+    model = CostModel()
+    model.observe_encode('360p', info, 10, {'encoder': {'segments': 4}})
+    assert ('360p', 'hd') not in model.encode_speeds
@@ -0,0 +1,13 @@
+from compressor import compressor, QUALITY_PRESETS
+from crf_analysis import crf_analyzer
+
+def test_streaming_is_skipped_when_crf_analysis_would_run():
+    preset = QUALITY_PRESETS['360p']
+    # Un video corto no deja presupuesto para el análisis y puede ir en streaming
+    assert not crf_analyzer.applies('360p', preset, 10)
+    assert not compressor.needs_file(None, '360p', 10)
+    # Uno más largo se analiza, así que necesita el original en disco
+    assert crf_analyzer.applies('360p', preset, 600)
+    assert compressor.needs_file(None, '360p', 600)
+    # Con tamaño objetivo manda el bitrate y no hay análisis
+    assert compressor.needs_file(None, '360p', 600, 10 * 1024 * 1024) == (compressor.segment_count(600) > 1)
@@ -0,0 +1,63 @@
+import pytest
+import encoder_policy as policy_module
+from encoder_policy import EncoderPolicy
+
+@pytest.fixture
+def policy(monkeypatch):
+    monkeypatch.setattr(policy_module, 'ADAPTIVE_ENCODER', True)
+    monkeypatch.setattr(policy_module, 'POLICY_BACKLOG', 3)
+    monkeypatch.setattr(policy_module, 'POLICY_SLOW_MAX_DURATION', 600)
+    monkeypatch.setattr(policy_module, 'POLICY_MIN_SPEED', 1.0)
+    return EncoderPolicy()
+
+def rung(policy, *args, **kwargs):
+    chosen, _, reason = policy.choose(*args, **kwargs)
+    return chosen['name'], reason
+
+def test_idle_tries_medium_until_it_is_measured_too_slow(policy):
+    assert rung(policy, 60, '360p', load=0) == ('hevc-medium', 'idle')
+    policy.record('hevc-medium', '360p', 60, 200)
+    assert rung(policy, 60, '360p', load=0) == ('hevc-veryfast', 'idle+slow')
+    # Medido rápido en otra calidad: ahí sigue valiendo
+    policy.record('hevc-medium', '720p', 60, 30)
+    assert rung(policy, 60, '720p', load=0) == ('hevc-medium', 'idle')
+
+def test_long_videos_and_light_load_skip_medium(policy):
+    assert rung(policy, 3600, '360p', load=0) == ('hevc-veryfast', 'light')
+    assert rung(policy, 60, '360p', load=0.5) == ('hevc-veryfast', 'light')
+
+def test_busy_and_backlog(policy):
+    assert rung(policy, 60, '360p', load=1) == ('hevc-ultrafast', 'busy')
+    assert rung(policy, 60, '360p', load=3) == ('avc-superfast', 'backlog')
+
+def test_target_size_stays_on_x265(policy):
+    assert rung(policy, 60, '360p', target_size=20, load=5) == ('hevc-ultrafast', 'backlog')
+    assert rung(policy, 60, '360p', target_size=20, load=0) == ('hevc-medium', 'idle')
+    # Ni siquiera lento se baja a x264: las dos pasadas necesitan x265
+    policy.record('hevc-ultrafast', '360p', 60, 600)
+    assert rung(policy, 60, '360p', target_size=20, load=1) == ('hevc-ultrafast', 'busy')
+
+def test_pinned_and_fixed(policy, monkeypatch):
+    policy.pinned = 'avc-superfast'
+    assert rung(policy, 60, '360p', load=0) == ('avc-superfast', 'pinned')
+    policy.pinned = None
+    monkeypatch.setattr(policy_module, 'ADAPTIVE_ENCODER', False)
+    assert rung(policy, 60, '360p', load=0) == ('hevc-ultrafast', 'fixed')
+
+def test_apply_without_count_leaves_encoder_choices_alone(policy, monkeypatch):
+    counted = []
+    monkeypatch.setattr(policy_module.metrics.encoder_choices, 'inc', lambda **labels: counted.append(labels))
+    preset = {'name': '360p', 'crf': 30}
+    policy.apply('360p', preset, 60, load=0, count=False)
+    assert counted == []
+    effective = policy.apply('360p', preset, 60, load=0)
+    assert counted == [{'rung': effective['encoder']['rung']}]
+
+def test_cached_results_from_a_faster_rung_are_not_served_when_idle(policy, monkeypatch):
+    monkeypatch.setattr(policy, 'load', lambda: 0)
+    assert not policy.serves({'rung': 'avc-superfast'}, 60, '360p')
+    assert policy.serves({'rung': 'hevc-medium'}, 60, '360p')
+    # Sin escalón (original, remux) siempre vale
+    assert policy.serves(None, 60, '360p')
+    monkeypatch.setattr(policy, 'load', lambda: 5)
+    assert policy.serves({'rung': 'avc-superfast'}, 60, '360p')
@@ -0,0 +1,86 @@
+import asyncio
+import os
+from aiohttp import web
+from parallel_download import ParallelDownloader, HttpFetcher, CHUNK_SIZE
+
+DATA = os.urandom(5 * CHUNK_SIZE + 12345)
+
+async def serve(failures=()):
+    """Servidor con rangos que responde 500 la primera vez que se pide cada offset de `failures`."""
+    requested = []
+    pending = set(failures)
+
+    async def handler(request):
+        start, end = request.http_range.start, request.http_range.stop
+        requested.append(start)
+        if start in pending:
+            pending.discard(start)
+            return web.Response(status=500)
+        end = min(end or len(DATA), len(DATA))
+        return web.Response(
+            status=206, body=DATA[start:end],
+            headers={'Content-Range': f"bytes {start}-{end - 1}/{len(DATA)}", 'Accept-Ranges': 'bytes'}
+        )
+
+    app = web.Application()
+    app.router.add_get('/video.mp4', handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}/video.mp4", requested
+
+def downloader(url):
+    return ParallelDownloader(HttpFetcher(url, allow_private=True), connections=3, range_size=CHUNK_SIZE)
+
+def test_ranges_are_retried_and_reassembled(tmp_path):
+    path = str(tmp_path / "input.mp4")
+
+    async def main():
+        runner, url, requested = await serve(failures={2 * CHUNK_SIZE})
+        try:
+            await downloader(url).download(path, len(DATA))
+        finally:
+            await runner.cleanup()
+        return requested
+
+    requested = asyncio.run(main())
+    assert requested.count(2 * CHUNK_SIZE) == 2
+    with open(path, 'rb') as f:
+        assert f.read() == DATA
+    assert not os.path.exists(path + ".ranges")
+
+def test_download_resumes_from_journal(tmp_path):
+    path = str(tmp_path / "input.mp4")
+    done = [0, 3 * CHUNK_SIZE]
+    # Descarga anterior cortada: dos rangos escritos y anotados
+    with open(path, 'wb') as f:
+        f.truncate(len(DATA))
+        for start in done:
+            f.seek(start)
+            f.write(DATA[start:start + CHUNK_SIZE])
+    with open(path + ".ranges", 'w') as f:
+        f.write(f"{len(DATA)}\n" + "".join(f"{start}\n" for start in done))
+
+    async def main():
+        runner, url, requested = await serve()
+        try:
+            await downloader(url).download(path, len(DATA))
+        finally:
+            await runner.cleanup()
+        return requested
+
+    requested = asyncio.run(main())
+    assert not set(requested) & set(done)
+    assert sorted(requested) == [start for start in range(0, len(DATA), CHUNK_SIZE) if start not in done]
+    with open(path, 'rb') as f:
+        assert f.read() == DATA
+
+def test_discard_removes_the_preallocated_file_and_journal(tmp_path):
+    path = str(tmp_path / "input.mp4")
+    for leftover in (path, path + ".ranges"):
+        open(leftover, 'w').close()
+    ParallelDownloader.discard(path)
+    ParallelDownloader.discard(path)
+    assert not os.listdir(tmp_path)
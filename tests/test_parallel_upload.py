@@ -0,0 +1,74 @@
+import asyncio
+import pytest
+import stream_upload
+from stream_upload import ParallelUpload, PART_SIZE
+
+class FakeSession:
+    def __init__(self):
+        self.parts = []
+        self.stopped = False
+
+    async def invoke(self, request):
+        self.parts.append(request.file_part)
+
+    async def stop(self):
+        self.stopped = True
+
+class FakeClient:
+    def rnd_id(self):
+        return 1
+
+def opener(sessions, fail_every):
+    count = [0]
+
+    async def open_media_session(client):
+        count[0] += 1
+        index = count[0]
+        await asyncio.sleep(0.01 * index)
+        if index % fail_every == 0:
+            raise ConnectionError("sin conexión")
+        session = FakeSession()
+        sessions.append(session)
+        return session
+    return open_media_session
+
+def upload(tmp_path, connections=4):
+    path = tmp_path / "output.mp4"
+    path.write_bytes(b'\x00' * (PART_SIZE * 6 + 10))
+    return ParallelUpload(FakeClient(), str(path), connections=connections)
+
+def test_failed_connection_does_not_leak_the_others(tmp_path, monkeypatch):
+    sessions = []
+    # La segunda conexión falla: la subida sigue con las otras tres
+    monkeypatch.setattr(stream_upload, 'open_media_session', opener(sessions, fail_every=2))
+    result = asyncio.run(upload(tmp_path).run())
+    assert result.parts == 7
+    assert sorted(part for session in sessions for part in session.parts) == list(range(7))
+    assert sessions and all(session.stopped for session in sessions)
+
+def test_all_connections_failing_raises_after_closing(tmp_path, monkeypatch):
+    sessions = []
+    monkeypatch.setattr(stream_upload, 'open_media_session', opener(sessions, fail_every=1))
+    with pytest.raises(ConnectionError):
+        asyncio.run(upload(tmp_path).run())
+    assert not sessions
+
+def test_growing_upload_holds_its_slot_until_done(tmp_path, monkeypatch):
+    sessions = []
+    monkeypatch.setattr(stream_upload, 'open_media_session', opener(sessions, fail_every=100))
+    path = tmp_path / "output.mp4"
+    parts = stream_upload.BIG_FILE_MIN // PART_SIZE + 1
+    path.write_bytes(b'\x00' * (PART_SIZE * parts))
+
+    async def run():
+        slot = asyncio.Semaphore(1)
+        growing = stream_upload.GrowingFileUpload(FakeClient(), str(path), "output.mp4")
+        growing.start(slot)
+        await asyncio.sleep(0.05)
+        # Mientras el encode sigue la subida ocupa el slot
+        assert slot.locked()
+        growing.finish(True)
+        input_file = await growing.result()
+        assert input_file.parts == parts
+        assert not slot.locked()
+    asyncio.run(run())
@@ -0,0 +1,24 @@
+import asyncio
+from result_cache import ResultCache
+
+def test_acquire_skips_entries_that_are_not_accepted(tmp_path):
+    async def main():
+        cache = ResultCache(str(tmp_path / "cache.db"))
+        key = cache.make_key('file', '360p', 'hash')
+        assert await cache.acquire(key) is None
+        await cache.complete(key, 'fast', {'encoder': {'rung': 'avc-superfast'}})
+
+        def slow_only(entry):
+            return entry['stats']['encoder']['rung'] != 'avc-superfast'
+
+        assert (await cache.acquire(key))['file_id'] == 'fast'
+        # Rechazada: quien llama queda a cargo y un trabajo idéntico espera su resultado
+        assert await cache.acquire(key, accept=slow_only) is None
+        waiting = asyncio.create_task(cache.acquire(key, accept=slow_only))
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        await cache.complete(key, 'slow', {'encoder': {'rung': 'hevc-medium'}})
+        assert (await waiting)['file_id'] == 'slow'
+        assert (await cache.acquire(key, accept=slow_only))['file_id'] == 'slow'
+
+    asyncio.run(main())
@@ -0,0 +1,38 @@
+import asyncio
+import os
+import threading
+from spool import SpoolManager
+
+def test_forget_releases_a_retained_workspace(tmp_path):
+    async def main():
+        spool = SpoolManager(str(tmp_path / "spool"), min_free=0)
+        # Trabajo recuperado tras un reinicio: sólo su directorio, sin reserva
+        os.makedirs(spool.root + "/job1")
+        spool.retain("job1")
+        await spool.forget("job1")
+        assert not os.path.exists(spool.root + "/job1")
+        assert "job1" not in spool.retained
+        await spool.forget("unknown")
+
+    asyncio.run(main())
+
+def test_acquire_evicts_off_the_event_loop(tmp_path, monkeypatch):
+    async def main():
+        spool = SpoolManager(str(tmp_path / "spool"), min_free=0)
+        loop_thread = threading.get_ident()
+        threads = []
+        freed = []
+
+        def evict(needed=0, max_age=None):
+            threads.append(threading.get_ident())
+            freed.append(needed)
+            return needed
+
+        monkeypatch.setattr(spool, 'evict', evict)
+        # Sin espacio hasta que evict libera lo que falta
+        monkeypatch.setattr(spool, 'available', lambda: 100 if freed else 0)
+        workspace = await spool.acquire("job2", 50)
+        assert os.path.isdir(workspace.dir)
+        assert threads and loop_thread not in threads
+
+    asyncio.run(main())
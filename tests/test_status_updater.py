@@ -0,0 +1,74 @@
+import asyncio
+from types import SimpleNamespace
+from status_updater import StatusUpdater, TokenBucket, NETWORK_RETRIES
+
+class FakeMessage:
+    def __init__(self, chat_id=1, message_id=1, errors=()):
+        self.chat = SimpleNamespace(id=chat_id)
+        self.id = message_id
+        self.errors = list(errors)
+        self.edits = []
+
+    async def edit_text(self, text):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.edits.append(text)
+
+async def drained(updater):
+    while updater.drainers:
+        await asyncio.gather(*list(updater.drainers.values()), return_exceptions=True)
+
+def test_token_bucket_refills_at_its_rate():
+    bucket = TokenBucket(rate=10, capacity=2)
+    bucket.take()
+    bucket.take()
+    assert 0 < bucket.delay() <= 0.1
+    bucket.updated -= 0.1
+    assert bucket.delay() == 0
+
+def test_updates_are_coalesced_to_the_latest_text():
+    async def main():
+        updater = StatusUpdater(chat_rate=20, chat_burst=1, global_rate=100, global_burst=10)
+        message = FakeMessage()
+        for step in range(5):
+            updater.update(message, f"paso {step}")
+        await drained(updater)
+        assert message.edits == ["paso 4"]
+        assert updater.coalesced == 4
+        # El mismo texto otra vez no genera otra edición
+        updater.update(message, "paso 4")
+        await drained(updater)
+        assert message.edits == ["paso 4"]
+
+    asyncio.run(main())
+
+def test_chat_bucket_paces_edits():
+    async def main():
+        updater = StatusUpdater(chat_rate=20, chat_burst=1, global_rate=100, global_burst=10)
+        message = FakeMessage()
+        started = asyncio.get_running_loop().time()
+        updater.update(message, "uno")
+        await asyncio.sleep(0)
+        updater.update(message, "dos")
+        await drained(updater)
+        assert message.edits == ["uno", "dos"]
+        # La segunda espera un token: 1 / 20 s
+        assert asyncio.get_running_loop().time() - started >= 0.04
+
+    asyncio.run(main())
+
+def test_network_errors_keep_the_text():
+    async def main():
+        updater = StatusUpdater(chat_rate=100, chat_burst=5, global_rate=100, global_burst=5)
+        message = FakeMessage(errors=[ConnectionError("sin red"), TimeoutError()])
+        updater.update(message, "✅ listo")
+        await drained(updater)
+        assert message.edits == ["✅ listo"]
+
+        # Si no se recupera, el texto se descarta sin matar al drainer
+        broken = FakeMessage(message_id=2, errors=[OSError("sin red")] * NETWORK_RETRIES)
+        updater.update(broken, "final")
+        await drained(updater)
+        assert broken.edits == [] and not updater.pending
+
+    asyncio.run(main())
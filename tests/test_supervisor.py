@@ -0,0 +1,42 @@
+import asyncio
+import sys
+import time
+from cancellation import CancelToken
+from supervisor import supervisor
+
+def test_stderr_is_drained_past_an_overlong_line():
+    # Una línea de 200 KB supera el límite de 64 KB del StreamReader; lo que sigue también se lee
+    script = "import sys; sys.stderr.write('x' * 200000 + '\\n'); sys.stderr.write('fin\\n' * 2000)"
+
+    async def main():
+        return await supervisor.run([sys.executable, '-c', script], timeout=10)
+
+    returncode, _, stderr = asyncio.run(main())
+    assert returncode == 0
+    assert stderr.endswith('fin')
+
+def test_run_stops_when_the_job_is_cancelled():
+    async def main():
+        token = CancelToken()
+        asyncio.get_running_loop().call_later(0.2, token.cancel)
+        started = time.monotonic()
+        returncode, _, _ = await supervisor.run([sys.executable, '-c', 'import time; time.sleep(30)'], token=token)
+        assert returncode == -1
+        assert time.monotonic() - started < 5
+        assert not supervisor.running
+
+    asyncio.run(main())
+
+def test_process_gauge_counts_every_supervised_process():
+    from metrics import metrics
+
+    def gauge():
+        line = next(l for l in metrics.render().splitlines() if l.startswith('videobot_ffmpeg_processes '))
+        return float(line.split()[1])
+
+    async def main():
+        async with await supervisor.spawn([sys.executable, '-c', 'import time; time.sleep(5)']):
+            assert gauge() == 1
+        assert gauge() == 0
+
+    asyncio.run(main())
@@ -0,0 +1,84 @@
+import asyncio
+import pytest
+from aiohttp import web
+import parallel_download
+import url_source
+from parallel_download import BlockedAddressError, is_public_address
+from url_source import UrlSource
+
+async def serve(routes):
+    app = web.Application()
+    app.add_routes(routes)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+def test_public_address_check():
+    assert is_public_address('93.184.216.34')
+    for host in ('127.0.0.1', '10.0.0.5', '169.254.169.254', '::1', '::ffff:127.0.0.1', 'fd00::1', '0.0.0.0'):
+        assert not is_public_address(host)
+
+def test_private_addresses_are_rejected():
+    async def video(request):
+        return web.Response(body=b'x')
+
+    async def main():
+        runner, base = await serve([web.get('/video.mp4', video)])
+        try:
+            # IP literal y nombre que resuelve a loopback
+            with pytest.raises(BlockedAddressError):
+                await UrlSource.probe(base + '/video.mp4')
+            with pytest.raises(BlockedAddressError):
+                await UrlSource.probe(base.replace('127.0.0.1', 'localhost') + '/video.mp4')
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(main())
+
+def test_redirects_are_checked(monkeypatch):
+    # Sólo 127.0.0.1 cuenta como "pública": la redirección a 127.0.0.2 tiene que cortarse
+    monkeypatch.setattr(parallel_download, 'is_public_address', lambda host: host == '127.0.0.1')
+
+    async def redirect(request):
+        raise web.HTTPFound(str(request.url.with_host('127.0.0.2')))
+
+    async def main():
+        runner, base = await serve([web.get('/video.mp4', redirect)])
+        try:
+            with pytest.raises(BlockedAddressError):
+                await UrlSource.probe(base + '/video.mp4')
+            with pytest.raises(BlockedAddressError):
+                async for _ in UrlSource(base + '/video.mp4')._chunks():
+                    pass
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(main())
+
+def test_streamed_body_is_capped(monkeypatch):
+    monkeypatch.setattr(url_source, 'MAX_FILE_SIZE', 3 * url_source.STREAM_CHUNK)
+
+    async def endless(request):
+        # Sin Content-Length: el tamaño no se conoce de antemano
+        resp = web.StreamResponse()
+        await resp.prepare(request)
+        for _ in range(10):
+            await resp.write(b'\x00' * url_source.STREAM_CHUNK)
+        return resp
+
+    async def main():
+        runner, base = await serve([web.get('/video.mkv', endless)])
+        try:
+            source = UrlSource(base + '/video.mkv', allow_private=True)
+            received = 0
+            with pytest.raises(ValueError):
+                async for chunk in source._chunks():
+                    received += len(chunk)
+            assert received <= url_source.MAX_FILE_SIZE
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(main())
@@ -0,0 +1,181 @@
+import contextvars
+import json
+import math
+import os
+import time
+from collections import deque, defaultdict
+from contextlib import contextmanager
+from config import TRACE_JOBS, TRACE_LOG_PATH, TRACE_LOG_MAX
+
+# Traza del trabajo en curso: las tareas creadas dentro del trabajo la heredan
+_current = contextvars.ContextVar('trace', default=None)
+# Un trabajo con cientos de ediciones de estado no debe crecer sin límite
+MAX_SPANS = 500
+
+def percentile(values, fraction):
+    """Percentil por rango más cercano de una lista no vacía."""
+    values = sorted(values)
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+class Trace:
+    def __init__(self, job_id, **attrs):
+        self.job_id = job_id
+        self.attrs = attrs
+        self.started = time.time()
+        self.duration = None
+        self.outcome = None
+        self.spans = []
+        self.dropped = 0
+
+    def add(self, name, start, duration, **attrs):
+        if self.duration is not None:
+            # Ediciones de estado que llegan después de cerrar el trabajo
+            return
+        if len(self.spans) >= MAX_SPANS:
+            self.dropped += 1
+            return
+        self.spans.append({'name': name, 'start': round(start - self.started, 3), 'duration': round(duration, 3), **attrs})
+
+    def phases(self):
+        """{fase: (veces, segundos totales, máximo)}"""
+        totals = {}
+        for span in self.spans:
+            count, total, longest = totals.get(span['name'], (0, 0, 0))
+            totals[span['name']] = (count + 1, total + span['duration'], max(longest, span['duration']))
+        return totals
+
+    def to_dict(self):
+        return {
+            'job_id': self.job_id,
+            'started': self.started,
+            'duration': self.duration,
+            'outcome': self.outcome,
+            'attrs': self.attrs,
+            'spans': self.spans,
+            'dropped': self.dropped
+        }
+
+class Tracer:
+    """
+    Trazas por trabajo: cada fase (cola, descarga, espera del archivo, probe, encode,
+    probe de la salida, subida, ediciones de estado) queda como un span con su
+    inicio y duración. Las últimas TRACE_JOBS trazas viven en memoria para /stats y
+    /trace; con TRACE_LOG_PATH además se agrega una línea JSON por trabajo en disco.
+    """
+    def __init__(self, max_jobs=TRACE_JOBS, log_path=TRACE_LOG_PATH, log_max=TRACE_LOG_MAX):
+        self.finished = deque(maxlen=max_jobs)
+        self.active = {}
+        self.log_path = log_path
+        self.log_max = log_max
+
+    @contextmanager
+    def trace(self, job_id, **attrs):
+        trace = Trace(job_id, **attrs)
+        self.active[job_id] = trace
+        token = _current.set(trace)
+        try:
+            yield trace
+        finally:
+            _current.reset(token)
+            trace.duration = time.time() - trace.started
+            trace.outcome = trace.outcome or 'failed'
+            self.active.pop(job_id, None)
+            self.finished.append(trace)
+            self._log(trace)
+
+    def current(self):
+        return _current.get()
+
+    def annotate(self, **attrs):
+        trace = _current.get()
+        if trace:
+            trace.attrs.update(attrs)
+
+    def set_outcome(self, outcome):
+        trace = _current.get()
+        if trace:
+            trace.outcome = outcome
+
+    def record(self, name, duration, **attrs):
+        """Span de una fase ya medida que termina ahora."""
+        trace = _current.get()
+        if trace:
+            trace.add(name, time.time() - duration, duration, **attrs)
+
+    @contextmanager
+    def span(self, name, **attrs):
+        trace = _current.get()
+        start = time.time()
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            if trace:
+                trace.add(name, start, time.monotonic() - started, **attrs)
+
+    def get(self, job_id):
+        if job_id in self.active:
+            return self.active[job_id]
+        for trace in reversed(self.finished):
+            if trace.job_id == job_id:
+                return trace
+        return None
+
+    def slowest(self, count=5):
+        return sorted(self.finished, key=lambda trace: trace.duration, reverse=True)[:count]
+
+    def summary(self, last=None):
+        """
+        Percentiles de cada fase, throughput y reducción por preset de los últimos
+        `last` trabajos terminados (los servidos desde caché no cuentan).
+        """
+        traces = [
+            trace for trace in self.finished
+            if trace.outcome in ('done', 'failed', 'cancelled') and not trace.attrs.get('cached')
+        ]
+        if last:
+            traces = traces[-last:]
+        phases = defaultdict(list)
+        download, upload, speed = [], [], []
+        reduction = defaultdict(list)
+        for trace in traces:
+            totals = trace.phases()
+            for name, (_, total, _) in totals.items():
+                phases[name].append(total)
+            attrs = trace.attrs
+            for name, rates in (('download', download), ('stream', download)):
+                if name in totals and attrs.get('input_size') and totals[name][1] > 0:
+                    rates.append(attrs['input_size'] / (1024 * 1024) / totals[name][1])
+            if 'upload' in totals and attrs.get('output_size') and totals['upload'][1] > 0:
+                upload.append(attrs['output_size'] / (1024 * 1024) / totals['upload'][1])
+            encode = totals.get('encode') or totals.get('stream')
+            if encode and attrs.get('media_duration') and encode[1] > 0:
+                speed.append(attrs['media_duration'] / encode[1])
+            if trace.outcome == 'done' and attrs.get('input_size') and 'output_size' in attrs:
+                reduction[attrs.get('preset')].append((1 - attrs['output_size'] / attrs['input_size']) * 100)
+
+        def stats(values):
+            return {'count': len(values), 'p50': percentile(values, 0.5), 'p95': percentile(values, 0.95)} if values else None
+
+        return {
+            'jobs': len(traces),
+            'phases': {name: stats(values) for name, values in phases.items()},
+            'download_mbps': stats(download),
+            'upload_mbps': stats(upload),
+            'encode_speed': stats(speed),
+            'reduction': {preset: stats(values) for preset, values in reduction.items()}
+        }
+
+    def _log(self, trace):
+        if not self.log_path:
+            return
+        try:
+            if os.path.exists(self.log_path) and os.path.getsize(self.log_path) > self.log_max:
+                # Una sola rotación: el log anterior queda como .1
+                os.replace(self.log_path, self.log_path + ".1")
+            with open(self.log_path, 'a') as f:
+                f.write(json.dumps(trace.to_dict(), ensure_ascii=False) + "\n")
+        except OSError as e:
+            print(f"Error escribiendo la traza de {trace.job_id}: {e}")
+
+tracer = Tracer()
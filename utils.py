@@ -1,7 +1,5 @@
 import os
-import asyncio
 import aiofiles
-import glob
 from datetime import datetime
 
 def format_bytes(size):
@@ -11,44 +9,17 @@ def format_bytes(size):
         size /= 1024.0
     return f"{size:.2f} TB"
 
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{max(seconds, 1)} s"
+    if seconds < 3600:
+        return f"{round(seconds / 60)} min"
+    return f"{seconds // 3600} h {seconds % 3600 // 60:02d} min"
+
 def get_file_size(file_path):
     return os.path.getsize(file_path)
 
-async def wait_for_file(file_path, timeout=30, check_interval=0.5):
-    """
-    Robustly wait for a file to exist, handling .temp file renames
-    Returns the actual path to the file, or None if timeout
-    """
-    start_time = asyncio.get_event_loop().time()
-    base_path = file_path.rstrip('.temp')
-    
-    while asyncio.get_event_loop().time() - start_time < timeout:
-        # Check main path
-        if os.path.exists(base_path):
-            return base_path
-        
-        # Check .temp path
-        temp_path = base_path + ".temp"
-        if os.path.exists(temp_path):
-            try:
-                os.rename(temp_path, base_path)
-                return base_path
-            except:
-                await asyncio.sleep(check_interval)
-                continue
-        
-        await asyncio.sleep(check_interval)
-    
-    # Last attempt: search for partial matches
-    dir_path = os.path.dirname(base_path) or "."
-    base_name = os.path.basename(base_path)
-    
-    for file in glob.glob(os.path.join(dir_path, f"*{base_name}*")):
-        if not file.endswith('.temp'):
-            return file
-    
-    return None
-
 async def cleanup_file(file_path):
     try:
         if os.path.exists(file_path):
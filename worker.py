@@ -0,0 +1,120 @@
+"""
+Worker de encode: toma tareas del broker, las comprime con VideoCompressor y
+reporta progreso y resultado. El bot debe correr con ENCODE_BACKEND=broker.
+
+    python worker.py                                   # misma máquina (SQLite compartido)
+    python worker.py --url http://bot:8080 --slots 2   # otra máquina (necesita WORKER_TOKEN)
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import socket
+import time
+from broker import TaskBroker, HttpBrokerClient
+from compressor import compressor
+from config import DOWNLOAD_DIR, ENCODE_SLOTS, WORKER_HEARTBEAT
+
+PROGRESS_INTERVAL = 1.0
+IDLE_POLL = 2.0
+
+class EncodeWorker:
+    def __init__(self, broker, name, slots):
+        self.broker = broker
+        self.name = name
+        self.slots = slots
+        self.worker_id = None
+        self.running = {}
+
+    async def start(self):
+        self.worker_id = await self.broker.register(self.name, self.slots)
+        print(f"👷 Worker {self.name} registrado como {self.worker_id} ({self.slots} slots)")
+        loops = [asyncio.create_task(self._slot_loop(i)) for i in range(self.slots)]
+        loops.append(asyncio.create_task(self._heartbeat_loop()))
+        await asyncio.gather(*loops)
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(WORKER_HEARTBEAT)
+            try:
+                if not await self.broker.heartbeat(self.worker_id):
+                    # El bot nos dio por muertos y reasignó las tareas: se abortan y se vuelve a registrar
+                    print("⚠️ Registro perdido; abortando tareas en curso")
+                    for task_id in list(self.running):
+                        compressor.set_cancel_flag(task_id, True)
+                    self.worker_id = await self.broker.register(self.name, self.slots)
+            except Exception as e:
+                print(f"Error en heartbeat: {e}")
+
+    async def _slot_loop(self, slot):
+        while True:
+            try:
+                task = await self.broker.claim(self.worker_id)
+            except Exception as e:
+                print(f"Error pidiendo tarea: {e}")
+                task = None
+            if task is None:
+                await asyncio.sleep(IDLE_POLL)
+                continue
+            task['worker_id'] = self.worker_id
+            await self._process(task)
+
+    async def _process(self, task):
+        task_id = task['id']
+        worker_id = task['worker_id']
+        workdir = os.path.join(DOWNLOAD_DIR, 'worker', task_id)
+        self.running[task_id] = task
+        last_report = [0.0]
+
+        # El flag de cancelación se indexa por tarea: en el worker no hay usuarios
+        async def report(progress, elapsed=0, current_size=0):
+            now = time.monotonic()
+            if now - last_report[0] < PROGRESS_INTERVAL and progress < 1.0:
+                return
+            last_report[0] = now
+            try:
+                if await self.broker.progress(task_id, worker_id, progress, elapsed, current_size):
+                    compressor.set_cancel_flag(task_id, True)
+            except Exception as e:
+                print(f"Error reportando progreso: {e}")
+
+        try:
+            print(f"🎬 Tarea {task_id} ({task['quality']})")
+            input_path, output_path = await self.broker.fetch_input(task, workdir)
+            target_size = task['target_size'] * 1024 * 1024 if task['target_size'] else None
+            result = await compressor.compress_video(
+                input_path, output_path, task_id, task['quality'], report, target_size=target_size,
+                # Aquí la cola está vacía: la carga la mide el bot al encolar
+                load=task.get('load')
+            )
+            if compressor.should_cancel(task_id):
+                print(f"❌ Tarea {task_id} cancelada")
+            elif result is None:
+                await self.broker.fail(task_id, worker_id, 'compress_video devolvió None')
+            else:
+                await self.broker.send_output(task, output_path)
+                await self.broker.complete(task_id, worker_id, result)
+                print(f"✅ Tarea {task_id} completada")
+        except Exception as e:
+            print(f"Error en tarea {task_id}: {e}")
+            try:
+                await self.broker.fail(task_id, worker_id, e)
+            except Exception:
+                pass
+        finally:
+            compressor.clear_cancel_flag(task_id)
+            self.running.pop(task_id, None)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Worker de encode para el bot compresor")
+    parser.add_argument('--url', help="URL del bot para workers remotos (por defecto, SQLite local)")
+    parser.add_argument('--slots', type=int, default=ENCODE_SLOTS, help="Encodes simultáneos")
+    parser.add_argument('--name', default=socket.gethostname())
+    args = parser.parse_args()
+
+    broker = HttpBrokerClient(args.url) if args.url else TaskBroker()
+    asyncio.run(EncodeWorker(broker, args.name, args.slots).start())
+
+if __name__ == "__main__":
+    main()